@@ -0,0 +1,326 @@
+"""
+Peer address module for Enclave.
+A peer can list several addresses (IPv4, IPv6, LAN and WAN, or hostnames)
+in its .address file, separated by commas or newlines. The first address
+identifies the peer to the connection pool and version negotiation;
+connecting to it tries all of the peer's addresses happy-eyeballs style:
+attempts start ATTEMPT_DELAY apart (or at once when one fails), the first
+to connect wins and the others are closed.
+
+The handshake time of each winning connection is kept per address, so
+later connections try the fastest working path first and addresses that
+just failed last. Hostnames are resolved with getaddrinfo, to IPv6 and
+IPv4, and cached for RESOLVE_TTL seconds.
+"""
+
+import os
+import time
+import errno
+import socket
+import selectors
+import threading
+from . import metrics
+
+
+# Seconds before an attempt on the next address starts while earlier ones are pending (RFC 8305)
+ATTEMPT_DELAY = 0.25
+
+# Seconds to wait for any address to connect
+CONNECT_TIMEOUT = 10
+
+# Seconds resolved hostnames are cached
+RESOLVE_TTL = 300
+
+# Seconds an address that failed to connect is tried after the others
+FAILURE_PENALTY = 60
+
+# Weight of the newest handshake time in the smoothed RTT
+RTT_SMOOTHING = 0.25
+
+
+def parse_address(text: str) -> tuple:
+    """
+    Parse one address: "host:port", "[ipv6]:port" or "ipv6:port".
+
+    Args:
+        text: Address text
+
+    Returns:
+        Tuple of (host, port)
+
+    Raises:
+        ValueError: If the address has no valid port
+    """
+    text = text.strip()
+    if text.startswith('['):
+        host, _, port_str = text[1:].partition(']')
+        port_str = port_str[1:] if port_str.startswith(':') else ''
+    else:
+        host, _, port_str = text.rpartition(':')
+
+    try:
+        port = int(port_str)
+    except ValueError:
+        raise ValueError(f"Invalid address (use host:port): {text}")
+    if not host or not 0 < port < 65536:
+        raise ValueError(f"Invalid address (use host:port): {text}")
+    return host, port
+
+
+def parse_address_list(text: str) -> list:
+    """
+    Parse a peer's addresses, separated by commas or whitespace.
+
+    Args:
+        text: Address list text, e.g. the contents of a .address file
+
+    Returns:
+        List of (host, port) tuples, primary address first
+
+    Raises:
+        ValueError: If an address is invalid or the list is empty
+    """
+    addresses = [parse_address(part) for part in text.replace(',', ' ').split()]
+    if not addresses:
+        raise ValueError("No address given")
+    return addresses
+
+
+def format_address(host: str, port: int) -> str:
+    """
+    Format an address, bracketing IPv6 hosts.
+    """
+    return f"[{host}]:{port}" if ':' in host else f"{host}:{port}"
+
+
+class _Path:
+    """
+    Connection history of one resolved address.
+    """
+
+    __slots__ = ('rtt', 'connects', 'failures', 'failed_at')
+
+    def __init__(self):
+        self.rtt = None
+        self.connects = 0
+        self.failures = 0
+        self.failed_at = 0.0
+
+
+class AddressBook:
+    """
+    Alternate addresses of peers, resolved hostnames and per-address RTTs.
+    """
+
+    def __init__(self):
+        # Primary (host, port) -> all (host, port) addresses of the peer
+        self.alternates = {}
+
+        # (host, port) -> (time resolved, [(family, sockaddr), ...])
+        self.resolved = {}
+
+        # (family, sockaddr) -> _Path
+        self.paths = {}
+        self.lock = threading.Lock()
+
+    def set_addresses(self, addresses: list):
+        """
+        Register a peer's addresses; the first one is its primary address.
+
+        Args:
+            addresses: List of (host, port) tuples
+        """
+        with self.lock:
+            self.alternates[tuple(addresses[0])] = [tuple(address) for address in addresses]
+
+    def addresses(self, host: str, port: int) -> list:
+        """
+        Get all addresses of the peer with this primary address.
+
+        Returns:
+            List of (host, port) tuples, just the given one if none are registered
+        """
+        with self.lock:
+            return list(self.alternates.get((host, port), [(host, port)]))
+
+    def _resolve(self, host: str, port: int) -> list:
+        """
+        Resolve an address to connectable socket addresses, cached for RESOLVE_TTL.
+
+        Raises:
+            OSError: If the host cannot be resolved
+        """
+        now = time.monotonic()
+        with self.lock:
+            cached = self.resolved.get((host, port))
+        if cached is not None and now - cached[0] < RESOLVE_TTL:
+            return cached[1]
+
+        results = [(family, sockaddr) for family, _, _, _, sockaddr in
+                   socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+                   if family in (socket.AF_INET, socket.AF_INET6)]
+
+        with self.lock:
+            self.resolved[(host, port)] = (now, results)
+        return results
+
+    def candidates(self, host: str, port: int) -> list:
+        """
+        Get the socket addresses to try for a peer, best first: those with a
+        measured RTT fastest first, then untried ones in listed order, then
+        those that failed in the last FAILURE_PENALTY seconds.
+
+        Returns:
+            List of (family, sockaddr) tuples
+
+        Raises:
+            OSError: If none of the peer's addresses resolve
+        """
+        targets = []
+        error = None
+        for address in self.addresses(host, port):
+            try:
+                for target in self._resolve(*address):
+                    if target not in targets:
+                        targets.append(target)
+            except OSError as e:
+                error = e
+        if not targets:
+            raise error or OSError(f"Could not resolve {host}")
+
+        now = time.monotonic()
+        with self.lock:
+            def rank(item):
+                index, target = item
+                path = self.paths.get(target)
+                if path is None:
+                    return (False, True, 0.0, index)
+                recently_failed = now - path.failed_at < FAILURE_PENALTY
+                return (recently_failed, path.rtt is None, path.rtt or 0.0, index)
+
+            return [target for _, target in sorted(enumerate(targets), key=rank)]
+
+    def _record(self, target: tuple, rtt: float = None):
+        """
+        Record a connection attempt: its handshake time, or None if it failed.
+        """
+        with self.lock:
+            path = self.paths.get(target)
+            if path is None:
+                path = self.paths[target] = _Path()
+            if rtt is None:
+                path.failures += 1
+                path.failed_at = time.monotonic()
+            else:
+                path.connects += 1
+                path.failed_at = 0.0
+                path.rtt = rtt if path.rtt is None else path.rtt + RTT_SMOOTHING * (rtt - path.rtt)
+
+        if rtt is None:
+            metrics.increment('connect.failed_attempts')
+
+    def connect(self, host: str, port: int, timeout: float = CONNECT_TIMEOUT) -> socket.socket:
+        """
+        Connect to a peer over the first of its addresses to answer.
+
+        Args:
+            host: Peer's primary host
+            port: Peer's primary port
+            timeout: Seconds to wait for any address (default: 10)
+
+        Returns:
+            Connected blocking socket
+
+        Raises:
+            socket.timeout: If no address connected in time
+            OSError: If every address failed (the last error)
+        """
+        candidates = self.candidates(host, port)
+        selector = selectors.DefaultSelector()
+        pending = set()
+        error = None
+        deadline = time.monotonic() + timeout
+        next_start = 0.0
+
+        try:
+            while True:
+                now = time.monotonic()
+
+                # Start the next attempt when its turn comes or nothing else is pending
+                if candidates and (now >= next_start or not pending):
+                    target = candidates.pop(0)
+                    sock = socket.socket(target[0], socket.SOCK_STREAM)
+                    sock.setblocking(False)
+                    result = sock.connect_ex(target[1])
+                    if result == 0:
+                        self._record(target, time.monotonic() - now)
+                        sock.setblocking(True)
+                        return sock
+                    if result not in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+                        sock.close()
+                        self._record(target)
+                        error = OSError(result, os.strerror(result))
+                        continue
+
+                    selector.register(sock, selectors.EVENT_WRITE, (target, now))
+                    pending.add(sock)
+                    next_start = now + ATTEMPT_DELAY
+                    continue
+
+                if not pending:
+                    raise error or OSError(f"Could not connect to {host}:{port}")
+                if now >= deadline:
+                    raise socket.timeout(f"Timed out connecting to {host}:{port}")
+
+                wait = deadline - now
+                if candidates:
+                    wait = min(wait, max(0.0, next_start - now))
+
+                for key, _ in selector.select(wait):
+                    sock = key.fileobj
+                    target, started = key.data
+                    selector.unregister(sock)
+                    pending.discard(sock)
+
+                    result = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    if result:
+                        sock.close()
+                        self._record(target)
+                        error = OSError(result, os.strerror(result))
+
+                        # A failed attempt frees its turn for the next address
+                        next_start = 0.0
+                        continue
+
+                    self._record(target, time.monotonic() - started)
+                    sock.setblocking(True)
+                    return sock
+        finally:
+            for sock in pending:
+                sock.close()
+            selector.close()
+
+    def stats(self) -> dict:
+        """
+        Get the connection history of every resolved address.
+
+        Returns:
+            Dictionary mapping address to {'rtt_ms', 'connects', 'failures'}
+        """
+        with self.lock:
+            return {
+                format_address(*target[1][:2]): {
+                    'rtt_ms': path.rtt * 1000 if path.rtt is not None else None,
+                    'connects': path.connects,
+                    'failures': path.failures
+                }
+                for target, path in self.paths.items()
+            }
+
+
+# Addresses of this process's peers
+book = AddressBook()
+
+set_addresses = book.set_addresses
+connect = book.connect
+stats = book.stats
@@ -0,0 +1,371 @@
+"""
+Admission control module for Enclave.
+Rate limits received envelopes per source IP and per claimed sender
+fingerprint with token buckets before they reach the crypto workers, and
+shares the workers between sources with weighted fair queueing, so one
+flooding peer only slows down itself.
+"""
+
+import time
+import threading
+from queue import Empty, Full
+from collections import OrderedDict, Counter, deque
+
+
+# Envelopes per second and burst size allowed per source IP
+DEFAULT_IP_RATE = 5000
+DEFAULT_IP_BURST = 10000
+
+# Envelopes per second and burst size allowed per claimed sender fingerprint
+DEFAULT_SENDER_RATE = 2000
+DEFAULT_SENDER_BURST = 5000
+
+# Sources tracked at once; the least recently seen are forgotten first
+DEFAULT_MAX_SOURCES = 10000
+
+
+class TokenBucket:
+    """
+    Token bucket that may go into debt: taking more tokens than available
+    always succeeds and reports how long the caller has to wait until the
+    debt is paid off.
+    """
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate: float, burst: float):
+        """
+        Initialize a full token bucket.
+
+        Args:
+            rate: Tokens added per second
+            burst: Maximum tokens held
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, count: float, now: float) -> float:
+        """
+        Take tokens.
+
+        Args:
+            count: Number of tokens
+            now: Current time.monotonic()
+
+        Returns:
+            Seconds until the bucket is out of debt (0 if enough tokens were available)
+        """
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= count
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def refund(self, count: float):
+        """
+        Return tokens taken for a request that was rejected.
+
+        Args:
+            count: Number of tokens
+        """
+        self.tokens = min(self.burst, self.tokens + count)
+
+
+class _Source:
+    """
+    Token bucket and counters of one source IP or sender fingerprint.
+    """
+
+    __slots__ = ('bucket', 'admitted', 'throttled', 'rejected')
+
+    def __init__(self, rate: float, burst: float):
+        self.bucket = TokenBucket(rate, burst)
+        self.admitted = 0
+        self.throttled = 0
+        self.rejected = 0
+
+
+class AdmissionControl:
+    """
+    Per-source rate limits for received envelopes.
+
+    A source over its rate is not dropped: admit() returns how long its
+    connection has to wait before the frame may be queued, so the sender
+    is slowed down by TCP backpressure. Frames that would have to wait
+    longer than max_delay are rejected instead.
+
+    Sender fingerprints are claimed, not verified, at this point; the IP
+    limit is the one a spoofing sender cannot get around.
+    """
+
+    def __init__(self, ip_rate: float = DEFAULT_IP_RATE, ip_burst: float = DEFAULT_IP_BURST,
+                 sender_rate: float = DEFAULT_SENDER_RATE, sender_burst: float = DEFAULT_SENDER_BURST,
+                 max_delay: float = 10, max_sources: int = DEFAULT_MAX_SOURCES):
+        """
+        Initialize admission control.
+
+        Args:
+            ip_rate: Envelopes per second per source IP, 0 for no limit (default: 5000)
+            ip_burst: Envelopes a source IP may send at once (default: 10000)
+            sender_rate: Envelopes per second per sender fingerprint, 0 for no limit (default: 2000)
+            sender_burst: Envelopes a sender fingerprint may send at once (default: 5000)
+            max_delay: Longest wait in seconds before a frame is rejected (default: 10)
+            max_sources: Sources of each kind tracked at once (default: 10000)
+        """
+        self.ip_rate = ip_rate
+        self.ip_burst = ip_burst
+        self.sender_rate = sender_rate
+        self.sender_burst = sender_burst
+        self.max_delay = max_delay
+        self.max_sources = max_sources
+
+        self.ips = OrderedDict()
+        self.senders = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _source(self, sources: OrderedDict, key, rate: float, burst: float) -> _Source:
+        """
+        Get or create the state of a source (lock held).
+        """
+        source = sources.get(key)
+        if source is None:
+            source = sources[key] = _Source(rate, burst)
+            if len(sources) > self.max_sources:
+                sources.popitem(last=False)
+        else:
+            sources.move_to_end(key)
+        return source
+
+    def admit(self, ip: str, senders: list):
+        """
+        Charge a received frame to its source IP and claimed senders.
+
+        Args:
+            ip: Source IP address
+            senders: Claimed sender fingerprint of each envelope in the frame
+                     (None where unreadable)
+
+        Returns:
+            Seconds to wait before queueing the frame (0 to queue it now),
+            or None if the frame is rejected
+        """
+        charges = []
+        now = time.monotonic()
+
+        with self.lock:
+            if self.ip_rate:
+                charges.append((self._source(self.ips, ip, self.ip_rate, self.ip_burst), len(senders)))
+            if self.sender_rate:
+                for sender, count in Counter(senders).items():
+                    if sender is not None:
+                        source = self._source(self.senders, sender, self.sender_rate, self.sender_burst)
+                        charges.append((source, count))
+
+            delay = 0.0
+            for source, count in charges:
+                delay = max(delay, source.bucket.take(count, now))
+
+            if delay > self.max_delay:
+                for source, count in charges:
+                    source.bucket.refund(count)
+                    source.rejected += count
+                return None
+
+            for source, count in charges:
+                source.admitted += count
+                if delay:
+                    source.throttled += count
+            return delay
+
+    def stats(self) -> dict:
+        """
+        Get per-source counters of envelopes admitted, throttled (admitted
+        after waiting) and rejected.
+
+        Returns:
+            Dictionary with 'ips' and 'senders', each mapping source to
+            {'admitted': n, 'throttled': n, 'rejected': n}
+        """
+        with self.lock:
+            return {
+                name: {key: {'admitted': source.admitted, 'throttled': source.throttled,
+                             'rejected': source.rejected}
+                       for key, source in sources.items()}
+                for name, sources in (('ips', self.ips), ('senders', self.senders))
+            }
+
+
+class FairQueue:
+    """
+    Drop-in replacement for queue.Queue that serves items from different
+    sources in weighted round robin (deficit round robin by item cost), so
+    a source with a long backlog does not delay the others.
+
+    Each source may hold at most max_per_source items; put() blocks on
+    the source's own limit, or when the whole queue is full.
+    """
+
+    # Cost units a source with weight 1 may take per round
+    QUANTUM = 16
+
+    def __init__(self, maxsize: int, key, cost=len, max_per_source: int = None, weights: dict = None):
+        """
+        Initialize fair queue.
+
+        Args:
+            maxsize: Maximum items in the whole queue
+            key: Function mapping an item to its source
+            cost: Function mapping an item to its processing cost (default: len)
+            max_per_source: Maximum items per source (default: a quarter of maxsize)
+            weights: Dictionary mapping source to weight, default weight 1 (optional);
+                     a source gets at least one item per round however small its weight
+
+        Raises:
+            ValueError: If a weight is not positive
+        """
+        for source, weight in (weights or {}).items():
+            if not weight > 0:
+                raise ValueError(f"Weight of source {source} must be positive: {weight}")
+
+        self.maxsize = maxsize
+        self.key = key
+        self.cost = cost
+        self.max_per_source = max_per_source or max(1, maxsize // 4)
+        self.weights = dict(weights or {})
+
+        self.queues = {}
+        self.deficits = {}
+        self.active = deque()
+        self.size = 0
+
+        self.mutex = threading.Lock()
+        self.not_empty = threading.Condition(self.mutex)
+        self.not_full = threading.Condition(self.mutex)
+        self.room_listeners = []
+
+    def add_room_listener(self, callback):
+        """
+        Register a function called with no arguments, in the getting thread,
+        each time an item is removed; lets producers that cannot block a
+        thread (e.g. coroutines) wait for room.
+
+        Args:
+            callback: Function to call
+        """
+        self.room_listeners.append(callback)
+
+    def _has_room(self, source) -> bool:
+        queue = self.queues.get(source)
+        return self.size < self.maxsize and (queue is None or len(queue) < self.max_per_source)
+
+    def put(self, item, block: bool = True, timeout: float = None):
+        """
+        Put item in its source's queue.
+
+        Args:
+            item: Queue item
+            block: Wait for room if full (default: True)
+            timeout: Seconds to wait for room (default: forever)
+
+        Raises:
+            Full: If there is no room
+        """
+        source = self.key(item)
+        with self.not_full:
+            if not self._has_room(source):
+                if not block:
+                    raise Full
+                if not self.not_full.wait_for(lambda: self._has_room(source), timeout):
+                    raise Full
+
+            queue = self.queues.get(source)
+            if queue is None:
+                queue = self.queues[source] = deque()
+                self.deficits[source] = 0
+                self.active.append(source)
+            queue.append(item)
+            self.size += 1
+            self.not_empty.notify()
+
+    def put_nowait(self, item):
+        """
+        Put item without waiting (see put).
+        """
+        self.put(item, block=False)
+
+    def get(self, block: bool = True, timeout: float = None):
+        """
+        Remove and return the next item in weighted round robin order.
+
+        Args:
+            block: Wait for an item if empty (default: True)
+            timeout: Seconds to wait for an item (default: forever)
+
+        Returns:
+            Queue item
+
+        Raises:
+            Empty: If there is no item
+        """
+        with self.not_empty:
+            if not self.size:
+                if not block:
+                    raise Empty
+                if not self.not_empty.wait_for(lambda: self.size, timeout):
+                    raise Empty
+
+            while True:
+                source = self.active[0]
+                queue = self.queues[source]
+                cost = self.cost(queue[0])
+                if self.deficits[source] >= cost:
+                    break
+                # Source used up its share this round, move on; at least one item's
+                # worth, so tiny weights do not spin here holding the lock
+                self.deficits[source] += max(self.QUANTUM * self.weights.get(source, 1), cost)
+                self.active.rotate(-1)
+
+            item = queue.popleft()
+            self.deficits[source] -= cost
+            self.size -= 1
+
+            if not queue:
+                # Idle sources do not save up credit
+                self.active.popleft()
+                del self.queues[source]
+                del self.deficits[source]
+
+            self.not_full.notify_all()
+
+        for callback in self.room_listeners:
+            callback()
+        return item
+
+    def get_nowait(self):
+        """
+        Remove and return an item without waiting (see get).
+        """
+        return self.get(block=False)
+
+    def qsize(self) -> int:
+        """
+        Get the number of queued items.
+        """
+        with self.mutex:
+            return self.size
+
+    def free(self, source) -> int:
+        """
+        Get how many more items a source may put without blocking.
+
+        Args:
+            source: Source key
+
+        Returns:
+            Number of free slots for the source
+        """
+        with self.mutex:
+            queue = self.queues.get(source)
+            return max(0, min(self.maxsize - self.size,
+                              self.max_per_source - (len(queue) if queue else 0)))
@@ -0,0 +1,294 @@
+"""
+asyncio server engine for Enclave.
+Same interface as network.ChatServer, but every connection is a coroutine
+on one event loop thread instead of a pool thread, so thousands of mostly
+idle persistent connections cost a few kilobytes each rather than a
+thread each. Verification and decryption still run in the message worker
+threads (or crypto processes), fed through the same message queue.
+"""
+
+import os
+import socket
+import asyncio
+import threading
+from queue import Full
+from collections import deque
+from . import framing, message, metrics, network, transfer
+
+
+class AsyncChatServer(network.ChatServer):
+    """
+    P2P chat server built on asyncio streams.
+    Accepts the same arguments as network.ChatServer; max_workers only
+    bounds concurrent file transfers, which run in the thread pool.
+    """
+
+    # Shown in the startup message
+    ENGINE_NAME = "asyncio"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.loop = None
+        self.loop_thread = None
+        self.asyncio_server = None
+
+        # Open stream writers (closed on stop), only touched from the loop thread
+        self.writers = set()
+
+        # Futures of connections waiting for room in the message queue, oldest
+        # first; woken one per removed item, only touched from the loop thread
+        self.queue_waiters = deque()
+        self.message_queue.add_room_listener(self._queue_room)
+
+    def start(self):
+        """
+        Start the chat server and begin accepting connections.
+        """
+        self._bind()
+        self.server_socket.setblocking(False)
+
+        self.loop = asyncio.new_event_loop()
+        try:
+            self.asyncio_server = self.loop.run_until_complete(
+                asyncio.start_server(self._handle_stream, sock=self.server_socket)
+            )
+        except Exception:
+            self.loop.close()
+            raise
+
+        self._start_processing()
+
+        self.loop_thread = threading.Thread(target=self.loop.run_forever, daemon=True, name="AsyncChatServer")
+        self.loop_thread.start()
+
+    async def _handle_stream(self, reader, writer):
+        """
+        Handle a persistent connection from a peer.
+        Reads length-prefixed frames until the peer disconnects or the
+        connection stays idle longer than idle_timeout.
+
+        Args:
+            reader: asyncio StreamReader
+            writer: asyncio StreamWriter
+        """
+        addr = writer.get_extra_info('peername')
+        self.writers.add(writer)
+        metrics.increment('server.connections')
+
+        # Acks are written by worker threads through the event loop
+        state = network._ConnectionState(lambda frame: self._write_threadsafe(writer, frame), addr[0])
+
+        try:
+            # Enable TCP_NODELAY for lower latency
+            writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            while self.running:
+                # Read 4-byte length prefix, idle deadline between messages
+                try:
+                    length_data = await asyncio.wait_for(reader.readexactly(framing.HEADER.size), self.idle_timeout)
+                except asyncio.TimeoutError:
+                    # Connection idle for too long
+                    break
+
+                message_length = framing.HEADER.unpack(length_data)[0]
+                if not self._check_frame_size(message_length, addr):
+                    break
+
+                # A peer that announces a frame and stops sending is dropped like an idle one
+                start = metrics.clock()
+                try:
+                    message_data = await asyncio.wait_for(reader.readexactly(message_length), self.idle_timeout)
+                except asyncio.TimeoutError:
+                    break
+                if not message_data:
+                    break
+                metrics.since('server.recv', start)
+
+                # Answer version negotiation on the same connection
+                if message_data[0] == message.FRAME_HELLO:
+                    state.acks = self._accepts_acks(message_data)
+                    hello = message.pack_hello()
+                    writer.writelines((framing.HEADER.pack(len(hello)), hello))
+                    await writer.drain()
+                    continue
+
+                # File transfers take over the connection until they finish
+                if message_data[0] == transfer.FRAME_FILE_MANIFEST:
+                    await self._receive_file_stream(writer, message_data)
+                    break
+
+                item = self._queue_item(message_data, addr, state)
+
+                # Sources over their rate limit wait without blocking others
+                delay = self._admission_delay(item)
+                if delay:
+                    await asyncio.sleep(delay)
+
+                await self._enqueue_frame_async(item)
+
+        except (asyncio.IncompleteReadError, ConnectionError):
+            # Peer disconnected
+            pass
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if self.running:
+                print(f"Error handling connection: {e}")
+
+        finally:
+            self.writers.discard(writer)
+            writer.close()
+
+    async def _enqueue_frame_async(self, item):
+        """
+        Queue a frame for processing. While the queue is full this
+        connection stops reading, so TCP backpressure slows its sender
+        down, and other connections keep being served.
+
+        Args:
+            item: Message queue item from _queue_item
+
+        Raises:
+            ConnectionError: If the queue stayed full for idle_timeout
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.idle_timeout
+
+        while self.running:
+            try:
+                self.message_queue.put_nowait(item)
+                return
+            except Full:
+                pass
+
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                metrics.increment('server.dropped.queue_full', len(item[0]))
+                raise ConnectionError(f"Message queue full for {self.idle_timeout}s")
+
+            # Sleep until a worker takes an item; a wakeup that finds no room
+            # for this source goes to the back of the line
+            waiter = loop.create_future()
+            self.queue_waiters.append(waiter)
+            try:
+                await asyncio.wait_for(waiter, remaining)
+            except asyncio.TimeoutError:
+                pass
+
+    def _queue_room(self):
+        """
+        Wake the connection waiting longest for room in the message queue
+        (called by worker threads after each get).
+        """
+        if self.queue_waiters:
+            try:
+                self.loop.call_soon_threadsafe(self._wake_queue_waiter)
+            except RuntimeError:
+                # Event loop already closed on shutdown
+                pass
+
+    def _wake_queue_waiter(self):
+        """
+        Resolve the oldest waiter still waiting (loop thread only).
+        """
+        while self.queue_waiters:
+            waiter = self.queue_waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+
+    def _write_threadsafe(self, writer, frame: bytes):
+        """
+        Write a frame to a stream from any thread.
+
+        Args:
+            writer: asyncio StreamWriter of the connection
+            frame: Frame bytes
+        """
+        def write():
+            if not writer.is_closing():
+                writer.writelines((framing.HEADER.pack(len(frame)), frame))
+
+        try:
+            self.loop.call_soon_threadsafe(write)
+        except RuntimeError:
+            # Event loop already closed on shutdown
+            pass
+
+    async def _receive_file_stream(self, writer, manifest_frame):
+        """
+        Hand the connection over to the blocking file receiver in the thread pool.
+
+        The sender waits for the first ack after the manifest, so nothing is
+        buffered in the stream yet; the receiver gets its own blocking
+        duplicate of the socket while the event loop stops reading from it.
+
+        Args:
+            writer: asyncio StreamWriter of the connection
+            manifest_frame: Manifest frame that started the transfer
+        """
+        writer.transport.pause_reading()
+
+        sock = writer.get_extra_info('socket')
+        conn = socket.socket(sock.family, sock.type, sock.proto, fileno=os.dup(sock.fileno()))
+        conn.settimeout(self.idle_timeout)
+
+        with self.connections_lock:
+            self.connections.add(conn)
+
+        def receive():
+            try:
+                self._receive_file(conn, manifest_frame)
+            finally:
+                with self.connections_lock:
+                    self.connections.discard(conn)
+                conn.close()
+
+        await asyncio.get_running_loop().run_in_executor(self.executor, receive)
+
+    async def _shutdown(self):
+        """
+        Stop accepting and close all connections, letting their handlers exit.
+        """
+        self.asyncio_server.close()
+
+        # Closing a transport ends pending reads with IncompleteReadError
+        for writer in list(self.writers):
+            writer.close()
+
+        # Connections waiting for queue room see running is False and exit
+        while self.queue_waiters:
+            waiter = self.queue_waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        if tasks:
+            _, pending = await asyncio.wait(tasks, timeout=5)
+            for task in pending:
+                task.cancel()
+
+    def stop(self):
+        """
+        Stop the chat server.
+        """
+        self.running = False
+
+        # Wake up file transfers blocked on their sockets
+        with self.connections_lock:
+            for conn in list(self.connections):
+                try:
+                    conn.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+        if self.loop and self.loop.is_running():
+            asyncio.run_coroutine_threadsafe(self._shutdown(), self.loop).result(timeout=10)
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.loop_thread.join()
+            self.loop.close()
+
+        # Wait for file transfers handed to the thread pool
+        self.executor.shutdown(wait=True, cancel_futures=False)
+
+        self._stop_processing()
@@ -0,0 +1,364 @@
+"""
+Benchmark suite for Enclave hot paths.
+Measures crypto, message and keystore operations at several payload sizes,
+reports ops/s and latency percentiles as JSON and flags regressions against
+a stored baseline.
+
+Usage:
+    python -m enclave.benchmark --output results.json
+    python -m enclave.benchmark --baseline results.json --threshold 0.1
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import shutil
+import argparse
+import platform
+import tempfile
+import contextlib
+import cryptography
+from . import __version__, crypto, keystore, message, replay, session
+
+
+DEFAULT_SIZES = [16, 1024, 10000]
+DEFAULT_KEY_TYPES = [crypto.KEY_TYPE_RSA, crypto.KEY_TYPE_ED25519]
+BENCHMARK_PASSWORD = "benchmark"
+
+
+def measure(operation, iterations: int, warmup: int = 5) -> dict:
+    """
+    Time an operation and compute throughput and latency percentiles.
+
+    Args:
+        operation: Zero-argument callable to benchmark
+        iterations: Number of timed calls
+        warmup: Number of untimed calls before measuring
+
+    Returns:
+        Dictionary with iterations, ops_per_sec and mean/p50/p90/p99/max latency in microseconds
+    """
+    for _ in range(warmup):
+        operation()
+
+    timings = []
+    clock = time.perf_counter_ns
+    for _ in range(iterations):
+        start = clock()
+        operation()
+        timings.append(clock() - start)
+
+    timings.sort()
+    total = sum(timings)
+
+    def percentile(p):
+        return timings[min(len(timings) - 1, int(len(timings) * p))] / 1000
+
+    return {
+        'iterations': iterations,
+        'ops_per_sec': iterations / (total / 1e9) if total else float('inf'),
+        'mean_us': total / iterations / 1000,
+        'p50_us': percentile(0.50),
+        'p90_us': percentile(0.90),
+        'p99_us': percentile(0.99),
+        'max_us': timings[-1] / 1000
+    }
+
+
+@contextlib.contextmanager
+def temporary_keystore():
+    """
+    Run inside a throwaway working directory so the keystore's relative
+    paths point at an empty keys/ directory.
+    """
+    previous_dir = os.getcwd()
+    work_dir = tempfile.mkdtemp(prefix="enclave-bench-")
+    os.chdir(work_dir)
+    try:
+        yield work_dir
+    finally:
+        os.chdir(previous_dir)
+        shutil.rmtree(work_dir, ignore_errors=True)
+        keystore.clear_peer_key_cache()
+
+
+def _make_identity(key_type: str):
+    """
+    Generate an identity and store its public key as a peer.
+
+    Returns:
+        Tuple of (private_key, public_key, fingerprint, private_key_bytes)
+    """
+    private_key_bytes, public_key_bytes, fingerprint = crypto.generate_key_pair(BENCHMARK_PASSWORD, key_type)
+    keystore.PEERS_DIR.mkdir(parents=True, exist_ok=True)
+    (keystore.PEERS_DIR / f"{fingerprint}.pem").write_bytes(public_key_bytes)
+
+    private_key = crypto.load_private_key(private_key_bytes, BENCHMARK_PASSWORD)
+    return private_key, private_key.public_key(), fingerprint, private_key_bytes
+
+
+def run_benchmarks(iterations: int = 200, sizes=None, key_types=None, name_filter: str = None) -> dict:
+    """
+    Run the benchmark suite.
+
+    Args:
+        iterations: Timed iterations per benchmark (RSA private-key operations use a tenth)
+        sizes: Plaintext sizes in characters (default: 16, 1024, 10000)
+        key_types: Identity key types to benchmark (default: rsa and ed25519)
+        name_filter: Only run benchmarks whose name contains this string
+
+    Returns:
+        Dictionary mapping benchmark name to measure() results
+    """
+    sizes = sizes or DEFAULT_SIZES
+    key_types = key_types or DEFAULT_KEY_TYPES
+    results = {}
+
+    def bench(name, operation, count=iterations):
+        if name_filter and name_filter not in name:
+            return
+        print(f"  {name} ...", file=sys.stderr, flush=True)
+        results[name] = measure(operation, max(count, 1))
+
+    with temporary_keystore():
+        for key_type in key_types:
+            private_key, public_key, fingerprint, private_key_bytes = _make_identity(key_type)
+
+            # RSA private-key operations take milliseconds, keep runs short
+            slow = iterations // 10 if key_type == crypto.KEY_TYPE_RSA else iterations
+
+            for size in sizes:
+                plaintext = "x" * size
+                data = plaintext.encode('utf-8')
+                prefix = f"{key_type}/{size}"
+
+                encrypted = crypto.encrypt_message(plaintext, public_key)
+                signature = crypto.sign_message(data, private_key)
+
+                bench(f"crypto.encrypt_message/{prefix}", lambda: crypto.encrypt_message(plaintext, public_key))
+                bench(f"crypto.decrypt_message/{prefix}", lambda: crypto.decrypt_message(encrypted, private_key), slow)
+                bench(f"crypto.sign_message/{prefix}", lambda: crypto.sign_message(data, private_key), slow)
+                bench(f"crypto.verify_signature/{prefix}", lambda: crypto.verify_signature(data, signature, public_key))
+
+                bench(f"message.create_message/{prefix}",
+                      lambda: message.create_message(plaintext, public_key, private_key, fingerprint), slow)
+
+                envelope_bytes = message.create_message(plaintext, public_key, private_key, fingerprint)
+                bench(f"message.parse_verify_decrypt/{prefix}",
+                      lambda: message.verify_and_decrypt(message.parse_message(envelope_bytes),
+                                                         public_key, private_key, fingerprint), slow)
+
+                bench(f"message.create_session_message/{prefix}",
+                      lambda: message.create_session_message(plaintext, fingerprint, public_key,
+                                                             private_key, fingerprint))
+
+                session_bytes = message.create_session_message(plaintext, fingerprint, public_key,
+                                                               private_key, fingerprint)
+                bench(f"message.parse_verify_decrypt_session/{prefix}",
+                      lambda: message.verify_and_decrypt(message.parse_message(session_bytes),
+                                                         public_key, private_key, fingerprint))
+
+                # Version 2 envelopes (binary header, signature over raw bytes)
+                v2_bytes = message.create_message(plaintext, public_key, private_key, fingerprint, 2)
+                bench(f"message.parse_verify_decrypt/v2/{prefix}",
+                      lambda: message.verify_and_decrypt(message.parse_message(v2_bytes),
+                                                         public_key, private_key, fingerprint), slow)
+
+                bench(f"message.create_session_message/v2/{prefix}",
+                      lambda: message.create_session_message(plaintext, fingerprint, public_key,
+                                                             private_key, fingerprint, 2))
+
+                v2_session_bytes = message.create_session_message(plaintext, fingerprint, public_key,
+                                                                  private_key, fingerprint, 2)
+                bench(f"message.parse_verify_decrypt_session/v2/{prefix}",
+                      lambda: message.verify_and_decrypt(message.parse_message(v2_session_bytes),
+                                                         public_key, private_key, fingerprint))
+
+            # Keystore loading
+            bench(f"keystore.load_peer_key/cold/{key_type}",
+                  lambda: (keystore.clear_peer_key_cache(), keystore.load_peer_key(fingerprint)))
+            bench(f"keystore.load_peer_key/cached/{key_type}", lambda: keystore.load_peer_key(fingerprint))
+            bench(f"crypto.load_private_key/{key_type}",
+                  lambda: crypto.load_private_key(private_key_bytes, BENCHMARK_PASSWORD), max(slow // 10, 5))
+
+            session.clear_sessions()
+
+        # Replay protection
+        bench("message.check_duplicate/new", lambda: message.check_duplicate(str(uuid.uuid4())), iterations * 10)
+        seen_id = str(uuid.uuid4())
+        message.check_duplicate(seen_id)
+        bench("message.check_duplicate/seen", lambda: message.check_duplicate(seen_id), iterations * 10)
+
+    return results
+
+
+def run_replay_benchmarks(entries: int = 1000000, shards: int = replay.DEFAULT_SHARDS,
+                          name_filter: str = None) -> dict:
+    """
+    Benchmark the replay cache filled with a full window of message IDs.
+
+    Args:
+        entries: Number of distinct message IDs spread over one window
+        shards: Number of replay cache shards
+        name_filter: Only run benchmarks whose name contains this string
+
+    Returns:
+        Dictionary mapping benchmark name to measure() results
+    """
+    names = {
+        'new': f"replay.check_and_add/new/{entries}",
+        'seen': f"replay.check_and_add/seen/{entries}",
+        'snapshot': f"replay.snapshot/{entries}",
+        'load': f"replay.load/{entries}"
+    }
+    selected = {key for key, name in names.items() if not name_filter or name_filter in name}
+
+    results = {}
+    if not selected:
+        # Filling the cache is the expensive part, skip it entirely
+        return results
+
+    cache = replay.ReplayCache(shards=shards)
+    now = time.time()
+    step = (cache.window - cache.bucket_seconds) / entries
+
+    print(f"  replay cache with {entries} entries ...", file=sys.stderr, flush=True)
+
+    ids = [uuid.uuid4().bytes for _ in range(entries)]
+    timestamps = [now - i * step for i in range(entries)]
+
+    counter = iter(range(entries))
+
+    def insert():
+        i = next(counter)
+        cache.check_and_add(ids[i], timestamps[i])
+
+    # Lookups and snapshots need the filled cache, so the inserts always run
+    inserted = measure(insert, entries, warmup=0)
+    if 'new' in selected:
+        results[names['new']] = inserted
+
+    probe = iter(range(entries))
+
+    def lookup():
+        i = next(probe)
+        cache.check_and_add(ids[i], timestamps[i])
+
+    if 'seen' in selected:
+        results[names['seen']] = measure(lookup, entries, warmup=0)
+
+    if not selected & {'snapshot', 'load'}:
+        return results
+
+    # Snapshot size shows the on-disk cost per remembered ID
+    with tempfile.TemporaryDirectory() as snapshot_dir:
+        snapshot_path = os.path.join(snapshot_dir, "replay.bin")
+        start = time.perf_counter()
+        cache.snapshot(snapshot_path)
+        snapshot_seconds = time.perf_counter() - start
+
+        if 'snapshot' in selected:
+            results[names['snapshot']] = {
+                'entries': len(cache),
+                'seconds': snapshot_seconds,
+                'bytes': os.path.getsize(snapshot_path)
+            }
+
+        if 'load' in selected:
+            start = time.perf_counter()
+            loaded = replay.ReplayCache(shards=shards, snapshot_path=snapshot_path)
+            results[names['load']] = {
+                'entries': len(loaded),
+                'seconds': time.perf_counter() - start
+            }
+
+    return results
+
+
+def compare(results: dict, baseline: dict, threshold: float = 0.1) -> list:
+    """
+    Compare results against a baseline run.
+
+    Args:
+        results: Current benchmark results
+        baseline: Baseline benchmark results
+        threshold: Allowed fractional throughput drop before flagging (default: 0.1)
+
+    Returns:
+        List of (name, baseline_ops, current_ops, change) tuples for regressions
+    """
+    regressions = []
+
+    for name, current in results.items():
+        previous = baseline.get(name)
+        if previous is None or 'ops_per_sec' not in current:
+            continue
+
+        change = current['ops_per_sec'] / previous['ops_per_sec'] - 1
+        if change < -threshold:
+            regressions.append((name, previous['ops_per_sec'], current['ops_per_sec'], change))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Enclave hot-path benchmarks")
+
+    parser.add_argument('--iterations', type=int, default=200,
+                        help='Timed iterations per benchmark (default: 200)')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help='Plaintext sizes in characters (default: 16 1024 10000)')
+    parser.add_argument('--key-types', nargs='+', choices=crypto.KEY_TYPES, default=DEFAULT_KEY_TYPES,
+                        help='Identity key types (default: rsa ed25519)')
+    parser.add_argument('--filter', type=str, default=None,
+                        help='Only run benchmarks whose name contains this string')
+    parser.add_argument('--replay-entries', type=int, default=1000000,
+                        help='Message IDs per window for replay cache benchmarks, 0 to skip (default: 1000000)')
+    parser.add_argument('--output', type=str, default=None,
+                        help='Write JSON results to this file (default: stdout)')
+    parser.add_argument('--baseline', type=str, default=None,
+                        help='Compare against JSON results from a previous run')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Allowed throughput drop vs baseline, as a fraction (default: 0.1)')
+
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.iterations, args.sizes, args.key_types, args.filter)
+    if args.replay_entries:
+        results.update(run_replay_benchmarks(args.replay_entries, name_filter=args.filter))
+
+    report = {
+        'meta': {
+            'enclave': __version__,
+            'python': platform.python_version(),
+            'cryptography': cryptography.__version__,
+            'platform': platform.platform(),
+            'timestamp': time.time()
+        },
+        'results': results
+    }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+
+        regressions = compare(results, baseline, args.threshold)
+        for name, previous, current, change in regressions:
+            print(f"REGRESSION {name}: {previous:.1f} -> {current:.1f} ops/s ({change:+.1%})", file=sys.stderr)
+
+        if regressions:
+            sys.exit(1)
+        print("No regressions against baseline", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
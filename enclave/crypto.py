@@ -1,48 +1,117 @@
 """
 Cryptographic operations module for Enclave.
-Handles RSA-4096 key generation, AES-256-GCM encryption, and digital signatures.
+Handles RSA-4096 and Ed25519/X25519 key generation, AES-256-GCM encryption,
+and digital signatures.
 """
 
 import os
+import re
 import hashlib
-from cryptography.hazmat.primitives.asymmetric import rsa, padding
+from cryptography.hazmat.primitives.asymmetric import rsa, padding, ed25519, x25519
 from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.backends import default_backend
 
 
-def generate_key_pair(password: str) -> tuple:
+# Supported identity key types
+KEY_TYPE_RSA = 'rsa'
+KEY_TYPE_ED25519 = 'ed25519'
+KEY_TYPES = (KEY_TYPE_RSA, KEY_TYPE_ED25519)
+
+# HKDF context string for X25519 key wrapping
+_X25519_WRAP_INFO = b"enclave x25519 key wrap"
+
+_PEM_BLOCK_RE = re.compile(rb"-----BEGIN [A-Z ]+-----.+?-----END [A-Z ]+-----\s*", re.DOTALL)
+
+
+class EdPrivateKey:
+    """
+    Ed25519/X25519 identity private key.
+    Ed25519 is used for signatures and X25519 for key wrapping.
+    """
+
+    key_type = KEY_TYPE_ED25519
+
+    def __init__(self, signing_key, exchange_key):
+        """
+        Args:
+            signing_key: Ed25519 private key
+            exchange_key: X25519 private key
+        """
+        self.signing_key = signing_key
+        self.exchange_key = exchange_key
+
+    def public_key(self):
+        """
+        Returns:
+            Matching EdPublicKey
+        """
+        return EdPublicKey(self.signing_key.public_key(), self.exchange_key.public_key())
+
+
+class EdPublicKey:
+    """
+    Ed25519/X25519 identity public key.
+    """
+
+    key_type = KEY_TYPE_ED25519
+
+    def __init__(self, verify_key, exchange_key):
+        """
+        Args:
+            verify_key: Ed25519 public key
+            exchange_key: X25519 public key
+        """
+        self.verify_key = verify_key
+        self.exchange_key = exchange_key
+
+
+def get_key_type(key) -> str:
+    """
+    Get identity key type of a loaded public or private key.
+
+    Args:
+        key: RSA key or EdPrivateKey/EdPublicKey
+
+    Returns:
+        'rsa' or 'ed25519'
+    """
+    return getattr(key, 'key_type', KEY_TYPE_RSA)
+
+
+def generate_key_pair(password: str, key_type: str = KEY_TYPE_RSA) -> tuple:
     """
-    Generate RSA-4096 key pair with password protection.
+    Generate identity key pair with password protection.
 
     Args:
         password: Password to encrypt private key
+        key_type: 'rsa' for RSA-4096 or 'ed25519' for Ed25519/X25519 (default: 'rsa')
 
     Returns:
         Tuple of (private_key_bytes, public_key_bytes, fingerprint)
     """
-    # Generate RSA-4096 key pair
-    private_key = rsa.generate_private_key(
-        public_exponent=65537,
-        key_size=4096,
-        backend=default_backend()
-    )
-
-    # Get public key
-    public_key = private_key.public_key()
+    if key_type == KEY_TYPE_ED25519:
+        # Ed25519 signing key and X25519 key-agreement key
+        private_key = EdPrivateKey(
+            ed25519.Ed25519PrivateKey.generate(),
+            x25519.X25519PrivateKey.generate()
+        )
+    elif key_type == KEY_TYPE_RSA:
+        # Generate RSA-4096 key pair
+        private_key = rsa.generate_private_key(
+            public_exponent=65537,
+            key_size=4096,
+            backend=default_backend()
+        )
+    else:
+        raise ValueError(f"Unsupported key type: {key_type}")
 
     # Serialize private key with password encryption
-    private_key_bytes = private_key.private_bytes(
-        encoding=serialization.Encoding.PEM,
-        format=serialization.PrivateFormat.PKCS8,
-        encryption_algorithm=serialization.BestAvailableEncryption(password.encode('utf-8'))
-    )
+    private_key_bytes = serialize_private_key(private_key, password)
 
     # Serialize public key (unencrypted)
-    public_key_bytes = public_key.public_bytes(
-        encoding=serialization.Encoding.PEM,
-        format=serialization.PublicFormat.SubjectPublicKeyInfo
-    )
+    public_key_bytes = serialize_public_key(private_key.public_key())
 
     # Generate fingerprint (SHA-256 of public key)
     fingerprint = hashlib.sha256(public_key_bytes).hexdigest()
@@ -50,27 +119,113 @@ def generate_key_pair(password: str) -> tuple:
     return (private_key_bytes, public_key_bytes, fingerprint)
 
 
+def serialize_private_key(private_key, password: str = None) -> bytes:
+    """
+    Serialize private key to PKCS8 PEM format.
+    Ed25519 identities are stored as two PEM blocks (Ed25519, then X25519).
+
+    Args:
+        private_key: RSA private key or EdPrivateKey
+        password: Password to encrypt private key (None for no encryption)
+
+    Returns:
+        PEM-encoded private key bytes
+    """
+    if password is None:
+        encryption = serialization.NoEncryption()
+    else:
+        encryption = serialization.BestAvailableEncryption(password.encode('utf-8'))
+
+    if get_key_type(private_key) == KEY_TYPE_ED25519:
+        keys = [private_key.signing_key, private_key.exchange_key]
+    else:
+        keys = [private_key]
+
+    return b''.join(
+        key.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=encryption
+        )
+        for key in keys
+    )
+
+
+def serialize_public_key(public_key) -> bytes:
+    """
+    Serialize public key to SubjectPublicKeyInfo PEM format.
+    Ed25519 identities are stored as two PEM blocks (Ed25519, then X25519).
+
+    Args:
+        public_key: RSA public key or EdPublicKey
+
+    Returns:
+        PEM-encoded public key bytes
+    """
+    if get_key_type(public_key) == KEY_TYPE_ED25519:
+        keys = [public_key.verify_key, public_key.exchange_key]
+    else:
+        keys = [public_key]
+
+    return b''.join(
+        key.public_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo
+        )
+        for key in keys
+    )
+
+
+def _combine_keys(keys: list, ed_class):
+    """
+    Build identity key object from the keys found in a PEM file.
+
+    Args:
+        keys: Loaded key objects in file order
+        ed_class: EdPrivateKey or EdPublicKey
+
+    Returns:
+        RSA key or Ed identity key object
+
+    Raises:
+        ValueError: If the combination of keys is not a supported identity
+    """
+    if len(keys) == 1 and isinstance(keys[0], (rsa.RSAPrivateKey, rsa.RSAPublicKey)):
+        return keys[0]
+
+    if len(keys) == 2:
+        signing, exchange = keys
+        if (isinstance(signing, (ed25519.Ed25519PrivateKey, ed25519.Ed25519PublicKey)) and
+                isinstance(exchange, (x25519.X25519PrivateKey, x25519.X25519PublicKey))):
+            return ed_class(signing, exchange)
+
+    raise ValueError("Unsupported key format")
+
+
 def load_private_key(key_data: bytes, password: str):
     """
     Load encrypted private key from PEM format.
 
     Args:
         key_data: PEM-encoded encrypted private key
-        password: Password to decrypt private key
+        password: Password to decrypt private key (None if not encrypted)
 
     Returns:
-        RSA private key object
+        RSA private key or EdPrivateKey object
 
     Raises:
         ValueError: If password is incorrect
     """
     try:
-        private_key = serialization.load_pem_private_key(
-            key_data,
-            password=password.encode('utf-8'),
-            backend=default_backend()
-        )
-        return private_key
+        keys = [
+            serialization.load_pem_private_key(
+                block,
+                password=password.encode('utf-8') if password is not None else None,
+                backend=default_backend()
+            )
+            for block in _PEM_BLOCK_RE.findall(key_data)
+        ]
+        return _combine_keys(keys, EdPrivateKey)
     except Exception:
         raise ValueError("Invalid password")
 
@@ -83,22 +238,22 @@ def load_public_key(key_data: bytes):
         key_data: PEM-encoded public key
 
     Returns:
-        RSA public key object
+        RSA public key or EdPublicKey object
     """
-    public_key = serialization.load_pem_public_key(
-        key_data,
-        backend=default_backend()
-    )
-    return public_key
+    keys = [
+        serialization.load_pem_public_key(block, backend=default_backend())
+        for block in _PEM_BLOCK_RE.findall(key_data)
+    ]
+    return _combine_keys(keys, EdPublicKey)
 
 
 def encrypt_message(plaintext: str, recipient_public_key) -> dict:
     """
-    Encrypt message using hybrid encryption (AES-256-GCM + RSA-OAEP).
+    Encrypt message using hybrid encryption (AES-256-GCM + RSA-OAEP or X25519).
 
     Args:
         plaintext: Message to encrypt
-        recipient_public_key: Recipient's RSA public key
+        recipient_public_key: Recipient's public key
 
     Returns:
         Dictionary with encrypted_key, ciphertext, nonce, and tag
@@ -118,15 +273,8 @@ def encrypt_message(plaintext: str, recipient_public_key) -> dict:
     tag = ciphertext[-16:]
     ciphertext_only = ciphertext[:-16]
 
-    # Encrypt AES key with RSA-OAEP
-    encrypted_key = recipient_public_key.encrypt(
-        aes_key,
-        padding.OAEP(
-            mgf=padding.MGF1(algorithm=hashes.SHA256()),
-            algorithm=hashes.SHA256(),
-            label=None
-        )
-    )
+    # Wrap AES key for recipient
+    encrypted_key = wrap_key(aes_key, recipient_public_key)
 
     return {
         'encrypted_key': encrypted_key,
@@ -142,7 +290,7 @@ def decrypt_message(envelope: dict, private_key) -> str:
 
     Args:
         envelope: Dictionary with encrypted_key, ciphertext, nonce, and tag
-        private_key: User's RSA private key
+        private_key: User's private key
 
     Returns:
         Decrypted plaintext string
@@ -150,44 +298,30 @@ def decrypt_message(envelope: dict, private_key) -> str:
     Raises:
         ValueError: If decryption or integrity check fails
     """
+    # Unwrap AES key
     try:
-        # Decrypt AES key with RSA-OAEP
-        aes_key = private_key.decrypt(
-            envelope['encrypted_key'],
-            padding.OAEP(
-                mgf=padding.MGF1(algorithm=hashes.SHA256()),
-                algorithm=hashes.SHA256(),
-                label=None
-            )
-        )
+        aes_key = unwrap_key(envelope['encrypted_key'], private_key)
+    except ValueError:
+        raise ValueError("Decryption failed")
 
-        # Reconstruct full ciphertext with tag
-        full_ciphertext = envelope['ciphertext'] + envelope['tag']
-
-        # Decrypt with AES-256-GCM (automatically verifies tag)
-        aesgcm = AESGCM(aes_key)
-        plaintext_bytes = aesgcm.decrypt(envelope['nonce'], full_ciphertext, None)
-
-        return plaintext_bytes.decode('utf-8')
-
-    except Exception as e:
-        if 'authentication' in str(e).lower() or 'tag' in str(e).lower():
-            raise ValueError("Message integrity check failed")
-        else:
-            raise ValueError("Decryption failed")
+    # Decrypt with AES-256-GCM (automatically verifies tag)
+    return decrypt_with_key(envelope, aes_key)
 
 
 def sign_message(data: bytes, private_key) -> bytes:
     """
-    Sign data using RSA-PSS with SHA-256.
+    Sign data using RSA-PSS with SHA-256, or Ed25519.
 
     Args:
         data: Data to sign
-        private_key: RSA private key
+        private_key: RSA private key or EdPrivateKey
 
     Returns:
         Signature bytes
     """
+    if get_key_type(private_key) == KEY_TYPE_ED25519:
+        return private_key.signing_key.sign(data)
+
     signature = private_key.sign(
         data,
         padding.PSS(
@@ -201,17 +335,21 @@ def sign_message(data: bytes, private_key) -> bytes:
 
 def verify_signature(data: bytes, signature: bytes, public_key) -> bool:
     """
-    Verify RSA-PSS signature with SHA-256.
+    Verify RSA-PSS signature with SHA-256, or Ed25519 signature.
 
     Args:
         data: Original data
         signature: Signature to verify
-        public_key: Signer's RSA public key
+        public_key: Signer's RSA public key or EdPublicKey
 
     Returns:
         True if valid, False if invalid
     """
     try:
+        if get_key_type(public_key) == KEY_TYPE_ED25519:
+            public_key.verify_key.verify(signature, data)
+            return True
+
         public_key.verify(
             signature,
             data,
@@ -224,3 +362,144 @@ def verify_signature(data: bytes, signature: bytes, public_key) -> bool:
         return True
     except Exception:
         return False
+
+
+def wrap_key(key: bytes, recipient_public_key) -> bytes:
+    """
+    Encrypt a symmetric key for a recipient.
+    RSA keys use RSA-OAEP. Ed25519 identities use an ephemeral X25519
+    exchange, HKDF and AES-256-GCM; the result is the 32-byte ephemeral
+    public key followed by the encrypted key and tag.
+
+    Args:
+        key: Symmetric key bytes
+        recipient_public_key: Recipient's RSA public key or EdPublicKey
+
+    Returns:
+        Encrypted key bytes
+    """
+    if get_key_type(recipient_public_key) == KEY_TYPE_ED25519:
+        ephemeral_key = x25519.X25519PrivateKey.generate()
+        ephemeral_public = ephemeral_key.public_key().public_bytes(
+            encoding=serialization.Encoding.Raw,
+            format=serialization.PublicFormat.Raw
+        )
+        shared_secret = ephemeral_key.exchange(recipient_public_key.exchange_key)
+        wrapping_key = derive_key(shared_secret, ephemeral_public, _X25519_WRAP_INFO)
+
+        # Wrapping key is single-use, so a fixed nonce is safe
+        return ephemeral_public + AESGCM(wrapping_key).encrypt(b'\x00' * 12, key, None)
+
+    return recipient_public_key.encrypt(
+        key,
+        padding.OAEP(
+            mgf=padding.MGF1(algorithm=hashes.SHA256()),
+            algorithm=hashes.SHA256(),
+            label=None
+        )
+    )
+
+
+def unwrap_key(encrypted_key: bytes, private_key) -> bytes:
+    """
+    Decrypt a symmetric key encrypted with wrap_key.
+
+    Args:
+        encrypted_key: Encrypted key bytes
+        private_key: User's RSA private key or EdPrivateKey
+
+    Returns:
+        Symmetric key bytes
+
+    Raises:
+        ValueError: If decryption fails
+    """
+    try:
+        if get_key_type(private_key) == KEY_TYPE_ED25519:
+            ephemeral_public = bytes(encrypted_key[:32])
+            shared_secret = private_key.exchange_key.exchange(
+                x25519.X25519PublicKey.from_public_bytes(ephemeral_public)
+            )
+            wrapping_key = derive_key(shared_secret, ephemeral_public, _X25519_WRAP_INFO)
+            return AESGCM(wrapping_key).decrypt(b'\x00' * 12, bytes(encrypted_key[32:]), None)
+
+        return private_key.decrypt(
+            encrypted_key,
+            padding.OAEP(
+                mgf=padding.MGF1(algorithm=hashes.SHA256()),
+                algorithm=hashes.SHA256(),
+                label=None
+            )
+        )
+    except Exception:
+        raise ValueError("Key decryption failed")
+
+
+def derive_key(secret: bytes, salt: bytes, info: bytes) -> bytes:
+    """
+    Derive a 256-bit key from a shared secret using HKDF-SHA256.
+
+    Args:
+        secret: Input keying material
+        salt: HKDF salt
+        info: Context string binding the key to its purpose
+
+    Returns:
+        32-byte derived key
+    """
+    hkdf = HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=salt,
+        info=info,
+        backend=default_backend()
+    )
+    return hkdf.derive(secret)
+
+
+def encrypt_with_key(plaintext: str, key: bytes, associated_data: bytes = None) -> dict:
+    """
+    Encrypt message with an existing AES-256-GCM key.
+
+    Args:
+        plaintext: Message to encrypt
+        key: 32-byte AES key
+        associated_data: Extra data authenticated but not encrypted
+
+    Returns:
+        Dictionary with ciphertext, nonce, and tag
+    """
+    nonce = os.urandom(12)
+    ciphertext = AESGCM(key).encrypt(nonce, plaintext.encode('utf-8'), associated_data)
+
+    return {
+        'ciphertext': ciphertext[:-16],
+        'nonce': nonce,
+        'tag': ciphertext[-16:]
+    }
+
+
+def decrypt_with_key(envelope: dict, key: bytes, associated_data: bytes = None) -> str:
+    """
+    Decrypt message with an existing AES-256-GCM key.
+
+    Args:
+        envelope: Dictionary with ciphertext, nonce, and tag
+        key: 32-byte AES key
+        associated_data: Extra data that was authenticated on encryption
+
+    Returns:
+        Decrypted plaintext string
+
+    Raises:
+        ValueError: If decryption or integrity check fails
+    """
+    try:
+        plaintext_bytes = AESGCM(key).decrypt(
+            envelope['nonce'],
+            envelope['ciphertext'] + envelope['tag'],
+            associated_data
+        )
+        return plaintext_bytes.decode('utf-8')
+    except Exception:
+        raise ValueError("Message integrity check failed")
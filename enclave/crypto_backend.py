@@ -0,0 +1,119 @@
+"""
+Process-pool crypto backend for Enclave.
+Runs message verification and decryption in worker processes so incoming
+throughput scales across CPU cores instead of being bound by one interpreter.
+"""
+
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from . import crypto, keystore, message
+
+
+# Per-process state, set once by the pool initializer
+_worker_private_key = None
+_worker_fingerprint = None
+
+
+def _init_worker(private_key_pem: bytes, fingerprint: str, working_dir: str):
+    """
+    Initialize a crypto worker process.
+    Loads the private key once so batches only carry message bytes.
+
+    Args:
+        private_key_pem: Unencrypted PKCS8 PEM private key
+        fingerprint: User's key fingerprint
+        working_dir: Directory containing the keystore
+    """
+    global _worker_private_key, _worker_fingerprint
+
+    # Keystore paths are relative to the parent's working directory
+    os.chdir(working_dir)
+
+    _worker_private_key = crypto.load_private_key(private_key_pem, None)
+    _worker_fingerprint = fingerprint
+
+
+def _process_batch(batch: list) -> list:
+    """
+    Verify and decrypt a batch of messages in a worker process.
+
+    Args:
+        batch: List of serialized message bytes
+
+    Returns:
+        List of (sender_fingerprint, plaintext, timestamp, error) tuples in
+        the same order as the batch; plaintext is None if error is set
+    """
+    results = []
+
+    for message_data in batch:
+        sender_fingerprint = None
+        try:
+            envelope = message.parse_message(message_data)
+            sender_fingerprint = envelope['sender_fingerprint']
+
+            # Load sender's public key (cached per process)
+            try:
+                sender_public_key = keystore.load_peer_key(sender_fingerprint)
+            except FileNotFoundError:
+                raise ValueError(f"Unknown sender: {sender_fingerprint}")
+
+            plaintext = message.verify_and_decrypt(
+                envelope,
+                sender_public_key,
+                _worker_private_key,
+                _worker_fingerprint
+            )
+            results.append((sender_fingerprint, plaintext, envelope['timestamp'], None))
+
+        except Exception as e:
+            results.append((sender_fingerprint, None, None, str(e)))
+
+    return results
+
+
+class ProcessCryptoBackend:
+    """
+    Crypto execution backend that verifies and decrypts message batches in a process pool.
+    """
+
+    def __init__(self, private_key, fingerprint: str, processes=None):
+        """
+        Start crypto worker processes.
+
+        Args:
+            private_key: User's private key
+            fingerprint: User's key fingerprint
+            processes: Number of worker processes (default: CPU count)
+        """
+        self.processes = processes or os.cpu_count() or 1
+
+        # Workers receive the unlocked key once over the pool's private pipe
+        private_key_pem = crypto.serialize_private_key(private_key)
+
+        # Spawn instead of fork: the server already runs threads
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.processes,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker,
+            initargs=(private_key_pem, fingerprint, os.getcwd())
+        )
+
+    def submit(self, batch: list):
+        """
+        Submit a batch of messages for verification and decryption.
+
+        Args:
+            batch: List of serialized message bytes
+
+        Returns:
+            Future resolving to the list of results from _process_batch
+        """
+        return self.executor.submit(_process_batch, batch)
+
+    def shutdown(self):
+        """
+        Stop worker processes.
+        """
+        self.executor.shutdown(wait=True, cancel_futures=True)
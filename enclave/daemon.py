@@ -0,0 +1,625 @@
+"""
+Node daemon module for Enclave.
+Runs a long-lived node that unlocks the private key once and owns the
+ChatServer, key caches and connection pool. Local clients (CLI UI, web GUI,
+scripts) attach over a Unix socket speaking newline-delimited JSON RPC.
+
+Request:  {"id": 1, "method": "send", "params": {"fingerprint": "...", "message": "..."}}
+Response: {"id": 1, "result": ...} or {"id": 1, "error": "..."}
+Event:    {"event": "message", "sender": "...", "text": "...", "timestamp": 0.0}
+          {"event": "file", "sender": "...", "path": "...", "timestamp": 0.0}
+          {"event": "delivery", "recipient": "...", "id": "...", "text": "...", "error": null}
+          {"event": "presence", "peer": "...", "online": true, "last_seen": 0.0}
+
+Events are written to each subscriber by its own thread, so a client that
+stops reading never blocks the node; one that falls SUBSCRIBER_QUEUE_SIZE
+events behind is disconnected.
+"""
+
+import os
+import json
+import socket
+import socketserver
+import threading
+from queue import Queue, Full
+from pathlib import Path
+from . import addresses, keystore, metrics, network, outbox, presence, profiler, sender
+
+
+# Default Unix socket path for the daemon RPC API
+SOCKET_PATH = keystore.KEYS_DIR / "enclave.sock"
+
+# Seconds an RPC send or broadcast waits for its messages to be written (or acked)
+SEND_TIMEOUT = network.DELIVERY_TIMEOUT + 15
+
+# Events queued for one subscriber before it is disconnected as too slow
+SUBSCRIBER_QUEUE_SIZE = 10000
+
+
+def load_peer_addresses() -> dict:
+    """
+    Load peer addresses from disk and register each peer's alternate
+    addresses for connecting (see addresses.py).
+
+    Returns:
+        Dictionary mapping {fingerprint: (host, port)} of primary addresses
+    """
+    peers = {}
+
+    if not keystore.PEERS_DIR.exists():
+        return peers
+
+    for address_file in keystore.PEERS_DIR.glob("*.address"):
+        fingerprint = address_file.stem
+        address = address_file.read_text().strip()
+
+        # Parse addresses, primary first
+        try:
+            peer_addresses = addresses.parse_address_list(address)
+        except ValueError:
+            print(f"Warning: Invalid address for peer {fingerprint[:12]}: {address}")
+            continue
+        addresses.set_addresses(peer_addresses)
+        peers[fingerprint] = peer_addresses[0]
+
+    return peers
+
+
+class _RPCHandler(socketserver.StreamRequestHandler):
+    """
+    Handles one client connection to the daemon.
+    """
+
+    def setup(self):
+        super().setup()
+        self.write_lock = threading.Lock()
+
+        # Events waiting for the writer thread, once subscribed
+        self.events = None
+        self.closed = False
+
+    def handle(self):
+        """
+        Serve JSON RPC requests until the client disconnects.
+        """
+        node = self.server.node
+
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+            except ValueError:
+                self.send({'id': None, 'error': 'Invalid JSON'})
+                continue
+
+            if not isinstance(request, dict):
+                self.send({'id': None, 'error': 'Request must be a JSON object'})
+                continue
+
+            request_id = request.get('id')
+            method = request.get('method', '')
+            params = request.get('params') or {}
+
+            # Subscriptions stream events over this connection
+            if method == 'subscribe':
+                self.subscribe()
+                self.send({'id': request_id, 'result': True})
+                node.add_subscriber(self)
+                continue
+
+            handler = getattr(node, f"rpc_{method}", None)
+            if handler is None:
+                self.send({'id': request_id, 'error': f"Unknown method: {method}"})
+                continue
+
+            try:
+                self.send({'id': request_id, 'result': handler(**params)})
+            except Exception as e:
+                self.send({'id': request_id, 'error': str(e)})
+
+    def finish(self):
+        self.server.node.remove_subscriber(self)
+        self.closed = True
+        if self.events is not None:
+            try:
+                # Wake the writer thread; if the queue is full it is stuck
+                # writing and stops when the connection closes
+                self.events.put_nowait(None)
+            except Full:
+                pass
+        super().finish()
+
+    def subscribe(self):
+        """
+        Start the thread that writes events to this client.
+        """
+        if self.events is None:
+            self.events = Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+            threading.Thread(target=self._write_events, daemon=True, name="DaemonSubscriber").start()
+
+    def publish(self, event: dict) -> bool:
+        """
+        Queue an event for this client without blocking.
+
+        Args:
+            event: JSON-serializable dictionary
+
+        Returns:
+            False if the client is too far behind to take it
+        """
+        try:
+            self.events.put_nowait(event)
+            return True
+        except Full:
+            return False
+
+    def disconnect(self):
+        """
+        Close the connection, ending both the request loop and the writer thread.
+        """
+        self.closed = True
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _write_events(self):
+        """
+        Write queued events to the client until it disconnects.
+        """
+        while not self.closed:
+            event = self.events.get()
+            if event is None:
+                return
+            try:
+                self.send(event)
+            except OSError:
+                return
+
+    def send(self, payload: dict):
+        """
+        Write one JSON line to the client.
+
+        Args:
+            payload: JSON-serializable dictionary
+        """
+        data = (json.dumps(payload) + "\n").encode('utf-8')
+        with self.write_lock:
+            self.wfile.write(data)
+            self.wfile.flush()
+
+
+class _RPCServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class NodeDaemon:
+    """
+    Long-running node owning the unlocked key, ChatServer and peer state.
+    """
+
+    def __init__(self, host: str, port: int, private_key, public_key, fingerprint: str,
+                 socket_path=SOCKET_PATH, crypto_processes=0, engine='threads', listener_processes=1):
+        """
+        Initialize node daemon.
+
+        Args:
+            host: IP address to bind P2P server
+            port: Port number for P2P server
+            private_key: User's unlocked private key
+            public_key: User's public key
+            fingerprint: User's key fingerprint
+            socket_path: Unix socket path for the RPC API
+            crypto_processes: Number of crypto worker processes for ChatServer
+            engine: P2P server engine ('threads' or 'asyncio')
+            listener_processes: Number of P2P server processes sharing the port
+        """
+        self.private_key = private_key
+        self.fingerprint = fingerprint
+        self.port = port
+        self.socket_path = Path(socket_path)
+        self.peers = load_peer_addresses()
+
+        self.subscribers = set()
+        self.subscribers_lock = threading.Lock()
+
+        self.chat_server = network.create_server(
+            engine,
+            listener_processes,
+            host=host,
+            port=port,
+            private_key=private_key,
+            public_key=public_key,
+            fingerprint=fingerprint,
+            message_callback=self._on_message,
+            max_workers=20,
+            crypto_processes=crypto_processes,
+            file_callback=self._on_file,
+            replay_cache_path=keystore.REPLAY_CACHE_PATH
+        )
+        self.presence = presence.PresenceMonitor()
+        self.presence.set_peers(self.peers)
+        self.presence.add_listener(self._on_presence)
+        # One send engine for direct sends, broadcasts and outbox deliveries
+        self.sender = sender.SendEngine(private_key, fingerprint, presence=self.presence)
+        self.outbox = outbox.Outbox(private_key, fingerprint, delivery_callback=self._on_delivery,
+                                    presence=self.presence, engine=self.sender)
+        self.rpc_server = None
+
+    def start(self):
+        """
+        Start P2P server and RPC API.
+
+        Raises:
+            RuntimeError: If another daemon is already serving this keystore's socket
+        """
+        self._remove_stale_socket()
+
+        keystore.preload_all_peer_keys()
+        self.chat_server.start()
+        self.presence.start()
+        self.sender.start()
+        self.outbox.start()
+
+        # Only the owner may talk to the unlocked key
+        old_umask = os.umask(0o177)
+        try:
+            self.rpc_server = _RPCServer(str(self.socket_path), _RPCHandler)
+        finally:
+            os.umask(old_umask)
+        self.rpc_server.node = self
+
+        threading.Thread(target=self.rpc_server.serve_forever, daemon=True, name="DaemonRPC").start()
+
+        print(f"Daemon API listening on {self.socket_path}")
+
+    def _remove_stale_socket(self):
+        """
+        Remove a socket left by a daemon that exited without cleaning up.
+
+        Raises:
+            RuntimeError: If a daemon still listens on the socket
+        """
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(str(self.socket_path))
+        except (FileNotFoundError, ConnectionRefusedError):
+            # Nobody listening: no socket, or one left behind
+            if self.socket_path.exists():
+                self.socket_path.unlink()
+            return
+        finally:
+            probe.close()
+
+        try:
+            client = DaemonClient(self.socket_path)
+            try:
+                port = client.call('info')['port']
+            finally:
+                client.close()
+        except Exception:
+            port = "unknown"
+        raise RuntimeError(f"A daemon is already running on {self.socket_path} (P2P port {port})")
+
+    def stop(self):
+        """
+        Stop RPC API and P2P server.
+        """
+        if self.rpc_server:
+            self.rpc_server.shutdown()
+            self.rpc_server.server_close()
+            try:
+                self.socket_path.unlink()
+            except FileNotFoundError:
+                pass
+
+        self.outbox.stop()
+        self.sender.stop()
+        self.presence.stop()
+        self.chat_server.stop()
+
+    def add_subscriber(self, handler):
+        """
+        Register client connection for incoming message events.
+        """
+        with self.subscribers_lock:
+            self.subscribers.add(handler)
+
+    def remove_subscriber(self, handler):
+        """
+        Unregister client connection from incoming message events.
+        """
+        with self.subscribers_lock:
+            self.subscribers.discard(handler)
+
+    def _on_message(self, sender_fingerprint: str, plaintext: str, timestamp: float):
+        """
+        Push incoming message to all subscribed clients.
+        """
+        self.presence.seen(sender_fingerprint)
+        self._publish({'event': 'message', 'sender': sender_fingerprint, 'text': plaintext, 'timestamp': timestamp})
+
+    def _on_file(self, sender_fingerprint: str, path: str, timestamp: float):
+        """
+        Push completed incoming file transfer to all subscribed clients.
+        """
+        self.presence.seen(sender_fingerprint)
+        self._publish({'event': 'file', 'sender': sender_fingerprint, 'path': path, 'timestamp': timestamp})
+
+    def _on_delivery(self, recipient_fingerprint: str, entry_id: str, plaintext: str, error):
+        """
+        Push delivered or dropped queued message to all subscribed clients.
+        """
+        self._publish({'event': 'delivery', 'recipient': recipient_fingerprint, 'id': entry_id, 'text': plaintext,
+                       'error': None if error is None else str(error)})
+
+    def _on_presence(self, fingerprint: str, online: bool, last_seen: float):
+        """
+        Push a peer going online or offline to all subscribed clients.
+        """
+        self._publish({'event': 'presence', 'peer': fingerprint, 'online': online, 'last_seen': last_seen})
+
+    def _publish(self, event: dict):
+        """
+        Queue event for all subscribed clients.
+        """
+        with self.subscribers_lock:
+            subscribers = list(self.subscribers)
+
+        for handler in subscribers:
+            if not handler.publish(event):
+                # Never block the message workers on a client that stopped reading
+                print("Dropping daemon subscriber that stopped reading events")
+                metrics.increment('daemon.subscribers_dropped')
+                self.remove_subscriber(handler)
+                handler.disconnect()
+
+    # RPC methods (called as rpc_<method>)
+
+    def rpc_info(self):
+        """
+        Get node fingerprint, P2P port and peer count.
+        """
+        return {'fingerprint': self.fingerprint, 'port': self.port, 'peers_count': len(self.peers)}
+
+    def rpc_peers(self):
+        """
+        Get known peers as {fingerprint: [host, port]}.
+        """
+        return {fp: [host, port] for fp, (host, port) in self.peers.items()}
+
+    def rpc_add_peer(self, fingerprint: str, host: str, port: int, alternates: list = None):
+        """
+        Register address of a peer whose key is already in the keystore,
+        with optional alternate "host:port" addresses.
+        """
+        keystore.load_peer_key(fingerprint)
+        peer_addresses = [(host, int(port))] + [addresses.parse_address(a) for a in alternates or []]
+        addresses.set_addresses(peer_addresses)
+        self.peers[fingerprint] = peer_addresses[0]
+        self.presence.watch(fingerprint, *peer_addresses[0])
+        return True
+
+    def rpc_paths(self):
+        """
+        Get the smoothed connect RTT, connects and failures of every peer address tried.
+        """
+        return addresses.stats()
+
+    def rpc_presence(self):
+        """
+        Get whether each known peer is online and when it last answered, as
+        {fingerprint: {'online', 'last_seen'}}.
+        """
+        return self.presence.status()
+
+    def rpc_send(self, fingerprint: str, message: str, wait: bool = False):
+        """
+        Send message to a known peer; with wait, return once the peer acks delivery.
+        """
+        if fingerprint not in self.peers:
+            raise ValueError("Peer not found")
+        host, port = self.peers[fingerprint]
+        future = self.sender.send(host, port, fingerprint, message, wait_for_delivery=wait)
+        return future.result(timeout=SEND_TIMEOUT)
+
+    def rpc_queue(self, fingerprint: str, message: str):
+        """
+        Queue message to a known peer in the outbox; returns the entry ID reported in delivery events.
+        """
+        if fingerprint not in self.peers:
+            raise ValueError("Peer not found")
+        host, port = self.peers[fingerprint]
+        return self.outbox.send(host, port, fingerprint, message)
+
+    def rpc_queue_broadcast(self, message: str, fingerprints: list = None):
+        """
+        Queue message to all known peers, or to the given fingerprints, in the outbox.
+        """
+        targets = fingerprints if fingerprints is not None else list(self.peers)
+        recipients = [(*self.peers[fp], fp) for fp in targets if fp in self.peers]
+        entry_ids, errors = self.outbox.broadcast(recipients, message)
+        return {'ids': entry_ids, 'errors': errors}
+
+    def rpc_outbox(self):
+        """
+        Get the number of queued messages per peer.
+        """
+        return self.outbox.pending()
+
+    def rpc_admission(self):
+        """
+        Get per-source counters of admitted, throttled and rejected envelopes.
+        """
+        return self.chat_server.admission_stats()
+
+    def rpc_validation(self):
+        """
+        Get the number of envelopes accepted and rejected per validation stage.
+        """
+        return self.chat_server.validation_stats()
+
+    def rpc_metrics(self):
+        """
+        Get hot-path counters, gauges and latency histograms (metrics.snapshot()).
+        """
+        return metrics.snapshot()
+
+    def rpc_profile_start(self, duration: float = profiler.DEFAULT_DURATION,
+                          interval: float = profiler.DEFAULT_INTERVAL, allocations: bool = True):
+        """
+        Start profiling the daemon for at most duration seconds.
+        """
+        return profiler.start(duration, interval, allocations)
+
+    def rpc_profile_stop(self):
+        """
+        Stop profiling and write the reports; returns the report summary.
+        """
+        return profiler.stop()
+
+    def rpc_profile_status(self):
+        """
+        Get the state of the current or last profiling session.
+        """
+        return profiler.status()
+
+    def rpc_send_file(self, fingerprint: str, path: str, transfer_id: str = None):
+        """
+        Stream a local file to a known peer; returns the transfer ID.
+        """
+        if fingerprint not in self.peers:
+            raise ValueError("Peer not found")
+        host, port = self.peers[fingerprint]
+        return network.send_file(host, port, fingerprint, path, self.private_key, self.fingerprint, transfer_id)
+
+    def rpc_broadcast(self, message: str, fingerprints: list = None, wait: bool = False):
+        """
+        Send message to all known peers, or to the given fingerprints.
+        """
+        targets = fingerprints if fingerprints is not None else list(self.peers)
+        recipients = [(*self.peers[fp], fp) for fp in targets if fp in self.peers]
+        futures, errors = self.sender.broadcast(recipients, message, wait_for_delivery=wait)
+        results = {fp: False for fp in errors}
+        for fp, future in futures.items():
+            try:
+                results[fp] = future.result(timeout=SEND_TIMEOUT)
+            except Exception as e:
+                results[fp] = False
+                errors[fp] = str(e)
+        return {'results': results, 'errors': errors}
+
+
+class DaemonClient:
+    """
+    Client for the node daemon RPC API.
+    """
+
+    def __init__(self, socket_path=SOCKET_PATH):
+        """
+        Connect to a running daemon.
+
+        Args:
+            socket_path: Unix socket path of the daemon
+
+        Raises:
+            ConnectionError: If no daemon is listening
+        """
+        self.socket_path = str(socket_path)
+        self.lock = threading.Lock()
+        self.next_id = 0
+
+        try:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(self.socket_path)
+        except OSError as e:
+            raise ConnectionError(f"Daemon not running at {self.socket_path}: {e}")
+        self.reader = self.sock.makefile('rb')
+
+    def call(self, method: str, **params):
+        """
+        Call an RPC method and wait for its result.
+
+        Args:
+            method: Method name
+            **params: Method parameters
+
+        Returns:
+            Method result
+
+        Raises:
+            RuntimeError: If the daemon returned an error
+            ConnectionError: If the daemon closed the connection
+        """
+        with self.lock:
+            self.next_id += 1
+            request = {'id': self.next_id, 'method': method, 'params': params}
+            self.sock.sendall((json.dumps(request) + "\n").encode('utf-8'))
+
+            line = self.reader.readline()
+            if not line:
+                raise ConnectionError("Daemon closed connection")
+
+        response = json.loads(line)
+        if response.get('error') is not None:
+            raise RuntimeError(response['error'])
+        return response['result']
+
+    def subscribe(self, callback, file_callback=None, delivery_callback=None, presence_callback=None):
+        """
+        Receive incoming messages on a separate connection.
+
+        Args:
+            callback: Function called with (sender_fingerprint, plaintext, timestamp)
+            file_callback: Function called with (sender_fingerprint, path, timestamp) (optional)
+            delivery_callback: Function called with (recipient_fingerprint, entry_id, plaintext, error)
+                               for messages queued with 'queue' (optional)
+            presence_callback: Function called with (fingerprint, online, last_seen) when a
+                               peer goes online or offline (optional)
+
+        Returns:
+            Background reader thread
+        """
+        subscription = DaemonClient(self.socket_path)
+        subscription.call('subscribe')
+
+        def reader_thread():
+            for line in subscription.reader:
+                event = json.loads(line)
+                if event.get('event') == 'message':
+                    callback(event['sender'], event['text'], event['timestamp'])
+                elif event.get('event') == 'file' and file_callback:
+                    file_callback(event['sender'], event['path'], event['timestamp'])
+                elif event.get('event') == 'delivery' and delivery_callback:
+                    delivery_callback(event['recipient'], event['id'], event['text'], event['error'])
+                elif event.get('event') == 'presence' and presence_callback:
+                    presence_callback(event['peer'], event['online'], event['last_seen'])
+
+        thread = threading.Thread(target=reader_thread, daemon=True, name="DaemonEvents")
+        thread.start()
+        return thread
+
+    def close(self):
+        """
+        Close connection to the daemon.
+        """
+        self.reader.close()
+        self.sock.close()
+
+
+def connect(socket_path=SOCKET_PATH):
+    """
+    Connect to a running daemon if there is one.
+
+    Args:
+        socket_path: Unix socket path of the daemon
+
+    Returns:
+        DaemonClient or None if no daemon is running
+    """
+    if not Path(socket_path).exists():
+        return None
+
+    try:
+        return DaemonClient(socket_path)
+    except ConnectionError:
+        return None
@@ -0,0 +1,328 @@
+"""
+Framing module for Enclave.
+Every connection carries frames made of a 4-byte big-endian length prefix
+and a payload.
+
+Receiving reads ahead with recv_into into a per-connection buffer, so one
+system call picks up many small frames, which are then copied out. Larger
+payloads are received with recv_into straight into pooled buffers and
+handed on as memoryviews, without copies or per-frame allocations once
+the pool is warm. Sending uses sendmsg, so the prefix and payload (or
+several payload parts) leave in one system call without being joined.
+"""
+
+import socket
+import struct
+import threading
+
+
+# Length prefix of every frame
+HEADER = struct.Struct('!I')
+
+# Per-connection read-ahead buffer; payloads up to this size are copied
+# out of it, longer ones are received into pooled buffers
+READ_AHEAD_SIZE = 16 * 1024
+
+# Pooled buffer sizes are powers of two from MIN_BUFFER_SIZE up
+MIN_BUFFER_SIZE = READ_AHEAD_SIZE
+
+# Most bytes kept in free buffers of one pool
+DEFAULT_MAX_POOLED_BYTES = 32 * 1024 * 1024
+
+_HAS_SENDMSG = hasattr(socket.socket, 'sendmsg')
+
+
+class BufferPool:
+    """
+    Free lists of bytearrays by power-of-two size, so frame buffers are
+    reused instead of allocated and freed for every frame.
+    """
+
+    def __init__(self, max_pooled_bytes: int = DEFAULT_MAX_POOLED_BYTES):
+        """
+        Initialize buffer pool.
+
+        Args:
+            max_pooled_bytes: Most bytes kept in free buffers; buffers released
+                              beyond that are left to the garbage collector
+                              (default: 32 MiB)
+        """
+        self.max_pooled_bytes = max_pooled_bytes
+        self.free = {}
+        self.pooled_bytes = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, size: int) -> bytearray:
+        """
+        Get a buffer of at least size bytes.
+
+        Args:
+            size: Bytes needed
+
+        Returns:
+            Pooled or new bytearray
+        """
+        capacity = max(MIN_BUFFER_SIZE, 1 << (size - 1).bit_length())
+        with self.lock:
+            buffers = self.free.get(capacity)
+            if buffers:
+                self.pooled_bytes -= capacity
+                return buffers.pop()
+        return bytearray(capacity)
+
+    def release(self, buffer: bytearray):
+        """
+        Return a buffer from acquire(). Nothing may use it afterwards.
+
+        Args:
+            buffer: Buffer to reuse
+        """
+        capacity = len(buffer)
+        with self.lock:
+            if self.pooled_bytes + capacity <= self.max_pooled_bytes:
+                self.free.setdefault(capacity, []).append(buffer)
+                self.pooled_bytes += capacity
+
+
+# Shared by all connections
+buffer_pool = BufferPool()
+
+
+class Frame:
+    """
+    Received frame payload, in a pooled buffer if it was too long to be copied.
+    """
+
+    __slots__ = ('view', 'buffer', 'pool')
+
+    def __init__(self, view, buffer: bytearray = None, pool: BufferPool = None):
+        """
+        Args:
+            view: Payload (bytes or a memoryview into buffer)
+            buffer: Pooled buffer holding the payload (optional)
+            pool: Pool the buffer belongs to (optional)
+        """
+        self.view = view
+        self.buffer = buffer
+        self.pool = pool
+
+    def release(self):
+        """
+        Return the buffer to its pool. The frame and views into it must not
+        be used afterwards; releasing twice does nothing.
+        """
+        if self.buffer is not None:
+            self.pool.release(self.buffer)
+            self.buffer = None
+            self.view = None
+
+
+def _recv_into_exact(sock, view: memoryview) -> bool:
+    """
+    Fill a buffer from a blocking socket.
+
+    Returns:
+        True if filled, False if the connection closed first
+    """
+    received = 0
+    while received < len(view):
+        read = sock.recv_into(view[received:])
+        if not read:
+            return False
+        received += read
+    return True
+
+
+class FrameReader:
+    """
+    Reads frames from one blocking socket.
+    """
+
+    def __init__(self, sock, pool: BufferPool = None, read_ahead: int = READ_AHEAD_SIZE):
+        """
+        Initialize frame reader.
+
+        Args:
+            sock: Connected socket
+            pool: Buffer pool for long payloads (default: the shared pool)
+            read_ahead: Size of the read-ahead buffer (default: 16 KiB)
+        """
+        self.sock = sock
+        self.pool = pool or buffer_pool
+        self.buffer = memoryview(bytearray(read_ahead))
+
+        # Received bytes not consumed yet are buffer[start:end]
+        self.start = 0
+        self.end = 0
+
+    def _fill(self, needed: int) -> bool:
+        """
+        Read ahead until at least needed bytes are buffered (needed <= buffer size).
+
+        Returns:
+            True if buffered, False if the connection closed first
+        """
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif self.start + needed > len(self.buffer):
+            # Move the unconsumed tail to the front
+            length = self.end - self.start
+            self.buffer[:length] = self.buffer[self.start:self.end]
+            self.start, self.end = 0, length
+
+        while self.end - self.start < needed:
+            read = self.sock.recv_into(self.buffer[self.end:])
+            if not read:
+                return False
+            self.end += read
+        return True
+
+    def read_length(self):
+        """
+        Receive the next length prefix.
+
+        Returns:
+            Payload length, or None if the connection closed
+
+        Raises:
+            socket.timeout: If the socket timeout expired
+        """
+        if not self._fill(HEADER.size):
+            return None
+        (length,) = HEADER.unpack_from(self.buffer, self.start)
+        self.start += HEADER.size
+        return length
+
+    def read_payload(self, length: int) -> Frame:
+        """
+        Receive a payload of known length.
+        Call only after checking length against the allowed frame size.
+
+        Args:
+            length: Payload length from read_length()
+
+        Returns:
+            Frame to release once processed, or None if the connection closed
+        """
+        if length <= len(self.buffer):
+            if not self._fill(length):
+                return None
+            payload = bytes(self.buffer[self.start:self.start + length])
+            self.start += length
+            return Frame(payload)
+
+        # Long payload: take what was read ahead, receive the rest in place
+        buffer = self.pool.acquire(length)
+        view = memoryview(buffer)[:length]
+        buffered = self.end - self.start
+        view[:buffered] = self.buffer[self.start:self.end]
+        self.start = self.end = 0
+
+        frame = Frame(view, buffer, self.pool)
+        if not _recv_into_exact(self.sock, view[buffered:]):
+            frame.release()
+            return None
+        return frame
+
+    def read_frame(self, max_size: int) -> Frame:
+        """
+        Receive the next frame.
+
+        Args:
+            max_size: Largest accepted payload size
+
+        Returns:
+            Frame to release once processed, or None if the connection closed
+
+        Raises:
+            ValueError: If the announced payload size is zero or exceeds max_size
+        """
+        length = self.read_length()
+        if length is None:
+            return None
+        if length == 0 or length > max_size:
+            raise ValueError(f"Invalid frame size: {length}")
+        return self.read_payload(length)
+
+
+def recv_frame(sock, max_size: int) -> bytearray:
+    """
+    Receive one frame into a new buffer of exactly its size, for small
+    frames that are kept or parsed on the spot (hello and ack replies).
+
+    Args:
+        sock: Connected socket
+        max_size: Largest accepted payload size
+
+    Returns:
+        Payload, or None if the connection closed
+
+    Raises:
+        ValueError: If the announced payload size exceeds max_size
+    """
+    header = bytearray(HEADER.size)
+    if not _recv_into_exact(sock, memoryview(header)):
+        return None
+
+    length = HEADER.unpack(header)[0]
+    if length > max_size:
+        raise ValueError(f"Invalid frame size: {length}")
+
+    payload = bytearray(length)
+    if not _recv_into_exact(sock, memoryview(payload)):
+        return None
+    return payload
+
+
+def send_frame(sock, payload):
+    """
+    Send one frame.
+
+    Args:
+        sock: Connected socket
+        payload: Bytes-like payload
+    """
+    header = HEADER.pack(len(payload))
+    if not _HAS_SENDMSG:
+        sock.sendall(header + payload)
+        return
+
+    sent = sock.sendmsg((header, payload))
+    if sent < len(header) + len(payload):
+        _send_rest(sock, (header, payload), sent)
+
+
+def send_frame_parts(sock, parts):
+    """
+    Send one frame whose payload is made of several buffers, without joining them.
+
+    Args:
+        sock: Connected socket
+        parts: Sequence of bytes-like buffers
+    """
+    buffers = [HEADER.pack(sum(len(part) for part in parts))]
+    buffers.extend(parts)
+    if not _HAS_SENDMSG:
+        sock.sendall(b''.join(buffers))
+        return
+
+    sent = sock.sendmsg(buffers)
+    if sent < sum(len(buffer) for buffer in buffers):
+        _send_rest(sock, buffers, sent)
+
+
+def _send_rest(sock, buffers, sent: int):
+    """
+    Send what a short sendmsg left over.
+
+    Args:
+        sock: Connected socket
+        buffers: Buffers passed to sendmsg
+        sent: Bytes sendmsg sent
+    """
+    for buffer in buffers:
+        if sent >= len(buffer):
+            sent -= len(buffer)
+            continue
+        sock.sendall(memoryview(buffer)[sent:])
+        sent = 0
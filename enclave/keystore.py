@@ -10,7 +10,7 @@ import hashlib
 import threading
 from pathlib import Path
 from concurrent.futures import ThreadPoolExecutor
-from . import crypto
+from . import crypto, metrics
 
 
 # Base directory for key storage
@@ -18,24 +18,27 @@ KEYS_DIR = Path("keys")
 PRIVATE_KEY_PATH = KEYS_DIR / "my_private_key.pem"
 PUBLIC_KEY_PATH = KEYS_DIR / "my_public_key.pem"
 PEERS_DIR = KEYS_DIR / "peers"
+REPLAY_CACHE_PATH = KEYS_DIR / "replay_cache.bin"
+OUTBOX_PATH = KEYS_DIR / "outbox.log"
 
 # Cache for peer public keys (fingerprint -> public_key object)
 _peer_key_cache = {}
 _cache_lock = threading.Lock()
 
 
-def generate_and_save_keys(password: str) -> str:
+def generate_and_save_keys(password: str, key_type: str = crypto.KEY_TYPE_RSA) -> str:
     """
-    Generate RSA-4096 key pair and save to disk.
+    Generate key pair and save to disk.
 
     Args:
         password: Password to encrypt private key
+        key_type: 'rsa' for RSA-4096 or 'ed25519' for Ed25519/X25519 (default: 'rsa')
 
     Returns:
         Fingerprint of generated keys
     """
     # Generate key pair
-    private_key_bytes, public_key_bytes, fingerprint = crypto.generate_key_pair(password)
+    private_key_bytes, public_key_bytes, fingerprint = crypto.generate_key_pair(password, key_type)
 
     # Create directories if they don't exist
     KEYS_DIR.mkdir(exist_ok=True)
@@ -124,14 +127,16 @@ def load_peer_key(fingerprint: str):
         fingerprint: SHA-256 fingerprint of peer's public key
 
     Returns:
-        RSA public key object
+        RSA public key or EdPublicKey object
 
     Raises:
         FileNotFoundError: If peer key not found
     """
     # Check cache first (read lock not needed for dict reads in Python GIL)
     if fingerprint in _peer_key_cache:
+        metrics.increment('keystore.cache_hits')
         return _peer_key_cache[fingerprint]
+    metrics.increment('keystore.cache_misses')
 
     # Not in cache, load from disk
     peer_key_file = PEERS_DIR / f"{fingerprint}.pem"
@@ -0,0 +1,358 @@
+"""
+Multi-process listener mode for Enclave.
+Runs several chat server processes on the same port through SO_REUSEPORT,
+so the kernel spreads incoming connections over them and envelope parsing
+and crypto scale across CPU cores instead of being bound by one interpreter.
+
+Listener processes deliver decrypted messages and received files to the
+parent over a multiprocessing queue. Each listener screens replays on its
+own connections before any crypto, and the parent checks every message ID
+against its (persisted) replay cache again before delivering, so a
+duplicate sent over a connection that landed on another process is
+dropped as well.
+"""
+
+import os
+import signal
+import socket
+import threading
+import multiprocessing
+from queue import Queue, Empty
+from . import crypto, keystore, message, metrics, network
+from .async_server import AsyncChatServer
+
+
+# Seconds between the counters each listener reports to the parent
+STATS_INTERVAL = 2
+
+# Seconds to wait for all listeners to bind
+START_TIMEOUT = 30
+
+
+class _Listener:
+    """
+    Chat server mixin that forwards deliveries to the parent process.
+    """
+
+    # Set by _run_listener before the server starts
+    events = None
+
+    def _deliver(self, message_id, sender_fingerprint: str, plaintext: str, timestamp: float):
+        self.events.put(('message', message_id, sender_fingerprint, plaintext, timestamp))
+
+
+class _ThreadListener(_Listener, network.ChatServer):
+    pass
+
+
+class _AsyncListener(_Listener, AsyncChatServer):
+    pass
+
+
+_LISTENER_CLASSES = {'threads': _ThreadListener, 'asyncio': _AsyncListener}
+
+
+def _run_listener(index: int, engine: str, private_key_pem: bytes, public_key_pem: bytes, fingerprint: str,
+                  working_dir: str, accept_files: bool, events, stop_event, server_kwargs: dict):
+    """
+    Run one listener process until stop_event is set or the parent exits.
+
+    Args:
+        index: Listener number, included in its events
+        engine: Server engine ('threads' or 'asyncio')
+        private_key_pem: Unencrypted PKCS8 PEM private key
+        public_key_pem: PEM public key
+        fingerprint: User's key fingerprint
+        working_dir: Directory containing the keystore
+        accept_files: Whether to accept incoming file transfers
+        events: Queue of events for the parent
+        stop_event: Event set by the parent to stop listening
+        server_kwargs: Other ChatServer arguments
+    """
+    parent_pid = os.getppid()
+
+    # Ctrl+C reaches the whole process group; the parent stops listeners itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    # Keystore paths are relative to the parent's working directory
+    os.chdir(working_dir)
+
+    try:
+        keystore.preload_all_peer_keys()
+
+        def file_callback(sender_fingerprint, path, timestamp):
+            events.put(('file', sender_fingerprint, path, timestamp))
+
+        server = _LISTENER_CLASSES[engine](
+            private_key=crypto.load_private_key(private_key_pem, None),
+            public_key=crypto.load_public_key(public_key_pem),
+            fingerprint=fingerprint,
+            message_callback=None,
+            file_callback=file_callback if accept_files else None,
+            reuse_port=True,
+            **server_kwargs
+        )
+        server.events = events
+        server.start()
+    except Exception as e:
+        events.put(('error', index, str(e)))
+        return
+
+    def report():
+        events.put(('stats', index, server.validation_stats(), server.admission_stats(),
+                    metrics.registry.local_snapshot()))
+
+    events.put(('ready', index))
+    try:
+        while not stop_event.wait(STATS_INTERVAL) and os.getppid() == parent_pid:
+            report()
+    finally:
+        server.stop()
+        report()
+
+
+class MultiProcessServer:
+    """
+    Chat server made of several listener processes sharing one port.
+    Provides the ChatServer methods used by the CLI, web GUI and daemon.
+    """
+
+    def __init__(self, engine: str, processes: int, host: str, port: int, private_key, public_key,
+                 fingerprint: str, message_callback, file_callback=None, replay_cache_path=None,
+                 **server_kwargs):
+        """
+        Initialize multi-process server.
+
+        Args:
+            engine: Server engine each listener runs ('threads' or 'asyncio')
+            processes: Number of listener processes
+            host: IP address to bind
+            port: Port number to listen on
+            private_key: User's private key, sent to each listener unlocked
+            public_key: User's public key
+            fingerprint: User's key fingerprint
+            message_callback: Function called in this process when a message is
+                              received (signature: callback(sender_fingerprint, plaintext, timestamp))
+            file_callback: Function called in this process when a file transfer
+                           completes (signature: callback(sender_fingerprint, path, timestamp));
+                           incoming transfers are refused if not set
+            replay_cache_path: File to persist the replay cache to (optional)
+            **server_kwargs: Other ChatServer arguments for each listener; they are
+                             pickled, so admission_control is not supported and each
+                             listener applies the default limits to its own connections
+
+        Raises:
+            ValueError: If the platform has no SO_REUSEPORT or crypto_processes is set
+        """
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            raise ValueError("Listener processes need SO_REUSEPORT, which this platform does not support")
+        if server_kwargs.get('crypto_processes'):
+            # Listener processes are daemonic and cannot start process pools
+            raise ValueError("Listener processes run crypto themselves and cannot use crypto processes")
+
+        self.engine = engine
+        self.processes = processes
+        self.host = host
+        self.port = port
+        self.public_key = public_key
+        self.fingerprint = fingerprint
+        self.message_callback = message_callback
+        self.file_callback = file_callback
+        self.replay_cache_path = replay_cache_path
+        self.replay_snapshot_stop = None
+        self.running = False
+
+        server_kwargs.update(host=host, port=port, replay_cache_path=None)
+
+        # Spawn instead of fork: the parent already runs threads
+        context = multiprocessing.get_context('spawn')
+        self.events = context.Queue()
+        self.stop_event = context.Event()
+        private_key_pem = crypto.serialize_private_key(private_key)
+        public_key_pem = crypto.serialize_public_key(public_key)
+        self.listeners = [
+            context.Process(
+                target=_run_listener,
+                args=(index, engine, private_key_pem, public_key_pem, fingerprint, os.getcwd(),
+                      file_callback is not None, self.events, self.stop_event, server_kwargs),
+                daemon=True,
+                name=f"EnclaveListener-{index}"
+            )
+            for index in range(processes)
+        ]
+        self.event_thread = None
+
+        # Startup results, read by start()
+        self.startup = Queue()
+
+        # Latest counters reported by each listener
+        self.listener_stats = {}
+        self.duplicates = 0
+        self.stats_lock = threading.Lock()
+
+    def start(self):
+        """
+        Start listener processes and wait until all of them are bound.
+
+        Raises:
+            OSError: If a listener failed to start
+        """
+        self.running = True
+
+        # Restore replay protection from the last run
+        if self.replay_cache_path:
+            replay_cache = message.configure_replay_cache(self.replay_cache_path)
+            self.replay_snapshot_stop = replay_cache.start_snapshots()
+
+        metrics.registry.add_source(self._listener_metrics)
+
+        self.event_thread = threading.Thread(target=self._event_loop, daemon=True, name="ListenerEvents")
+        self.event_thread.start()
+
+        for listener in self.listeners:
+            listener.start()
+
+        for _ in self.listeners:
+            try:
+                event = self.startup.get(timeout=START_TIMEOUT)
+            except Empty:
+                event = ('error', None, "timed out")
+            if event[0] == 'error':
+                self.stop()
+                raise OSError(f"Listener process failed to start: {event[2]}")
+
+        print(f"Server started with {self.processes} listener processes ({self.engine} engine) "
+              f"sharing port {self.port}")
+
+    def _event_loop(self):
+        """
+        Deliver messages and files received by the listeners, in arrival order.
+        """
+        while self.running:
+            try:
+                event = self.events.get(timeout=0.5)
+            except Empty:
+                continue
+            except (EOFError, OSError):
+                break
+
+            try:
+                self._handle_event(event)
+            except Exception as e:
+                print(f"Error processing message: {e}")
+
+    def _handle_event(self, event: tuple):
+        """
+        Handle one event from a listener process.
+
+        Args:
+            event: Tuple starting with the event kind
+        """
+        kind = event[0]
+
+        if kind == 'message':
+            _, message_id, sender_fingerprint, plaintext, timestamp = event
+
+            # Only the parent sees envelopes from every listener
+            if message.check_duplicate(message_id, timestamp):
+                with self.stats_lock:
+                    self.duplicates += 1
+                return
+
+            start = metrics.clock()
+            self.message_callback(sender_fingerprint, plaintext, timestamp)
+            metrics.since('server.callback', start)
+
+        elif kind == 'file':
+            _, sender_fingerprint, path, timestamp = event
+            if self.file_callback:
+                self.file_callback(sender_fingerprint, path, timestamp)
+
+        elif kind == 'stats':
+            _, index, validation, admission_stats, snapshot = event
+            with self.stats_lock:
+                self.listener_stats[index] = (validation, admission_stats, snapshot)
+
+        else:
+            self.startup.put(event)
+
+    def validation_stats(self) -> dict:
+        """
+        Get how many envelopes passed validation and how many each stage
+        rejected, summed over the listeners' last reports. Duplicates caught
+        by this process count as replays.
+
+        Returns:
+            Dictionary with 'accepted' count and 'rejected' mapping stage to count
+        """
+        with self.stats_lock:
+            rejected = dict.fromkeys(network.VALIDATION_STAGES, 0)
+            rejected['replay'] = self.duplicates
+            accepted = -self.duplicates
+
+            for validation, _, _ in self.listener_stats.values():
+                accepted += validation['accepted']
+                for stage, count in validation['rejected'].items():
+                    rejected[stage] += count
+
+        return {'accepted': accepted, 'rejected': rejected}
+
+    def admission_stats(self) -> dict:
+        """
+        Get per-source counters of envelopes admitted, throttled and rejected,
+        summed over the listeners' last reports.
+
+        Returns:
+            Dictionary with 'ips' and 'senders', each mapping source to
+            {'admitted': n, 'throttled': n, 'rejected': n}
+        """
+        totals = {'ips': {}, 'senders': {}}
+        with self.stats_lock:
+            for _, admission_stats, _ in self.listener_stats.values():
+                for name, sources in admission_stats.items():
+                    for key, counters in sources.items():
+                        total = totals[name].setdefault(key, dict.fromkeys(counters, 0))
+                        for counter, count in counters.items():
+                            total[counter] += count
+        return totals
+
+    def _listener_metrics(self) -> list:
+        """
+        Get the metrics snapshots the listeners last reported, merged into
+        this process's metrics.
+        """
+        with self.stats_lock:
+            return [snapshot for _, _, snapshot in self.listener_stats.values()]
+
+    def stop(self):
+        """
+        Stop listener processes and save the replay cache.
+        """
+        self.stop_event.set()
+        for listener in self.listeners:
+            if listener.pid is None:
+                continue
+            listener.join(timeout=15)
+            if listener.is_alive():
+                listener.terminate()
+                listener.join()
+
+        # Deliver what the listeners handed over before they stopped
+        self.running = False
+        if self.event_thread:
+            self.event_thread.join()
+        while True:
+            try:
+                self._handle_event(self.events.get_nowait())
+            except (Empty, EOFError, OSError):
+                break
+            except Exception as e:
+                print(f"Error processing message: {e}")
+
+        metrics.registry.remove_source(self._listener_metrics)
+
+        if self.replay_snapshot_stop:
+            self.replay_snapshot_stop.set()
+            message.get_replay_cache().snapshot()
+
+        print("Server stopped")
@@ -0,0 +1,725 @@
+"""
+End-to-end load generator for Enclave.
+Simulates hundreds of peers on loopback against one or more real target
+nodes: throwaway identities are generated in a process pool into a
+temporary keystore, each target node runs in its own process, and every
+simulated peer sends over its own persistent connections, so traffic goes
+through the same sockets, framing, admission, validation and crypto as in
+production.
+
+Reports end-to-end latency percentiles (from before encryption on the
+sender to the target's message callback), throughput, drops and CPU time
+per component as JSON.
+
+Usage:
+    enclave-bench --peers 200 --messages 50 --pattern unicast
+    enclave-bench --peers 100 --targets 4 --pattern broadcast --rate 5
+    enclave-bench --pattern mixed --sizes 16 1024 8000 --engine asyncio
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import platform
+import threading
+import multiprocessing
+from queue import Empty
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+import cryptography
+from . import __version__, admission, crypto, keystore, message, metrics, network, profiler
+from .benchmark import BENCHMARK_PASSWORD, temporary_keystore
+
+
+PATTERNS = ('unicast', 'burst', 'broadcast', 'mixed')
+
+# Payload sizes in characters when none are given
+DEFAULT_SIZES = [256]
+MIXED_SIZES = [16, 256, 1024, 8192]
+
+# Seconds without new deliveries after which the remaining messages count as dropped
+DRAIN_TIMEOUT = 10
+
+# Seconds between per-thread CPU clock reads
+CPU_INTERVAL = 0.5
+
+# Seconds to wait for target nodes to start
+START_TIMEOUT = 60
+
+HOST = "127.0.0.1"
+
+
+def _generate_identity(key_type: str) -> tuple:
+    """
+    Generate an identity in a key generation process.
+
+    Returns:
+        Tuple of (unencrypted private key PEM, public key PEM, fingerprint)
+    """
+    private_key_bytes, public_key_bytes, fingerprint = crypto.generate_key_pair(BENCHMARK_PASSWORD, key_type)
+    private_key = crypto.load_private_key(private_key_bytes, BENCHMARK_PASSWORD)
+    return crypto.serialize_private_key(private_key), public_key_bytes, fingerprint
+
+
+def generate_identities(count: int, key_type: str = crypto.KEY_TYPE_RSA, processes: int = 0) -> list:
+    """
+    Generate identities in parallel and store their public keys as peers
+    in the keystore of the current directory.
+
+    Args:
+        count: Number of identities
+        key_type: Identity key type (default: rsa)
+        processes: Key generation processes, 0 for one per CPU (default: 0)
+
+    Returns:
+        List of (private_key, public_key, fingerprint, private_key_pem) tuples
+    """
+    processes = min(processes or os.cpu_count() or 1, count)
+    with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn')) as pool:
+        generated = list(pool.map(_generate_identity, [key_type] * count))
+
+    keystore.PEERS_DIR.mkdir(parents=True, exist_ok=True)
+    identities = []
+    for private_key_pem, public_key_bytes, fingerprint in generated:
+        (keystore.PEERS_DIR / f"{fingerprint}.pem").write_bytes(public_key_bytes)
+        identities.append((crypto.load_private_key(private_key_pem, None),
+                           crypto.load_public_key(public_key_bytes), fingerprint, private_key_pem))
+    return identities
+
+
+def _component(thread_name: str) -> str:
+    """
+    Group threads by what they do: "MsgWorker-3" and "ChatServer_12" count
+    as "MsgWorker" and "ChatServer", unnamed threads by their target function.
+    """
+    unnamed = re.match(r'Thread-\d+ \((\w+)\)', thread_name)
+    if unnamed:
+        return unnamed.group(1)
+    return re.sub(r'[-_]?\d+$', '', thread_name)
+
+
+class _CpuSampler:
+    """
+    Accounts CPU time per component of this process. Thread CPU clocks are
+    read periodically so threads that exit before the end are counted too.
+    """
+
+    def __init__(self, interval: float = CPU_INTERVAL):
+        self.interval = interval
+
+        # Thread ident -> [name, CPU seconds at first read, at last read]
+        self.threads = {}
+        self.started_cpu = None
+        self.stop_event = threading.Event()
+        self.sampler = None
+
+    def start(self):
+        self.started_cpu = time.process_time()
+        self._read(initial=True)
+        self.sampler = threading.Thread(target=self._sample_loop, daemon=True, name="CpuSampler")
+        self.sampler.start()
+
+    def _sample_loop(self):
+        while not self.stop_event.wait(self.interval):
+            self._read()
+
+    def _read(self, initial: bool = False):
+        for thread in threading.enumerate():
+            cpu = profiler.thread_cpu_time(thread)
+            if cpu is None:
+                continue
+
+            entry = self.threads.get(thread.ident)
+            if entry is None or entry[0] != thread.name:
+                self.threads[thread.ident] = [thread.name, cpu if initial else 0.0, cpu]
+            else:
+                entry[2] = cpu
+
+    def stop(self) -> dict:
+        """
+        Stop sampling.
+
+        Returns:
+            Dictionary mapping component to CPU seconds, with the whole
+            process under 'process'
+        """
+        self.stop_event.set()
+        if self.sampler:
+            self.sampler.join()
+        self._read()
+
+        components = Counter()
+        for name, first, last in self.threads.values():
+            if name != "CpuSampler":
+                components[_component(name)] += last - first
+
+        result = {name: round(seconds, 3) for name, seconds in components.most_common()}
+        result['process'] = round(time.process_time() - self.started_cpu, 3)
+        return result
+
+
+class _Receipts:
+    """
+    Messages received by a target node, recorded in its message callback.
+    """
+
+    def __init__(self, counter):
+        """
+        Args:
+            counter: Shared multiprocessing value counting deliveries, read
+                     by the load generator to see when sending has drained
+        """
+        self.counter = counter
+        self.seen = set()
+        self.latencies = []
+        self.duplicates = 0
+        self.payload_bytes = 0
+        self.first_received = None
+        self.last_received = None
+        self.lock = threading.Lock()
+
+    def callback(self, sender_fingerprint: str, plaintext: str, timestamp: float):
+        # CLOCK_MONOTONIC is system-wide, so stamps from the sender process compare
+        received = time.monotonic_ns()
+        parts = plaintext.split(' ', 2)
+        if len(parts) < 3 or not parts[1].isdigit():
+            return
+
+        with self.lock:
+            if parts[0] in self.seen:
+                self.duplicates += 1
+                return
+            self.seen.add(parts[0])
+            self.latencies.append(received - int(parts[1]))
+            self.payload_bytes += len(plaintext)
+            if self.first_received is None:
+                self.first_received = received
+            self.last_received = received
+
+        with self.counter.get_lock():
+            self.counter.value += 1
+
+
+def _run_target(index: int, engine: str, listener_processes: int, port: int, private_key_pem: bytes,
+                public_key_pem: bytes, fingerprint: str, working_dir: str, max_workers: int,
+                default_limits: bool, counter, events, stop_event):
+    """
+    Run one target node until stop_event is set, then report what it received.
+
+    Args:
+        index: Target number, included in its events
+        engine: Server engine ('threads' or 'asyncio')
+        listener_processes: Listener processes sharing the port
+        port: Port to listen on
+        private_key_pem: Unencrypted PKCS8 PEM private key
+        public_key_pem: PEM public key
+        fingerprint: Target's key fingerprint
+        working_dir: Directory containing the keystore
+        max_workers: Connection threads of the threads engine
+        default_limits: Whether to keep the default per-IP rate limit, which
+                        all simulated peers share on loopback
+        counter: Shared value counting deliveries
+        events: Queue of events for the load generator
+        stop_event: Event set by the load generator to stop the node
+    """
+    # Server startup lines (also from listener processes) would mix with the JSON report
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
+    os.close(devnull)
+    os.chdir(working_dir)
+
+    receipts = _Receipts(counter)
+    sampler = _CpuSampler()
+
+    try:
+        keystore.preload_all_peer_keys()
+
+        server_kwargs = {}
+        if listener_processes == 1 and not default_limits:
+            server_kwargs['admission_control'] = admission.AdmissionControl(ip_rate=0)
+
+        server = network.create_server(
+            engine,
+            listener_processes,
+            host=HOST,
+            port=port,
+            private_key=crypto.load_private_key(private_key_pem, None),
+            public_key=crypto.load_public_key(public_key_pem),
+            fingerprint=fingerprint,
+            message_callback=receipts.callback,
+            max_workers=max_workers,
+            **server_kwargs
+        )
+        server.start()
+    except Exception as e:
+        events.put(('error', index, str(e)))
+        return
+
+    sampler.start()
+    events.put(('ready', index))
+    try:
+        stop_event.wait()
+    finally:
+        server.stop()
+        cpu = sampler.stop()
+
+        # Listener processes are reaped by stop()
+        children = os.times()
+        if listener_processes > 1:
+            cpu['listener_processes'] = round(children.children_user + children.children_system, 3)
+
+        with receipts.lock:
+            events.put(('report', index, {
+                'received': len(receipts.latencies),
+                'duplicates': receipts.duplicates,
+                'payload_bytes': receipts.payload_bytes,
+                'first_received': receipts.first_received,
+                'last_received': receipts.last_received,
+                'latencies_ns': receipts.latencies,
+                'validation': server.validation_stats(),
+                'cpu_seconds': cpu,
+                'metrics': metrics.summary(metrics.snapshot())
+            }))
+
+
+class _SimulatedPeer:
+    """
+    One simulated peer sending a pattern of messages over its own
+    persistent connections to the target nodes.
+    """
+
+    def __init__(self, index: int, identity: tuple, targets: list, pattern: str, messages: int, sizes: list,
+                 rate: float, burst_size: int, burst_pause: float, seed: int):
+        """
+        Args:
+            index: Peer number
+            identity: (private_key, public_key, fingerprint, private_key_pem)
+            targets: List of (host, port, fingerprint) tuples
+            pattern: One of PATTERNS
+            messages: Send operations to make (a broadcast is one operation)
+            sizes: Payload sizes in characters, drawn at random per message
+            rate: Send operations per second, 0 for as fast as possible
+            burst_size: Messages per burst
+            burst_pause: Seconds between bursts
+            seed: Random seed
+        """
+        self.index = index
+        self.private_key, _, self.fingerprint, _ = identity
+        self.targets = targets
+        self.pattern = pattern
+        self.messages = messages
+        self.sizes = sizes
+        self.rate = rate
+        self.burst_size = burst_size
+        self.burst_pause = burst_pause
+        self.random = random.Random(seed * 1000003 + index)
+
+        # Target port -> PeerConnection
+        self.connections = {}
+
+        # Target fingerprint -> messages handed to its socket
+        self.delivered = Counter()
+        self.operations = 0
+        self.errors = Counter()
+
+    def _payload(self, seq: int) -> str:
+        head = f"{self.index}.{seq} {time.monotonic_ns()} "
+        return head + "x" * max(0, self.random.choice(self.sizes) - len(head))
+
+    def _unicast(self, seq: int):
+        host, port, fingerprint = self.targets[(self.index + seq) % len(self.targets)]
+        plaintext = self._payload(seq)
+
+        try:
+            version, features = network.negotiate_features(host, port)
+            message_data = message.create_peer_message(
+                plaintext,
+                fingerprint,
+                keystore.load_peer_key(fingerprint),
+                self.private_key,
+                self.fingerprint,
+                version,
+                features
+            )
+
+            conn = self.connections.get(port)
+            if conn is None:
+                conn = self.connections[port] = network._connect_peer(host, port)
+            try:
+                conn.send(message_data)
+            except:
+                del self.connections[port]
+                conn.close()
+                raise
+        except (OSError, ValueError) as e:
+            self.errors[type(e).__name__] += 1
+            return
+        self.delivered[fingerprint] += 1
+
+    def _broadcast(self, seq: int):
+        results, errors = network.send_batch_messages(self.targets, self._payload(seq),
+                                                      self.private_key, self.fingerprint)
+        for fingerprint, success in results.items():
+            if success:
+                self.delivered[fingerprint] += 1
+        for error in errors.values():
+            self.errors[error.split(':')[0]] += 1
+
+    def run(self, start_event: threading.Event):
+        """
+        Send the peer's messages, paced by rate.
+        """
+        start_event.wait()
+        started = time.monotonic()
+
+        seq = 0
+        while self.operations < self.messages:
+            pattern = self.pattern
+            if pattern == 'mixed':
+                pattern = self.random.choice(('unicast', 'burst', 'broadcast'))
+
+            if pattern == 'unicast':
+                self._unicast(seq)
+                seq += 1
+                self.operations += 1
+            elif pattern == 'broadcast':
+                self._broadcast(seq)
+                seq += 1
+                self.operations += 1
+            else:
+                for _ in range(min(self.burst_size, self.messages - self.operations)):
+                    self._unicast(seq)
+                    seq += 1
+                    self.operations += 1
+                time.sleep(self.burst_pause)
+                continue
+
+            if self.rate:
+                delay = started + self.operations / self.rate - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+
+    def finish(self, timeout: float):
+        """
+        Wait until targets that send delivery acks processed everything, then close connections.
+        """
+        deadline = time.monotonic() + timeout
+        for conn in self.connections.values():
+            try:
+                conn.wait_delivered(conn.sent, max(deadline - time.monotonic(), 0.001))
+            except (OSError, ValueError):
+                pass
+            conn.close()
+        self.connections.clear()
+
+
+def _free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind((HOST, 0))
+        return sock.getsockname()[1]
+
+
+def _latency_summary(latencies: list) -> dict:
+    """
+    Compute latency percentiles.
+
+    Args:
+        latencies: Latencies in nanoseconds
+
+    Returns:
+        Dictionary with count and mean/p50/p90/p99/p999/max in milliseconds
+    """
+    if not latencies:
+        return {'count': 0}
+
+    latencies = sorted(latencies)
+
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] / 1e6
+
+    return {
+        'count': len(latencies),
+        'mean_ms': sum(latencies) / len(latencies) / 1e6,
+        'p50_ms': percentile(0.50),
+        'p90_ms': percentile(0.90),
+        'p99_ms': percentile(0.99),
+        'p999_ms': percentile(0.999),
+        'max_ms': latencies[-1] / 1e6
+    }
+
+
+def run_load(peers: int = 100, targets: int = 1, pattern: str = 'unicast', messages: int = 100, sizes=None,
+             rate: float = 0, burst_size: int = 20, burst_pause: float = 0.5, engine: str = 'threads',
+             listener_processes: int = 1, key_type: str = crypto.KEY_TYPE_RSA, keygen_processes: int = 0,
+             default_limits: bool = False, drain_timeout: float = DRAIN_TIMEOUT, seed: int = 0) -> dict:
+    """
+    Run a load test against fresh target nodes on loopback.
+
+    Args:
+        peers: Simulated sending peers, one thread each
+        targets: Target nodes, one process each
+        pattern: 'unicast' (round robin over targets), 'burst' (back-to-back
+                 unicast bursts), 'broadcast' (send_batch_messages to all
+                 targets) or 'mixed' (a random one of those per step)
+        messages: Send operations per peer
+        sizes: Payload sizes in characters, drawn at random per message
+               (default: 256, or 16 to 8192 for 'mixed')
+        rate: Send operations per second per peer, 0 for as fast as possible
+        burst_size: Messages per burst
+        burst_pause: Seconds between bursts
+        engine: Server engine of the targets ('threads' or 'asyncio')
+        listener_processes: Listener processes per target
+        key_type: Identity key type (default: rsa)
+        keygen_processes: Key generation processes, 0 for one per CPU
+        default_limits: Keep the default per-IP rate limit on the targets
+        drain_timeout: Seconds without new deliveries before giving up on the rest
+        seed: Random seed for targets and payload sizes
+
+    Returns:
+        Report dictionary
+
+    Raises:
+        ValueError: If an argument is out of range
+        RuntimeError: If a target node fails to start
+    """
+    if pattern not in PATTERNS:
+        raise ValueError(f"Unknown pattern: {pattern}")
+    if peers < 1 or targets < 1 or messages < 1:
+        raise ValueError("Peers, targets and messages must be at least 1")
+    sizes = sizes or (MIXED_SIZES if pattern == 'mixed' else DEFAULT_SIZES)
+    if not all(0 < size <= 10000 for size in sizes):
+        raise ValueError("Payload sizes must be between 1 and 10,000 characters")
+
+    context = multiprocessing.get_context('spawn')
+
+    with temporary_keystore() as work_dir:
+        print(f"Generating {peers + targets} {key_type} identities ...", file=sys.stderr, flush=True)
+        start = time.perf_counter()
+        identities = generate_identities(peers + targets, key_type, keygen_processes)
+        keygen_seconds = time.perf_counter() - start
+
+        # One connection thread per simulated peer on the threads engine
+        max_workers = peers + 16
+
+        events = context.Queue()
+        stop_event = context.Event()
+        counters = [context.Value('q', 0) for _ in range(targets)]
+        target_list = []
+        processes = []
+        for index, (_, public_key, fingerprint, private_key_pem) in enumerate(identities[:targets]):
+            port = _free_port()
+            target_list.append((HOST, port, fingerprint))
+            process = context.Process(
+                target=_run_target,
+                args=(index, engine, listener_processes, port, private_key_pem,
+                      crypto.serialize_public_key(public_key), fingerprint, work_dir, max_workers,
+                      default_limits, counters[index], events, stop_event),
+                name=f"EnclaveTarget-{index}"
+            )
+            process.start()
+            processes.append(process)
+
+        reports = {}
+        try:
+            for _ in range(targets):
+                try:
+                    event = events.get(timeout=START_TIMEOUT)
+                except Empty:
+                    raise RuntimeError("Target nodes did not start in time")
+                if event[0] == 'error':
+                    raise RuntimeError(f"Target node {event[1]} failed to start: {event[2]}")
+
+            for host, port, _ in target_list:
+                network.negotiate_version(host, port)
+
+            simulated = [
+                _SimulatedPeer(index, identity, target_list, pattern, messages, sizes,
+                               rate, burst_size, burst_pause, seed)
+                for index, identity in enumerate(identities[targets:])
+            ]
+            start_event = threading.Event()
+            threads = [threading.Thread(target=peer.run, args=(start_event,), daemon=True,
+                                        name=f"LoadPeer-{peer.index}")
+                       for peer in simulated]
+            for thread in threads:
+                thread.start()
+
+            print(f"Sending: {peers} peers, {targets} targets, {pattern} pattern, "
+                  f"{messages} operations each ...", file=sys.stderr, flush=True)
+            sampler = _CpuSampler()
+            sampler.start()
+            metrics.registry.reset()
+            started = time.monotonic_ns()
+            start_event.set()
+            for thread in threads:
+                thread.join()
+            send_seconds = (time.monotonic_ns() - started) / 1e9
+
+            for peer in simulated:
+                peer.finish(drain_timeout)
+
+            # Wait for deliveries until everything arrived or nothing more arrives
+            expected = sum((peer.delivered for peer in simulated), Counter())
+            expected_total = sum(expected.values())
+            received = -1
+            idle_since = time.monotonic()
+            while True:
+                current = sum(counter.value for counter in counters)
+                if current >= expected_total:
+                    break
+                if current != received:
+                    received = current
+                    idle_since = time.monotonic()
+                elif time.monotonic() - idle_since >= drain_timeout:
+                    break
+                time.sleep(0.05)
+
+            generator_cpu = sampler.stop()
+            generator_metrics = metrics.summary(metrics.snapshot())
+        finally:
+            stop_event.set()
+            while len(reports) < len(processes):
+                try:
+                    event = events.get(timeout=START_TIMEOUT)
+                except Empty:
+                    break
+                if event[0] == 'report':
+                    reports[event[1]] = event[2]
+            for process in processes:
+                process.join(timeout=15)
+                if process.is_alive():
+                    process.terminate()
+            network._connection_pool.close_all()
+
+    latencies = []
+    target_results = {}
+    cpu_seconds = {'load_generator': generator_cpu}
+    for index, (_, _, fingerprint) in enumerate(target_list):
+        report = reports.get(index, {})
+        latencies.extend(report.pop('latencies_ns', []))
+        cpu_seconds[f"target-{index}"] = report.pop('cpu_seconds', {})
+        report['expected'] = expected[fingerprint]
+        report['dropped'] = max(0, expected[fingerprint] - report.get('received', 0))
+        target_results[f"target-{index}"] = report
+
+    received_total = len(latencies)
+    last_received = max((r['last_received'] for r in reports.values() if r.get('last_received')), default=None)
+    elapsed = (last_received - started) / 1e9 if last_received else send_seconds
+    payload_bytes = sum(r.get('payload_bytes', 0) for r in reports.values())
+
+    return {
+        'config': {
+            'peers': peers, 'targets': targets, 'pattern': pattern, 'messages': messages, 'sizes': sizes,
+            'rate': rate, 'burst_size': burst_size, 'burst_pause': burst_pause, 'engine': engine,
+            'listener_processes': listener_processes, 'key_type': key_type, 'default_limits': default_limits
+        },
+        'results': {
+            'keygen_seconds': round(keygen_seconds, 3),
+            'send_seconds': round(send_seconds, 3),
+            'operations': sum(peer.operations for peer in simulated),
+            'sent': expected_total,
+            'send_errors': dict(sum((peer.errors for peer in simulated), Counter())),
+            'received': received_total,
+            'dropped': max(0, expected_total - received_total),
+            'duplicates': sum(r.get('duplicates', 0) for r in reports.values()),
+            'throughput_msgs_per_sec': received_total / elapsed if elapsed > 0 else 0.0,
+            'throughput_payload_mb_per_sec': payload_bytes / 1e6 / elapsed if elapsed > 0 else 0.0,
+            'latency': _latency_summary(latencies),
+            'cpu_seconds': cpu_seconds,
+            'generator_metrics': generator_metrics,
+            'targets': target_results
+        }
+    }
+
+
+def _print_summary(results: dict):
+    latency = results['latency']
+    errors = sum(results['send_errors'].values())
+    print(f"Sent {results['sent']} messages ({results['operations']} operations) in "
+          f"{results['send_seconds']:.2f}s, {errors} send errors", file=sys.stderr)
+    print(f"Received {results['received']} ({results['throughput_msgs_per_sec']:.0f} msg/s, "
+          f"{results['throughput_payload_mb_per_sec']:.2f} MB/s), {results['dropped']} dropped, "
+          f"{results['duplicates']} duplicates", file=sys.stderr)
+    if latency['count']:
+        print(f"Latency: p50 {latency['p50_ms']:.2f}ms  p90 {latency['p90_ms']:.2f}ms  "
+              f"p99 {latency['p99_ms']:.2f}ms  max {latency['max_ms']:.2f}ms", file=sys.stderr)
+    for name, components in results['cpu_seconds'].items():
+        busiest = ", ".join(f"{component} {seconds:.2f}s" for component, seconds in components.items())
+        print(f"CPU {name}: {busiest}", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Enclave end-to-end load generator")
+
+    parser.add_argument('--peers', type=int, default=100,
+                        help='Simulated sending peers (default: 100)')
+    parser.add_argument('--targets', type=int, default=1,
+                        help='Target nodes, one process each (default: 1)')
+    parser.add_argument('--pattern', choices=PATTERNS, default='unicast',
+                        help='Send pattern (default: unicast)')
+    parser.add_argument('--messages', type=int, default=100,
+                        help='Send operations per peer; a broadcast is one operation (default: 100)')
+    parser.add_argument('--sizes', type=int, nargs='+', default=None,
+                        help='Payload sizes in characters, drawn at random per message '
+                             '(default: 256, or 16 256 1024 8192 for mixed)')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='Send operations per second per peer, 0 for as fast as possible (default: 0)')
+    parser.add_argument('--burst-size', type=int, default=20,
+                        help='Messages per burst (default: 20)')
+    parser.add_argument('--burst-pause', type=float, default=0.5,
+                        help='Seconds between bursts (default: 0.5)')
+    parser.add_argument('--engine', choices=network.SERVER_ENGINES, default='threads',
+                        help='Server engine of the target nodes (default: threads)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Listener processes per target node (default: 1)')
+    parser.add_argument('--key-type', choices=crypto.KEY_TYPES, default=crypto.KEY_TYPE_RSA,
+                        help='Identity key type (default: rsa)')
+    parser.add_argument('--keygen-processes', type=int, default=0,
+                        help='Key generation processes, 0 for one per CPU (default: 0)')
+    parser.add_argument('--default-limits', action='store_true',
+                        help='Keep the default per-IP rate limit on targets; all peers share 127.0.0.1 '
+                             '(always kept with --workers above 1)')
+    parser.add_argument('--drain-timeout', type=float, default=DRAIN_TIMEOUT,
+                        help=f'Seconds without deliveries before counting the rest as dropped '
+                             f'(default: {DRAIN_TIMEOUT})')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Random seed (default: 0)')
+    parser.add_argument('--output', type=str, default=None,
+                        help='Write the JSON report to this file (default: stdout)')
+
+    args = parser.parse_args()
+
+    try:
+        report = run_load(args.peers, args.targets, args.pattern, args.messages, args.sizes, args.rate,
+                          args.burst_size, args.burst_pause, args.engine, args.workers, args.key_type,
+                          args.keygen_processes, args.default_limits, args.drain_timeout, args.seed)
+    except (ValueError, RuntimeError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    report['meta'] = {
+        'enclave': __version__,
+        'python': platform.python_version(),
+        'cryptography': cryptography.__version__,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'timestamp': time.time()
+    }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+    _print_summary(report['results'])
+
+
+if __name__ == "__main__":
+    main()
@@ -5,8 +5,9 @@ Main entry point for Enclave CLI application.
 import sys
 import argparse
 import getpass
+import threading
 from pathlib import Path
-from . import keystore, network, ui
+from . import addresses, daemon, keystore, network, outbox, presence, profiler, ui
 
 # Import web_server for GUI mode
 try:
@@ -28,9 +29,24 @@ Examples:
   # Generate new key pair
   enclave --generate
 
+  # Generate Ed25519/X25519 key pair (much faster than RSA-4096)
+  enclave --generate --key-type ed25519
+
   # Start chat server
   enclave --listen --port 8000
 
+  # Start background node (--listen and --web attach to it automatically)
+  enclave --daemon --port 8000
+
+  # Serve thousands of mostly idle peers from one event loop
+  enclave --daemon --port 8000 --engine asyncio
+
+  # Spread incoming connections over 4 listener processes
+  enclave --daemon --port 8000 --workers 4
+
+  # Profile the node for 2 minutes (reports in profiles/)
+  enclave --daemon --port 8000 --profile 120
+
   # Add peer's public key
   enclave --add-peer /path/to/peer_key.pem --peer-address 192.168.1.100:8000
         """
@@ -38,7 +54,10 @@ Examples:
 
     # Arguments
     parser.add_argument('--generate', action='store_true',
-                       help='Generate new RSA-4096 key pair')
+                       help='Generate new key pair')
+
+    parser.add_argument('--key-type', choices=['rsa', 'ed25519'], default='rsa',
+                       help='Key type for --generate: RSA-4096 or Ed25519/X25519 (default: rsa)')
 
     parser.add_argument('--listen', action='store_true',
                        help='Start chat server (CLI mode)')
@@ -46,6 +65,12 @@ Examples:
     parser.add_argument('--web', action='store_true',
                        help='Start web GUI (modern WhatsApp-like interface)')
 
+    parser.add_argument('--daemon', action='store_true',
+                       help='Start long-running node with a local API for the CLI, web GUI and scripts')
+
+    parser.add_argument('--socket', type=str, default=str(daemon.SOCKET_PATH),
+                       help=f'Unix socket for the daemon API (default: {daemon.SOCKET_PATH})')
+
     parser.add_argument('--port', type=int, default=8000,
                        help='Port number for P2P server (default: 8000)')
 
@@ -55,14 +80,43 @@ Examples:
     parser.add_argument('--host', type=str, default='0.0.0.0',
                        help='IP address to bind server (default: 0.0.0.0)')
 
+    parser.add_argument('--crypto-processes', type=int, default=0, metavar='N',
+                       help='Verify and decrypt incoming messages in N processes (default: 0, use threads)')
+
+    parser.add_argument('--engine', choices=network.SERVER_ENGINES, default='threads',
+                       help='P2P server engine: a thread per connection, or asyncio for thousands of '
+                            'mostly idle peers (default: threads)')
+
+    parser.add_argument('--workers', type=int, default=1, metavar='N',
+                       help='Run the P2P server in N processes sharing the port through SO_REUSEPORT '
+                            '(default: 1)')
+
+    parser.add_argument('--profile', type=float, nargs='?', const=profiler.DEFAULT_DURATION, metavar='SECONDS',
+                       help='Sample stacks, allocations and per-thread CPU once started, for SECONDS '
+                            f'(default: {profiler.DEFAULT_DURATION}, at most {profiler.MAX_DURATION}); '
+                            f'reports are written to {profiler.PROFILE_DIR}/')
+
     parser.add_argument('--add-peer', type=str, metavar='KEY_PATH',
                        help='Add peer\'s public key')
 
     parser.add_argument('--peer-address', type=str, metavar='ADDRESS',
-                       help='Peer\'s address in format host:port (used with --add-peer)')
+                       help='Peer\'s address in format host:port, or several separated by commas '
+                            '(IPv6 as [addr]:port), fastest working one preferred (used with --add-peer)')
 
     args = parser.parse_args()
 
+    if args.workers < 1:
+        print("Error: --workers must be at least 1")
+        sys.exit(1)
+
+    if args.workers > 1 and args.crypto_processes:
+        print("Error: --workers cannot be combined with --crypto-processes")
+        sys.exit(1)
+
+    if args.profile is not None and not 0 < args.profile <= profiler.MAX_DURATION:
+        print(f"Error: --profile must be between 0 and {profiler.MAX_DURATION} seconds")
+        sys.exit(1)
+
     # Validate port range
     if args.port < 1024 or args.port > 65535:
         print("Error: Port must be between 1024 and 65535")
@@ -71,7 +125,7 @@ Examples:
     try:
         # Handle --generate mode
         if args.generate:
-            handle_generate()
+            handle_generate(args.key_type)
             return
 
         # Handle --add-peer mode
@@ -82,9 +136,16 @@ Examples:
             handle_add_peer(args.add_peer, args.peer_address)
             return
 
+        # Handle --daemon mode
+        if args.daemon:
+            start_daemon(args.host, args.port, args.socket, args.crypto_processes, args.engine, args.workers,
+                         args.profile)
+            return
+
         # Handle --web mode
         if args.web:
-            start_web_gui(args.host, args.web_port)
+            start_web_gui(args.host, args.web_port, args.port, args.socket, args.engine, args.workers,
+                          args.profile)
             return
 
         # Normal chat mode requires --listen
@@ -94,7 +155,8 @@ Examples:
             sys.exit(1)
 
         # Start chat mode
-        start_chat(args.host, args.port)
+        start_chat(args.host, args.port, args.crypto_processes, args.socket, args.engine, args.workers,
+                   args.profile)
 
     except KeyboardInterrupt:
         print("\nExiting...")
@@ -106,11 +168,17 @@ Examples:
         sys.exit(1)
 
 
-def handle_generate():
+def handle_generate(key_type: str = 'rsa'):
     """
     Handle key generation mode.
+
+    Args:
+        key_type: 'rsa' or 'ed25519'
     """
-    print("Generating RSA-4096 key pair...")
+    if key_type == 'ed25519':
+        print("Generating Ed25519/X25519 key pair...")
+    else:
+        print("Generating RSA-4096 key pair...")
     print()
 
     # Prompt for password
@@ -126,7 +194,7 @@ def handle_generate():
         sys.exit(1)
 
     # Generate and save keys
-    fingerprint = keystore.generate_and_save_keys(password)
+    fingerprint = keystore.generate_and_save_keys(password, key_type)
 
     print()
     print("Share this fingerprint with your peers to establish secure communication:")
@@ -139,25 +207,20 @@ def handle_add_peer(key_path: str, peer_address: str):
 
     Args:
         key_path: Path to peer's public key file
-        peer_address: Peer's address (host:port)
+        peer_address: Peer's address (host:port), or several separated by commas
     """
     # Validate address format
-    if ':' not in peer_address:
+    try:
+        peer_addresses = addresses.parse_address_list(peer_address)
+    except ValueError:
         print("Error: Invalid address format. Use host:port")
         sys.exit(1)
 
-    try:
-        host, port_str = peer_address.rsplit(':', 1)
-        port = int(port_str)
-
-        if port < 1024 or port > 65535:
+    for host, port in peer_addresses:
+        if port < 1024:
             print("Error: Port must be between 1024 and 65535")
             sys.exit(1)
 
-    except ValueError:
-        print("Error: Invalid address format. Use host:port")
-        sys.exit(1)
-
     # Add peer key
     try:
         fingerprint = keystore.add_peer_key(key_path)
@@ -166,23 +229,36 @@ def handle_add_peer(key_path: str, peer_address: str):
         peers_dir = Path("keys/peers")
         peers_dir.mkdir(parents=True, exist_ok=True)
         address_file = peers_dir / f"{fingerprint}.address"
-        address_file.write_text(peer_address)
+        address_file.write_text(", ".join(addresses.format_address(host, port) for host, port in peer_addresses))
 
-        print(f"Peer address saved: {host}:{port}")
+        for host, port in peer_addresses:
+            print(f"Peer address saved: {addresses.format_address(host, port)}")
 
     except FileNotFoundError as e:
         print(f"Error: {e}")
         sys.exit(1)
 
 
-def start_chat(host: str, port: int):
+def start_chat(host: str, port: int, crypto_processes: int = 0, socket_path=daemon.SOCKET_PATH,
+               engine: str = 'threads', listener_processes: int = 1, profile: float = None):
     """
     Start chat server and interactive session.
+    Attaches to a running daemon instead if one is listening on socket_path.
 
     Args:
         host: IP address to bind
         port: Port number to listen on
+        crypto_processes: Number of crypto worker processes (0 uses threads)
+        socket_path: Daemon socket to attach to if running
+        engine: P2P server engine ('threads' or 'asyncio')
+        listener_processes: Number of P2P server processes sharing the port
+        profile: Seconds to profile this process for once started (optional)
     """
+    client = daemon.connect(socket_path)
+    if client:
+        attach_chat(client)
+        return
+
     # Prompt for password
     password = getpass.getpass("Enter password to unlock private key: ")
 
@@ -198,56 +274,144 @@ def start_chat(host: str, port: int):
     keystore.preload_all_peer_keys()
 
     # Load peer addresses from files
-    peers = {}
-    peers_dir = Path("keys/peers")
-
-    if peers_dir.exists():
-        for address_file in peers_dir.glob("*.address"):
-            fingerprint = address_file.stem
-            address = address_file.read_text().strip()
-
-            # Parse address
-            if ':' in address:
-                peer_host, peer_port_str = address.rsplit(':', 1)
-                try:
-                    peer_port = int(peer_port_str)
-                    peers[fingerprint] = (peer_host, peer_port)
-                except ValueError:
-                    print(f"Warning: Invalid address for peer {fingerprint[:12]}: {address}")
-
-    # Create message callback
+    peers = daemon.load_peer_addresses()
+
+    # Create message and file callbacks
     message_callback = ui.create_message_callback()
+    file_callback = ui.create_file_callback()
 
     # Create and start server with optimized settings
-    server = network.ChatServer(
+    server = network.create_server(
+        engine,
+        listener_processes,
         host=host,
         port=port,
         private_key=private_key,
         public_key=public_key,
         fingerprint=my_fingerprint,
         message_callback=message_callback,
-        max_workers=20  # ThreadPoolExecutor with 20 workers
+        max_workers=20,  # ThreadPoolExecutor with 20 workers
+        crypto_processes=crypto_processes,
+        file_callback=file_callback,
+        replay_cache_path=keystore.REPLAY_CACHE_PATH
     )
 
+    # Peers are heartbeated so messages for peers that are down wait in the outbox
+    peer_presence = presence.PresenceMonitor()
+    peer_presence.set_peers(peers)
+
+    # Outgoing messages are queued on disk and delivered in the background
+    message_outbox = outbox.Outbox(private_key, my_fingerprint, delivery_callback=ui.create_delivery_callback(),
+                                   presence=peer_presence)
+
     try:
         server.start()
+        peer_presence.start()
+        message_outbox.start()
+        if profile:
+            profiler.start(profile)
 
         # Start interactive chat session
-        ui.start_chat_session(server, my_fingerprint, private_key, peers)
+        ui.start_chat_session(server, my_fingerprint, private_key, peers, outbox=message_outbox,
+                              presence=peer_presence)
 
     except KeyboardInterrupt:
         print("\nExiting...")
     finally:
+        profiler.finish()
+        message_outbox.stop()
+        peer_presence.stop()
         server.stop()
 
 
-def start_web_gui(host: str, web_port: int):
+def attach_chat(client):
+    """
+    Start interactive session attached to a running daemon.
+
+    Args:
+        client: Connected DaemonClient
+    """
+    info = client.call('info')
+    peers = {fp: (host, port) for fp, (host, port) in client.call('peers').items()}
+
+    print("Attached to Enclave daemon")
+    client.subscribe(ui.create_message_callback(), ui.create_file_callback(), ui.create_delivery_callback())
+
+    ui.start_chat_session(None, info['fingerprint'], None, peers, client=client)
+
+
+def start_daemon(host: str, port: int, socket_path, crypto_processes: int = 0, engine: str = 'threads',
+                 listener_processes: int = 1, profile: float = None):
+    """
+    Start long-running node daemon.
+
+    Args:
+        host: IP address to bind
+        port: Port number for P2P server
+        socket_path: Unix socket path for the daemon API
+        crypto_processes: Number of crypto worker processes (0 uses threads)
+        engine: P2P server engine ('threads' or 'asyncio')
+        listener_processes: Number of P2P server processes sharing the port
+        profile: Seconds to profile the daemon for once started (optional)
+    """
+    # Do not ask for the password just to find the socket taken
+    client = daemon.connect(socket_path)
+    if client:
+        client.close()
+        print(f"Error: A daemon is already running on {socket_path}")
+        sys.exit(1)
+
+    # Prompt for password (only once for the lifetime of the daemon)
+    password = getpass.getpass("Enter password to unlock private key: ")
+
+    try:
+        private_key, public_key, my_fingerprint = keystore.load_my_keys(password)
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+
+    node = daemon.NodeDaemon(
+        host=host,
+        port=port,
+        private_key=private_key,
+        public_key=public_key,
+        fingerprint=my_fingerprint,
+        socket_path=socket_path,
+        crypto_processes=crypto_processes,
+        engine=engine,
+        listener_processes=listener_processes
+    )
+
+    try:
+        node.start()
+    except RuntimeError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    if profile:
+        profiler.start(profile)
+
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        print("\nExiting...")
+    finally:
+        profiler.finish()
+        node.stop()
+
+
+def start_web_gui(host: str, web_port: int, p2p_port: int = 8000, socket_path=daemon.SOCKET_PATH,
+                  engine: str = 'threads', listener_processes: int = 1, profile: float = None):
     """
     Start web GUI interface.
 
     Args:
         host: IP address to bind
         web_port: Port for web interface
+        p2p_port: Port for P2P server
+        socket_path: Daemon socket to attach to if running
+        engine: P2P server engine ('threads' or 'asyncio')
+        listener_processes: Number of P2P server processes sharing the port
+        profile: Seconds to profile this process for once started (optional)
     """
     if not WEB_AVAILABLE:
         print("Error: Web dependencies not installed")
@@ -265,7 +429,9 @@ def start_web_gui(host: str, web_port: int):
     """)
 
     try:
-        web_server.start_web_server(host=host, port=web_port)
+        web_server.start_web_server(host=host, port=web_port, p2p_port=p2p_port,
+                                    client=daemon.connect(socket_path), engine=engine,
+                                    listener_processes=listener_processes, profile=profile)
     except KeyboardInterrupt:
         print("\n\n✓ Web GUI shut down gracefully")
 
@@ -1,22 +1,103 @@
 """
 Message protocol module for Enclave.
 Handles message structure, serialization, and replay protection.
+
+Two envelope formats are understood:
+- Version 1 is a msgpack map; its signature covers the map re-serialized
+  without the signature field.
+- Version 2 starts with a fixed binary header (16-byte message ID, 32-byte
+  fingerprint, integer millisecond timestamp) followed by a msgpack body.
+  The signature is appended after the body and covers the raw header and
+  body bytes, so they are verified in place without re-serialization.
+
+Version 2 is only sent to peers that announced it in a hello frame, and
+session and multi-recipient envelopes only to peers that announced the
+'session' and 'multi' features; other peers get classic per-message
+envelopes.
 """
 
+import os
 import time
 import uuid
+import struct
 import msgpack
-import threading
-from collections import deque
-from . import crypto
+from . import crypto, metrics, replay, session
+
+
+# Envelope versions this node can parse, in order of preference
+PROTOCOL_VERSIONS = (2, 1)
+
+# First byte of a version 2 envelope. msgpack never emits 0xC1, so it
+# cannot be confused with a version 1 map or a control frame.
+ENVELOPE_V2_MAGIC = 0xC1
+
+# Control frames (first payload byte below 0x80)
+FRAME_HELLO = 0x05   # Announces supported envelope versions and features
+FRAME_BATCH = 0x06   # Several length-prefixed envelopes in one frame
+FRAME_ACK = 0x07     # Cumulative delivery ack and send credit (receiver to sender)
+
+# Optional frame and envelope types announced in the hello frame
+FEATURES = ('batch', 'ack', 'session', 'multi')
+
+# Largest frame a receiver accepts; longer length prefixes are rejected
+# before anything is allocated
+MAX_FRAME_SIZE = 4 * 1024 * 1024
+
+# Accepted difference between an envelope's timestamp and our clock (seconds)
+MAX_CLOCK_SKEW = 300
+
+# Fingerprints are hex SHA-256 digests
+_FINGERPRINT_SIZE = 32
 
+_BATCH_LENGTH = struct.Struct('!I')
 
-# Message ID deque for duplicate detection (thread-safe)
-_seen_message_ids = deque(maxlen=10000)
-_seen_ids_lock = threading.Lock()
+# Ack frame: type, sequence number of the last processed frame, frames the
+# sender may have outstanding beyond it
+_DELIVERY_ACK = struct.Struct('!BQI')
 
+# Version 2 header: magic, kind, key type, message ID, sender fingerprint,
+# timestamp in milliseconds, body length
+_V2_HEADER = struct.Struct('!BBB16s32sqI')
+_V2_KINDS = {None: 0, 'multi': 1, 'session': 2}
+_V2_KIND_NAMES = {code: kind for kind, code in _V2_KINDS.items()}
+_V2_KEY_TYPES = (crypto.KEY_TYPE_RSA, crypto.KEY_TYPE_ED25519)
 
-def create_message(plaintext: str, recipient_public_key, sender_private_key, sender_fingerprint: str) -> bytes:
+# AES-GCM nonce and tag sizes in version 2 session envelopes
+_NONCE_SIZE = 12
+_TAG_SIZE = 16
+
+# Replay cache for duplicate detection (thread-safe)
+_replay_cache = replay.ReplayCache()
+
+
+def _pack_v2_head(kind: str, sender_private_key, sender_fingerprint: str, body: list) -> bytes:
+    """
+    Serialize the header and body of a version 2 envelope.
+
+    Args:
+        kind: Envelope type (None, 'multi' or 'session')
+        sender_private_key: Sender's private key
+        sender_fingerprint: Sender's key fingerprint (64 hex characters)
+        body: Type-specific fields
+
+    Returns:
+        Header and body bytes (covered by the signature or AES-GCM tag)
+    """
+    body_bytes = msgpack.packb(body, use_bin_type=True)
+    header = _V2_HEADER.pack(
+        ENVELOPE_V2_MAGIC,
+        _V2_KINDS[kind],
+        _V2_KEY_TYPES.index(crypto.get_key_type(sender_private_key)),
+        uuid.uuid4().bytes,
+        bytes.fromhex(sender_fingerprint),
+        int(time.time() * 1000),
+        len(body_bytes)
+    )
+    return header + body_bytes
+
+
+def create_message(plaintext: str, recipient_public_key, sender_private_key, sender_fingerprint: str,
+                   version: int = 1) -> bytes:
     """
     Create encrypted and signed message envelope.
 
@@ -25,6 +106,7 @@ def create_message(plaintext: str, recipient_public_key, sender_private_key, sen
         recipient_public_key: Recipient's RSA public key
         sender_private_key: Sender's RSA private key
         sender_fingerprint: Sender's key fingerprint
+        version: Envelope version negotiated with the recipient (default: 1)
 
     Returns:
         Serialized message bytes
@@ -36,21 +118,32 @@ def create_message(plaintext: str, recipient_public_key, sender_private_key, sen
     if len(plaintext) > 10000:
         raise ValueError("Message too large (max 10,000 chars)")
 
+    # Encrypt message using hybrid encryption
+    encrypted_components = crypto.encrypt_message(plaintext, recipient_public_key)
+
+    if version == 2:
+        # Signature covers the raw header and body bytes
+        signed = _pack_v2_head(None, sender_private_key, sender_fingerprint, [
+            encrypted_components['encrypted_key'],
+            encrypted_components['nonce'],
+            encrypted_components['tag'],
+            encrypted_components['ciphertext']
+        ])
+        return signed + crypto.sign_message(signed, sender_private_key)
+
     # Generate unique message ID
     message_id = str(uuid.uuid4())
 
     # Get current timestamp
     timestamp = time.time()
 
-    # Encrypt message using hybrid encryption
-    encrypted_components = crypto.encrypt_message(plaintext, recipient_public_key)
-
     # Build envelope (without signature)
     envelope = {
         'version': 1,
         'message_id': message_id,
         'timestamp': timestamp,
         'sender_fingerprint': sender_fingerprint,
+        'key_type': crypto.get_key_type(sender_private_key),
         'encrypted_key': encrypted_components['encrypted_key'],
         'ciphertext': encrypted_components['ciphertext'],
         'nonce': encrypted_components['nonce'],
@@ -72,12 +165,193 @@ def create_message(plaintext: str, recipient_public_key, sender_private_key, sen
     return final_envelope_bytes
 
 
+def create_multi_message(plaintext: str, recipient_public_keys: dict, sender_private_key,
+                         sender_fingerprint: str, version: int = 1) -> bytes:
+    """
+    Create one encrypted and signed envelope for several recipients.
+    The body is encrypted once, the AES key is wrapped for each recipient
+    and a single signature covers the whole envelope.
+
+    Args:
+        plaintext: Message text to send
+        recipient_public_keys: Dictionary mapping recipient fingerprint to RSA public key
+        sender_private_key: Sender's RSA private key
+        sender_fingerprint: Sender's key fingerprint
+        version: Envelope version supported by all recipients (default: 1)
+
+    Returns:
+        Serialized message bytes
+
+    Raises:
+        ValueError: If plaintext exceeds 10,000 characters
+    """
+    # Check message size limit
+    if len(plaintext) > 10000:
+        raise ValueError("Message too large (max 10,000 chars)")
+
+    # Encrypt body once with a fresh AES key
+    aes_key = os.urandom(32)
+    encrypted_components = crypto.encrypt_with_key(plaintext, aes_key)
+
+    # Wrap AES key for each recipient
+    encrypted_keys = {
+        fingerprint: crypto.wrap_key(aes_key, public_key)
+        for fingerprint, public_key in recipient_public_keys.items()
+    }
+
+    if version == 2:
+        signed = _pack_v2_head('multi', sender_private_key, sender_fingerprint, [
+            {bytes.fromhex(fingerprint): encrypted_key for fingerprint, encrypted_key in encrypted_keys.items()},
+            encrypted_components['nonce'],
+            encrypted_components['tag'],
+            encrypted_components['ciphertext']
+        ])
+        return signed + crypto.sign_message(signed, sender_private_key)
+
+    # Build envelope (without signature)
+    envelope = {
+        'version': 1,
+        'type': 'multi',
+        'message_id': str(uuid.uuid4()),
+        'timestamp': time.time(),
+        'sender_fingerprint': sender_fingerprint,
+        'key_type': crypto.get_key_type(sender_private_key),
+        'encrypted_keys': encrypted_keys,
+        'ciphertext': encrypted_components['ciphertext'],
+        'nonce': encrypted_components['nonce'],
+        'tag': encrypted_components['tag']
+    }
+
+    # Sign the serialized envelope once for all recipients
+    envelope_bytes = msgpack.packb(envelope, use_bin_type=True)
+    envelope['signature'] = crypto.sign_message(envelope_bytes, sender_private_key)
+
+    return msgpack.packb(envelope, use_bin_type=True)
+
+
+def create_session_message(plaintext: str, recipient_fingerprint: str, recipient_public_key,
+                           sender_private_key, sender_fingerprint: str, version: int = 1) -> bytes:
+    """
+    Create message envelope encrypted with the per-peer session key.
+    Only the first message of a session pays for RSA operations.
+
+    Args:
+        plaintext: Message text to send
+        recipient_fingerprint: Recipient's key fingerprint
+        recipient_public_key: Recipient's RSA public key
+        sender_private_key: Sender's RSA private key
+        sender_fingerprint: Sender's key fingerprint
+        version: Envelope version negotiated with the recipient (default: 1)
+
+    Returns:
+        Serialized message bytes
+
+    Raises:
+        ValueError: If plaintext exceeds 10,000 characters
+    """
+    # Check message size limit
+    if len(plaintext) > 10000:
+        raise ValueError("Message too large (max 10,000 chars)")
+
+    # Get session with recipient (creates or rekeys if needed)
+    current_session = session.get_outgoing_session(
+        recipient_fingerprint,
+        recipient_public_key,
+        sender_private_key,
+        sender_fingerprint
+    )
+
+    if version == 2:
+        header = current_session.header
+        authenticated = _pack_v2_head('session', sender_private_key, sender_fingerprint, [
+            header['session_id'],
+            header['created'],
+            header['encrypted_key'],
+            header['signature']
+        ])
+
+        # No signature: the AES-GCM tag authenticates the raw header and body
+        encrypted_components = crypto.encrypt_with_key(plaintext, current_session.key, authenticated)
+        return b''.join([
+            authenticated,
+            encrypted_components['nonce'],
+            encrypted_components['ciphertext'],
+            encrypted_components['tag']
+        ])
+
+    envelope = {
+        'version': 1,
+        'type': 'session',
+        'message_id': str(uuid.uuid4()),
+        'timestamp': time.time(),
+        'sender_fingerprint': sender_fingerprint,
+        'key_type': crypto.get_key_type(sender_private_key),
+        'session': current_session.header
+    }
+
+    # Encrypt with session key, authenticating the envelope header
+    encrypted_components = crypto.encrypt_with_key(
+        plaintext,
+        current_session.key,
+        _session_associated_data(envelope)
+    )
+    envelope.update(encrypted_components)
+
+    return msgpack.packb(envelope, use_bin_type=True)
+
+
+def create_peer_message(plaintext: str, recipient_fingerprint: str, recipient_public_key, sender_private_key,
+                        sender_fingerprint: str, version: int = 1, features=frozenset()) -> bytes:
+    """
+    Create the cheapest envelope a peer can read: a session envelope if the
+    peer announced 'session', otherwise a classic per-message envelope.
+
+    Args:
+        plaintext: Message text to send
+        recipient_fingerprint: Recipient's key fingerprint
+        recipient_public_key: Recipient's public key
+        sender_private_key: Sender's private key
+        sender_fingerprint: Sender's key fingerprint
+        version: Envelope version negotiated with the recipient (default: 1)
+        features: Features negotiated with the recipient (default: none)
+
+    Returns:
+        Serialized message bytes
+
+    Raises:
+        ValueError: If plaintext exceeds 10,000 characters
+    """
+    if 'session' in features:
+        return create_session_message(plaintext, recipient_fingerprint, recipient_public_key,
+                                      sender_private_key, sender_fingerprint, version)
+    return create_message(plaintext, recipient_public_key, sender_private_key, sender_fingerprint, version)
+
+
+def _session_associated_data(envelope: dict) -> bytes:
+    """
+    Serialize envelope fields authenticated by the session AES-GCM tag.
+
+    Args:
+        envelope: Session message envelope
+
+    Returns:
+        Associated data bytes
+    """
+    return msgpack.packb([
+        envelope['message_id'],
+        envelope['timestamp'],
+        envelope['sender_fingerprint'],
+        envelope['session']['session_id']
+    ], use_bin_type=True)
+
+
 def parse_message(data: bytes) -> dict:
     """
     Parse and validate message envelope.
 
     Args:
-        data: Serialized message bytes
+        data: Serialized message bytes or memoryview, e.g. into a pooled
+              receive buffer; version 2 envelopes are parsed without copying
 
     Returns:
         Envelope dictionary
@@ -86,17 +360,42 @@ def parse_message(data: bytes) -> dict:
         ValueError: If message format is invalid
     """
     try:
+        if data[0] == ENVELOPE_V2_MAGIC:
+            return _parse_v2(data)
+
         # Deserialize message
         envelope = msgpack.unpackb(data, raw=False)
 
         # Validate required fields
-        required_fields = ['version', 'message_id', 'timestamp', 'sender_fingerprint',
-                          'encrypted_key', 'ciphertext', 'nonce', 'tag', 'signature']
+        if envelope.get('type') == 'session':
+            required_fields = ['version', 'message_id', 'timestamp', 'sender_fingerprint',
+                              'session', 'ciphertext', 'nonce', 'tag']
+        elif envelope.get('type') == 'multi':
+            required_fields = ['version', 'message_id', 'timestamp', 'sender_fingerprint',
+                              'encrypted_keys', 'ciphertext', 'nonce', 'tag', 'signature']
+        else:
+            required_fields = ['version', 'message_id', 'timestamp', 'sender_fingerprint',
+                              'encrypted_key', 'ciphertext', 'nonce', 'tag', 'signature']
 
         for field in required_fields:
             if field not in envelope:
                 raise ValueError(f"Missing required field: {field}")
 
+        if envelope.get('type') == 'session':
+            if not isinstance(envelope['session'], dict):
+                raise ValueError("Invalid session header")
+            for field in ['session_id', 'created', 'sender_fingerprint', 'encrypted_key', 'signature']:
+                if field not in envelope['session']:
+                    raise ValueError(f"Missing required session field: {field}")
+
+        # Fields used before the signature is checked must have the right type
+        if not _is_message_id(envelope['message_id']):
+            raise ValueError("Invalid message ID")
+        if not isinstance(envelope['timestamp'], (int, float)) or isinstance(envelope['timestamp'], bool):
+            raise ValueError("Invalid timestamp")
+        if not _is_fingerprint(envelope['sender_fingerprint']):
+            raise ValueError("Invalid sender fingerprint")
+
         # Validate protocol version
         if envelope['version'] != 1:
             raise ValueError(f"Unsupported protocol version: {envelope['version']}")
@@ -107,14 +406,140 @@ def parse_message(data: bytes) -> dict:
         raise ValueError(f"Invalid message format: {str(e)}")
 
 
-def verify_and_decrypt(envelope: dict, sender_public_key, my_private_key) -> str:
+def _is_message_id(value) -> bool:
+    """
+    Check that a value is a message ID the replay cache accepts (a string or 16 bytes).
+    """
+    return isinstance(value, str) or (isinstance(value, bytes) and len(value) == 16)
+
+
+def _is_fingerprint(value) -> bool:
+    """
+    Check that a value is a hex SHA-256 fingerprint (and so safe to use in key file names).
+    """
+    try:
+        return isinstance(value, str) and len(bytes.fromhex(value)) == _FINGERPRINT_SIZE
+    except ValueError:
+        return False
+
+
+def check_timestamp(timestamp: float, now: float = None):
+    """
+    Check that an envelope timestamp is within MAX_CLOCK_SKEW of our clock.
+
+    Args:
+        timestamp: Envelope timestamp
+        now: Current time (default: time.time())
+
+    Raises:
+        ValueError: If the timestamp is too old or too far in the future
+    """
+    if now is None:
+        now = time.time()
+
+    if timestamp > now + MAX_CLOCK_SKEW:
+        raise ValueError("Message timestamp too far in future")
+
+    if timestamp < now - MAX_CLOCK_SKEW:
+        raise ValueError("Message timestamp too old")
+
+
+def claimed_sender(data: bytes) -> str:
+    """
+    Read the sender fingerprint an envelope claims, without validating the
+    envelope or verifying anything. Meant for cheap checks before crypto.
+
+    Args:
+        data: Serialized message bytes
+
+    Returns:
+        Claimed sender fingerprint, or None if it cannot be read
+    """
+    try:
+        if data[0] == ENVELOPE_V2_MAGIC:
+            return _V2_HEADER.unpack_from(data)[4].hex()
+
+        sender = msgpack.unpackb(data, raw=False).get('sender_fingerprint')
+        return sender if isinstance(sender, str) else None
+    except Exception:
+        return None
+
+
+def _parse_v2(data: bytes) -> dict:
+    """
+    Parse version 2 envelope into the same dictionary layout as version 1.
+    Binary IDs and fingerprints are converted only where callers expect
+    strings; the signed bytes are kept as a memoryview into data.
+
+    Args:
+        data: Serialized message bytes starting with ENVELOPE_V2_MAGIC
+
+    Returns:
+        Envelope dictionary with 'version' 2 and 'signed' bytes
+
+    Raises:
+        ValueError: If message format is invalid
+    """
+    view = memoryview(data)
+    _, kind, key_type, message_id, fingerprint, timestamp_ms, body_length = _V2_HEADER.unpack_from(view)
+
+    body_end = _V2_HEADER.size + body_length
+    if body_end > len(view):
+        raise ValueError("Truncated envelope body")
+
+    if kind not in _V2_KIND_NAMES or key_type >= len(_V2_KEY_TYPES):
+        raise ValueError("Unknown envelope kind or key type")
+
+    body = msgpack.unpackb(view[_V2_HEADER.size:body_end], raw=False)
+    if not isinstance(body, list) or len(body) != 4:
+        raise ValueError("Malformed envelope body")
+
+    envelope = {
+        'version': 2,
+        'message_id': message_id,
+        'timestamp': timestamp_ms / 1000,
+        'sender_fingerprint': fingerprint.hex(),
+        'key_type': _V2_KEY_TYPES[key_type],
+        'signed': view[:body_end]
+    }
+    trailer = view[body_end:]
+
+    envelope_type = _V2_KIND_NAMES[kind]
+    if envelope_type is not None:
+        envelope['type'] = envelope_type
+
+    if envelope_type == 'session':
+        if len(trailer) < _NONCE_SIZE + _TAG_SIZE:
+            raise ValueError("Truncated session ciphertext")
+
+        session_id, created, encrypted_key, signature = body
+        envelope['session'] = {
+            'session_id': session_id,
+            'created': created,
+            'sender_fingerprint': envelope['sender_fingerprint'],
+            'encrypted_key': encrypted_key,
+            'signature': signature
+        }
+        envelope['nonce'] = bytes(trailer[:_NONCE_SIZE])
+        envelope['ciphertext'] = bytes(trailer[_NONCE_SIZE:-_TAG_SIZE])
+        envelope['tag'] = bytes(trailer[-_TAG_SIZE:])
+        return envelope
+
+    encrypted_key, envelope['nonce'], envelope['tag'], envelope['ciphertext'] = body
+    envelope['encrypted_keys' if envelope_type == 'multi' else 'encrypted_key'] = encrypted_key
+    envelope['signature'] = trailer
+    return envelope
+
+
+def verify_and_decrypt(envelope: dict, sender_public_key, my_private_key, my_fingerprint: str = None) -> str:
     """
-    Verify signature, check timestamp, and decrypt message.
+    Check timestamp, verify signature, and decrypt message.
 
     Args:
         envelope: Parsed message envelope
         sender_public_key: Sender's RSA public key
         my_private_key: Recipient's RSA private key
+        my_fingerprint: Recipient's key fingerprint (required for multi-recipient envelopes)
 
     Returns:
         Decrypted plaintext message
@@ -122,57 +547,279 @@ def verify_and_decrypt(envelope: dict, sender_public_key, my_private_key) -> str
     Raises:
         ValueError: If verification or decryption fails
     """
+    # Envelopes without key_type come from RSA-only clients
+    if envelope.get('key_type', crypto.KEY_TYPE_RSA) != crypto.get_key_type(sender_public_key):
+        raise ValueError("Sender key type mismatch")
+
+    if envelope.get('type') == 'session':
+        return _verify_and_decrypt_session(envelope, sender_public_key, my_private_key)
+
+    # Cheap checks first: timestamp window and recipient, then the signature
+    check_timestamp(envelope['timestamp'])
+
+    # Pick our wrapped key from a multi-recipient envelope
+    if envelope.get('type') == 'multi':
+        # Version 2 keys recipients by binary fingerprint
+        recipient = my_fingerprint
+        if envelope['version'] == 2 and my_fingerprint is not None:
+            recipient = bytes.fromhex(my_fingerprint)
+
+        encrypted_key = envelope['encrypted_keys'].get(recipient)
+        if encrypted_key is None:
+            raise ValueError("Message not addressed to this recipient")
+    else:
+        encrypted_key = envelope['encrypted_key']
+
     # Extract signature
     signature = envelope['signature']
 
-    # Create envelope copy without signature for verification
-    envelope_copy = envelope.copy()
-    del envelope_copy['signature']
+    if envelope['version'] == 2:
+        # Signed bytes are verified in place, no re-serialization
+        envelope_bytes = envelope['signed']
+    else:
+        # Create envelope copy without signature for verification
+        envelope_copy = envelope.copy()
+        del envelope_copy['signature']
 
-    # Serialize envelope for signature verification
-    envelope_bytes = msgpack.packb(envelope_copy, use_bin_type=True)
+        # Serialize envelope for signature verification
+        envelope_bytes = msgpack.packb(envelope_copy, use_bin_type=True)
 
     # Verify signature
-    if not crypto.verify_signature(envelope_bytes, signature, sender_public_key):
+    start = metrics.clock()
+    valid = crypto.verify_signature(envelope_bytes, signature, sender_public_key)
+    metrics.since('server.verify', start)
+    if not valid:
         raise ValueError("Invalid signature")
 
-    # Check timestamp (must be within 5 minutes of current time)
-    current_time = time.time()
-    message_time = envelope['timestamp']
-
-    if message_time > current_time + 300:
-        raise ValueError("Message timestamp too far in future")
-
-    if message_time < current_time - 300:
-        raise ValueError("Message timestamp too old")
-
     # Decrypt message
     decryption_envelope = {
-        'encrypted_key': envelope['encrypted_key'],
+        'encrypted_key': encrypted_key,
         'ciphertext': envelope['ciphertext'],
         'nonce': envelope['nonce'],
         'tag': envelope['tag']
     }
 
+    start = metrics.clock()
     plaintext = crypto.decrypt_message(decryption_envelope, my_private_key)
+    metrics.since('server.decrypt', start)
+
+    return plaintext
+
+
+def _verify_and_decrypt_session(envelope: dict, sender_public_key, my_private_key) -> str:
+    """
+    Check timestamp and decrypt a session message.
+    RSA operations only happen the first time a session is seen.
+
+    Args:
+        envelope: Parsed session message envelope
+        sender_public_key: Sender's RSA public key
+        my_private_key: Recipient's RSA private key
+
+    Returns:
+        Decrypted plaintext message
 
+    Raises:
+        ValueError: If session, timestamp or decryption check fails
+    """
+    # Check timestamp (must be within 5 minutes of current time)
+    check_timestamp(envelope['timestamp'])
+
+    # Get session key (verifies session signature on first use)
+    start = metrics.clock()
+    key = session.open_session(
+        envelope['session'],
+        envelope['sender_fingerprint'],
+        sender_public_key,
+        my_private_key
+    )
+    metrics.since('server.verify', start)
+
+    # Decrypt message (AES-GCM tag authenticates header and ciphertext)
+    start = metrics.clock()
+    if envelope['version'] == 2:
+        associated_data = envelope['signed']
+    else:
+        associated_data = _session_associated_data(envelope)
+    plaintext = crypto.decrypt_with_key(envelope, key, associated_data)
+    metrics.since('server.decrypt', start)
     return plaintext
 
 
-def check_duplicate(message_id: str) -> bool:
+def pack_hello() -> bytes:
+    """
+    Build hello frame announcing the envelope versions and optional frame
+    types this node accepts. A client that lists 'ack' in the hello frame
+    it sends on a connection receives delivery acks on that connection.
+
+    Returns:
+        Hello frame bytes
+    """
+    return bytes([FRAME_HELLO]) + msgpack.packb({
+        'versions': list(PROTOCOL_VERSIONS),
+        'features': list(FEATURES)
+    }, use_bin_type=True)
+
+
+def negotiate(hello_frame) -> tuple:
+    """
+    Pick the envelope version and features to use with a peer from its hello frame.
+
+    Args:
+        hello_frame: Hello frame received from the peer
+
+    Returns:
+        Tuple of (highest version supported by both sides, frozenset of shared features)
+
+    Raises:
+        ValueError: If frame is not a valid hello frame
+    """
+    if not hello_frame or hello_frame[0] != FRAME_HELLO:
+        raise ValueError("Invalid hello frame")
+
+    try:
+        hello = msgpack.unpackb(hello_frame[1:], raw=False)
+        versions = hello['versions']
+        features = frozenset(hello.get('features', ())) & frozenset(FEATURES)
+    except Exception as e:
+        raise ValueError(f"Invalid hello frame: {e}")
+
+    for version in PROTOCOL_VERSIONS:
+        if version in versions:
+            return version, features
+    return 1, features
+
+
+def pack_delivery_ack(processed: int, window: int) -> bytes:
+    """
+    Build delivery ack frame.
+
+    Args:
+        processed: Sequence number up to which all frames were processed
+        window: Number of frames the sender may send beyond processed
+
+    Returns:
+        Ack frame bytes
+    """
+    return _DELIVERY_ACK.pack(FRAME_ACK, processed, window)
+
+
+def unpack_delivery_ack(frame) -> tuple:
+    """
+    Parse delivery ack frame.
+
+    Args:
+        frame: Frame bytes starting with FRAME_ACK
+
+    Returns:
+        Tuple of (processed, window)
+
+    Raises:
+        ValueError: If frame is not a delivery ack
+    """
+    if len(frame) != _DELIVERY_ACK.size or frame[0] != FRAME_ACK:
+        raise ValueError("Invalid delivery ack frame")
+    _, processed, window = _DELIVERY_ACK.unpack(frame)
+    return processed, window
+
+
+def pack_batch(envelopes: list) -> bytes:
+    """
+    Coalesce several serialized envelopes into one batch frame.
+
+    Args:
+        envelopes: List of serialized message bytes
+
+    Returns:
+        Batch frame bytes
+    """
+    parts = [bytes([FRAME_BATCH])]
+    for envelope in envelopes:
+        parts.append(_BATCH_LENGTH.pack(len(envelope)))
+        parts.append(envelope)
+    return b''.join(parts)
+
+
+def unpack_batch(frame) -> list:
+    """
+    Split a batch frame into its envelopes.
+
+    Args:
+        frame: Frame bytes or memoryview starting with FRAME_BATCH
+
+    Returns:
+        List of serialized messages, slices of the same type as frame
+
+    Raises:
+        ValueError: If the frame is truncated or malformed
+    """
+    envelopes = []
+    offset = 1
+    end = len(frame)
+
+    while offset < end:
+        if offset + _BATCH_LENGTH.size > end:
+            raise ValueError("Truncated batch frame")
+        (length,) = _BATCH_LENGTH.unpack_from(frame, offset)
+        offset += _BATCH_LENGTH.size
+
+        if length == 0 or offset + length > end:
+            raise ValueError("Invalid envelope length in batch frame")
+        envelopes.append(frame[offset:offset + length])
+        offset += length
+
+    return envelopes
+
+
+def configure_replay_cache(snapshot_path=None, shards: int = replay.DEFAULT_SHARDS) -> replay.ReplayCache:
+    """
+    Replace the replay cache, optionally loading it from a disk snapshot.
+
+    Args:
+        snapshot_path: File to load from and snapshot to (optional)
+        shards: Number of independently locked shards
+
+    Returns:
+        The new ReplayCache
+    """
+    global _replay_cache
+    _replay_cache = replay.ReplayCache(shards=shards, snapshot_path=snapshot_path)
+    return _replay_cache
+
+
+def get_replay_cache() -> replay.ReplayCache:
+    """
+    Returns:
+        The current ReplayCache
+    """
+    return _replay_cache
+
+
+def check_duplicate(message_id, timestamp: float = None) -> bool:
     """
     Check if message ID has been seen before (replay protection).
 
     Args:
-        message_id: UUID string of message
+        message_id: UUID string or 16-byte binary ID of message
+        timestamp: Envelope timestamp (default: now)
 
     Returns:
         True if duplicate (already seen), False if new
+
+    Raises:
+        ValueError: If message_id is neither a string nor 16 bytes
     """
-    with _seen_ids_lock:
-        if message_id in _seen_message_ids:
-            return True
+    return _replay_cache.check_and_add(message_id, timestamp)
 
-        # Add to seen set
-        _seen_message_ids.append(message_id)
-        return False
+
+def forget_message(message_id, timestamp: float):
+    """
+    Remove a message ID added by check_duplicate, for a message that failed
+    verification afterwards, so a forged copy does not block the genuine one
+    for the rest of the replay window.
+
+    Args:
+        message_id: UUID string or 16-byte binary ID of message
+        timestamp: Envelope timestamp passed to check_duplicate
+    """
+    _replay_cache.discard(message_id, timestamp)
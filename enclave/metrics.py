@@ -0,0 +1,353 @@
+"""
+Metrics module for Enclave.
+Counts and times hot-path operations with fixed-bucket histograms kept
+per thread, so recording is a clock read, a bisect and an increment
+without locks and can stay on in production. Snapshots are plain
+dictionaries that can be merged across processes and rendered as JSON
+or Prometheus text.
+"""
+
+import time
+import bisect
+import threading
+
+
+# Histogram bucket upper bounds in seconds, 10µs to 10s
+LATENCY_BUCKETS = (
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+# Prefix of all exported metric names
+PROMETHEUS_PREFIX = 'enclave_'
+
+clock = time.perf_counter
+
+
+class _ThreadStore:
+    """
+    Counters and histograms written by one thread only, so recording takes no lock.
+    Histograms are lists of bucket counts (the last bucket is for values above
+    the largest bound) followed by the sum of all values.
+    """
+
+    __slots__ = ('thread', 'counters', 'histograms')
+
+    def __init__(self, thread=None):
+        self.thread = thread
+        self.counters = {}
+        self.histograms = {}
+
+    def add(self, other: '_ThreadStore'):
+        """
+        Fold another store's values into this one.
+        """
+        for name, value in list(other.counters.items()):
+            self.counters[name] = self.counters.get(name, 0) + value
+        for name, values in list(other.histograms.items()):
+            total = self.histograms.get(name)
+            if total is None:
+                self.histograms[name] = list(values)
+            else:
+                self.histograms[name] = [a + b for a, b in zip(total, values)]
+
+
+class Registry:
+    """
+    Named counters, latency histograms and gauges of one process.
+    """
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        """
+        Initialize registry.
+
+        Args:
+            bounds: Histogram bucket upper bounds in seconds (default: 10µs to 10s)
+        """
+        self.enabled = True
+        self.bounds = bounds
+        self.local = threading.local()
+        self.stores = []
+        self.retired = _ThreadStore()
+        self.gauges = {}
+        self.sources = []
+        self.lock = threading.Lock()
+
+    def _store(self) -> _ThreadStore:
+        try:
+            return self.local.store
+        except AttributeError:
+            pass
+
+        store = self.local.store = _ThreadStore(threading.current_thread())
+        with self.lock:
+            self._retire_dead()
+            self.stores.append(store)
+        return store
+
+    def _retire_dead(self):
+        """
+        Fold stores of exited threads into one (lock held).
+        """
+        alive = []
+        for store in self.stores:
+            if store.thread.is_alive():
+                alive.append(store)
+            else:
+                self.retired.add(store)
+        self.stores = alive
+
+    def increment(self, name: str, count: int = 1):
+        """
+        Add to a counter, creating it on first use.
+
+        Args:
+            name: Counter name
+            count: Amount to add (default: 1)
+        """
+        if self.enabled:
+            counters = self._store().counters
+            counters[name] = counters.get(name, 0) + count
+
+    def observe(self, name: str, seconds: float):
+        """
+        Record a latency.
+
+        Args:
+            name: Histogram name
+            seconds: Measured latency
+        """
+        if not self.enabled:
+            return
+        histograms = self._store().histograms
+        values = histograms.get(name)
+        if values is None:
+            values = histograms[name] = [0] * (len(self.bounds) + 1) + [0.0]
+        values[bisect.bisect_left(self.bounds, seconds)] += 1
+        values[-1] += seconds
+
+    def since(self, name: str, start: float):
+        """
+        Record the time elapsed since start, a value from clock().
+
+        Args:
+            name: Histogram name
+            start: Start time from clock()
+        """
+        if self.enabled:
+            self.observe(name, clock() - start)
+
+    def set_gauge(self, name: str, read):
+        """
+        Register a gauge read when a snapshot is taken.
+
+        Args:
+            name: Gauge name
+            read: Zero-argument function returning the current value
+        """
+        with self.lock:
+            self.gauges[name] = read
+
+    def remove_gauge(self, name: str):
+        with self.lock:
+            self.gauges.pop(name, None)
+
+    def add_source(self, source):
+        """
+        Register a function returning snapshots from elsewhere (e.g. other
+        processes), merged into every snapshot of this registry.
+
+        Args:
+            source: Zero-argument function returning a list of snapshots
+        """
+        with self.lock:
+            self.sources.append(source)
+
+    def remove_source(self, source):
+        with self.lock:
+            if source in self.sources:
+                self.sources.remove(source)
+
+    def local_snapshot(self) -> dict:
+        """
+        Snapshot this process's metrics only.
+
+        Returns:
+            Dictionary with 'counters', 'gauges' and 'histograms'
+        """
+        total = _ThreadStore()
+        with self.lock:
+            self._retire_dead()
+            total.add(self.retired)
+            for store in self.stores:
+                total.add(store)
+            gauges = dict(self.gauges)
+
+        gauge_values = {}
+        for name, read in gauges.items():
+            try:
+                gauge_values[name] = read()
+            except Exception:
+                continue
+
+        return {
+            'counters': total.counters,
+            'gauges': gauge_values,
+            'histograms': {name: {'bounds': list(self.bounds), 'counts': values[:-1], 'sum': values[-1]}
+                           for name, values in total.histograms.items()}
+        }
+
+    def snapshot(self) -> dict:
+        """
+        Snapshot this process's metrics merged with those of registered sources.
+
+        Returns:
+            Dictionary with 'counters', 'gauges' and 'histograms'
+        """
+        with self.lock:
+            sources = list(self.sources)
+
+        snapshots = [self.local_snapshot()]
+        for source in sources:
+            snapshots.extend(source())
+        return merge(snapshots)
+
+    def reset(self):
+        """
+        Forget all counters and histograms.
+        """
+        with self.lock:
+            self.retired = _ThreadStore()
+            for store in self.stores:
+                store.counters.clear()
+                store.histograms.clear()
+
+
+def merge(snapshots: list) -> dict:
+    """
+    Sum snapshots, e.g. from several listener processes.
+
+    Args:
+        snapshots: List of snapshot dictionaries
+
+    Returns:
+        Merged snapshot
+    """
+    merged = {'counters': {}, 'gauges': {}, 'histograms': {}}
+    for snapshot in snapshots:
+        for kind in ('counters', 'gauges'):
+            for name, value in snapshot[kind].items():
+                merged[kind][name] = merged[kind].get(name, 0) + value
+
+        for name, histogram in snapshot['histograms'].items():
+            total = merged['histograms'].get(name)
+            if total is None:
+                merged['histograms'][name] = {'bounds': list(histogram['bounds']),
+                                              'counts': list(histogram['counts']),
+                                              'sum': histogram['sum']}
+                continue
+            total['counts'] = [a + b for a, b in zip(total['counts'], histogram['counts'])]
+            total['sum'] += histogram['sum']
+    return merged
+
+
+def percentile(histogram: dict, fraction: float) -> float:
+    """
+    Estimate a percentile from a histogram snapshot as the upper bound of
+    the bucket it falls in.
+
+    Args:
+        histogram: Histogram snapshot
+        fraction: Percentile as a fraction, e.g. 0.99
+
+    Returns:
+        Latency in seconds (infinity if above the largest bound, 0 if empty)
+    """
+    count = sum(histogram['counts'])
+    if not count:
+        return 0.0
+
+    rank = fraction * count
+    seen = 0
+    for bound, bucket_count in zip(histogram['bounds'], histogram['counts']):
+        seen += bucket_count
+        if seen >= rank:
+            return bound
+    return float('inf')
+
+
+def summary(snapshot: dict) -> dict:
+    """
+    Condense a snapshot for display: histograms become count, mean, p50 and p99.
+
+    Args:
+        snapshot: Snapshot dictionary
+
+    Returns:
+        Dictionary with 'counters', 'gauges' and 'latencies' (values in milliseconds)
+    """
+    latencies = {}
+    for name, histogram in sorted(snapshot['histograms'].items()):
+        count = sum(histogram['counts'])
+        latencies[name] = {
+            'count': count,
+            'mean_ms': histogram['sum'] / count * 1000 if count else 0.0,
+            'p50_ms': percentile(histogram, 0.5) * 1000,
+            'p99_ms': percentile(histogram, 0.99) * 1000
+        }
+
+    return {
+        'counters': dict(sorted(snapshot['counters'].items())),
+        'gauges': dict(sorted(snapshot['gauges'].items())),
+        'latencies': latencies
+    }
+
+
+def _prometheus_name(name: str) -> str:
+    return PROMETHEUS_PREFIX + name.replace('.', '_').replace('-', '_')
+
+
+def to_prometheus(snapshot: dict) -> str:
+    """
+    Render a snapshot in the Prometheus text exposition format.
+
+    Args:
+        snapshot: Snapshot dictionary
+
+    Returns:
+        Exposition text
+    """
+    lines = []
+    for name, value in sorted(snapshot['counters'].items()):
+        metric = _prometheus_name(name) + '_total'
+        lines.append(f"# TYPE {metric} counter")
+        lines.append(f"{metric} {value}")
+
+    for name, value in sorted(snapshot['gauges'].items()):
+        metric = _prometheus_name(name)
+        lines.append(f"# TYPE {metric} gauge")
+        lines.append(f"{metric} {value}")
+
+    for name, histogram in sorted(snapshot['histograms'].items()):
+        metric = _prometheus_name(name) + '_seconds'
+        lines.append(f"# TYPE {metric} histogram")
+        cumulative = 0
+        for bound, count in zip(histogram['bounds'], histogram['counts']):
+            cumulative += count
+            lines.append(f'{metric}_bucket{{le="{bound}"}} {cumulative}')
+        cumulative += histogram['counts'][-1]
+        lines.append(f'{metric}_bucket{{le="+Inf"}} {cumulative}')
+        lines.append(f"{metric}_sum {histogram['sum']}")
+        lines.append(f"{metric}_count {cumulative}")
+
+    return "\n".join(lines) + "\n"
+
+
+# Metrics of this process
+registry = Registry()
+
+increment = registry.increment
+observe = registry.observe
+since = registry.since
+snapshot = registry.snapshot
@@ -4,14 +4,97 @@ Handles P2P client and server using sockets and threading.
 High-performance implementation with ThreadPoolExecutor and connection pooling.
 """
 
+import os
+import select
 import socket
-import struct
 import threading
 import time
+import hashlib
 from concurrent.futures import ThreadPoolExecutor
-from queue import Queue, Empty
-from collections import defaultdict
-from . import message, keystore
+from queue import Queue, Empty, Full
+from collections import OrderedDict, deque
+from . import addresses, admission, framing, message, metrics, keystore, transfer
+
+
+# Receive path stages in the order they run, cheapest first; each counts
+# the envelopes (or, for frame_size, frames) it rejects
+VALIDATION_STAGES = ('frame_size', 'schema', 'unknown_sender', 'timestamp', 'replay', 'crypto')
+
+
+class _ConnectionState:
+    """
+    Delivery ack state of one incoming connection.
+
+    Message and batch frames are numbered in arrival order. Once every frame
+    up to N has been processed, the sender gets a cumulative ack for N along
+    with the number of frames it may send beyond N.
+    """
+
+    __slots__ = ('write', 'source', 'acks', 'received', 'processed', 'completed', 'lock')
+
+    def __init__(self, write, source):
+        """
+        Initialize connection state.
+
+        Args:
+            write: Function writing one frame to the connection
+            source: Source IP of the connection
+        """
+        self.write = write
+        self.source = source
+        self.acks = False
+        self.received = 0
+        self.processed = 0
+        self.completed = set()
+        self.lock = threading.Lock()
+
+    def send(self, frame: bytes):
+        """
+        Write a frame, serialized with acks sent from worker threads.
+
+        Args:
+            frame: Frame bytes
+        """
+        with self.lock:
+            self.write(frame)
+
+    def next_seq(self) -> int:
+        """
+        Number the next received message or batch frame (reader only).
+
+        Returns:
+            Sequence number of the frame
+        """
+        self.received += 1
+        return self.received
+
+    def complete(self, seq: int, window: int):
+        """
+        Mark a frame as processed and ack every frame processed in order so far.
+
+        Args:
+            seq: Sequence number of the processed frame
+            window: Frames the sender may send beyond the acked one
+        """
+        if not self.acks:
+            return
+
+        with self.lock:
+            if seq != self.processed + 1:
+                # An earlier frame is still being processed
+                self.completed.add(seq)
+                return
+
+            while seq + 1 in self.completed:
+                seq += 1
+                self.completed.remove(seq)
+            self.processed = seq
+
+            try:
+                self.write(message.pack_delivery_ack(seq, window))
+            except OSError:
+                # Connection closed, the sender sees it fail
+                pass
 
 
 class ChatServer:
@@ -20,7 +103,14 @@ class ChatServer:
     High-performance with ThreadPoolExecutor and message queue processing.
     """
 
-    def __init__(self, host: str, port: int, private_key, public_key, fingerprint: str, message_callback, max_workers=20):
+    # Shown in the startup message
+    ENGINE_NAME = "ThreadPoolExecutor"
+
+    def __init__(self, host: str, port: int, private_key, public_key, fingerprint: str, message_callback, max_workers=20,
+                 idle_timeout=60, crypto_processes=0, crypto_batch_size=64,
+                 file_callback=None, download_dir="downloads", replay_cache_path=None, ack_window=64,
+                 admission_control=None, source_weights=None, max_frame_size=message.MAX_FRAME_SIZE,
+                 reuse_port=False):
         """
         Initialize chat server.
 
@@ -32,37 +122,115 @@ class ChatServer:
             fingerprint: User's key fingerprint
             message_callback: Function called when message received (signature: callback(sender_fingerprint, plaintext, timestamp))
             max_workers: Maximum number of worker threads (default: 20)
+            idle_timeout: Seconds a persistent connection may stay idle before it is closed (default: 60)
+            crypto_processes: Number of processes for verification and decryption;
+                              0 runs crypto in the message worker threads (default: 0)
+            crypto_batch_size: Maximum messages sent to a crypto process at once (default: 64)
+            file_callback: Function called when a file transfer completes (signature: callback(sender_fingerprint, path, timestamp));
+                           incoming transfers are refused if not set
+            download_dir: Directory for received files (default: "downloads")
+            replay_cache_path: File to persist the replay cache to, so replay
+                               protection survives restarts (optional)
+            ack_window: Most frames a sender with delivery acks may have
+                        unprocessed; shrinks as the message queue fills (default: 64)
+            admission_control: admission.AdmissionControl rate limiting envelopes per
+                               source IP and claimed sender (default: default limits)
+            source_weights: Dictionary mapping source IP to its share of the message
+                            workers relative to others, default 1 (optional)
+            max_frame_size: Largest accepted frame in bytes; a connection announcing
+                            a longer frame is closed (default: 4 MiB)
+            reuse_port: Bind with SO_REUSEPORT so several listener processes
+                        share the port (default: False)
+
+        Raises:
+            ValueError: If a source weight is not positive
         """
+        for source, weight in (source_weights or {}).items():
+            if not weight > 0:
+                raise ValueError(f"Weight of source {source} must be positive: {weight}")
+
         self.host = host
         self.port = port
         self.private_key = private_key
         self.public_key = public_key
         self.fingerprint = fingerprint
         self.message_callback = message_callback
+        self.file_callback = file_callback
+        self.download_dir = download_dir
+        self.idle_timeout = idle_timeout
+        self.replay_cache_path = replay_cache_path
+        self.ack_window = ack_window
+        self.max_frame_size = max_frame_size
+        self.reuse_port = reuse_port
+        self.replay_snapshot_stop = None
         self.server_socket = None
         self.running = False
 
+        # Open persistent client connections (closed on stop)
+        self.connections = set()
+        self.connections_lock = threading.Lock()
+
         # ThreadPoolExecutor for handling connections
         self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ChatServer")
 
-        # Message queue for processing
-        self.message_queue = Queue(maxsize=1000)
+        # Per-source rate limits applied before frames are queued
+        self.admission = admission_control or admission.AdmissionControl()
+
+        # Envelopes accepted and rejected per validation stage
+        self.accepted = 0
+        self.rejected = dict.fromkeys(VALIDATION_STAGES, 0)
+        self.validation_lock = threading.Lock()
+
+        # Message queue for processing, one item per received frame:
+        # (list of envelopes, address, connection state, sequence number,
+        # pooled frame, time received),
+        # served round robin per source IP weighted by envelope count
+        self.message_queue = admission.FairQueue(
+            1000,
+            key=lambda item: item[1][0],
+            cost=lambda item: len(item[0]),
+            weights=source_weights
+        )
 
         # Worker threads for message processing
         self.num_message_workers = 4
         self.message_workers = []
 
+        # Optional process-pool crypto backend (started in start())
+        self.crypto_processes = crypto_processes
+        self.crypto_batch_size = crypto_batch_size
+        self.crypto_backend = None
+
+        # Submitted crypto batches, consumed in order by the result worker
+        self.pending_batches = Queue(maxsize=crypto_processes * 2 or 1)
+
     def start(self):
         """
         Start the chat server and begin accepting connections.
         """
+        self._bind()
+        self._start_processing()
+
+        # Start accept loop in daemon thread
+        accept_thread = threading.Thread(target=self._accept_loop, daemon=True)
+        accept_thread.start()
+
+    def _bind(self):
+        """
+        Create, bind and listen on the server socket.
+        """
         try:
-            # Create TCP socket
-            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            # Create TCP socket (IPv6 for an IPv6 bind address such as "::")
+            family = socket.AF_INET6 if ':' in self.host else socket.AF_INET
+            self.server_socket = socket.socket(family, socket.SOCK_STREAM)
 
             # Set SO_REUSEADDR for quick restart
             self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
+            # Let the kernel spread connections over listener processes
+            if self.reuse_port:
+                self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
             # Enable TCP_NODELAY for lower latency
             self.server_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
@@ -72,28 +240,47 @@ class ChatServer:
             # Listen with larger backlog for high-performance
             self.server_socket.listen(100)
 
-            self.running = True
+        except OSError as e:
+            if "Address already in use" in str(e):
+                print(f"Port {self.port} already in use")
+                raise
+            else:
+                raise
+
+    def _start_processing(self):
+        """
+        Restore the replay cache and start message processing workers.
+        """
+        self.running = True
+        metrics.registry.set_gauge('server.queue_depth', self.message_queue.qsize)
+
+        # Restore replay protection from the last run
+        if self.replay_cache_path:
+            replay_cache = message.configure_replay_cache(self.replay_cache_path)
+            self.replay_snapshot_stop = replay_cache.start_snapshots()
 
+        if self.crypto_processes:
+            # Crypto runs in worker processes, threads only dispatch and deliver
+            from .crypto_backend import ProcessCryptoBackend
+            self.crypto_backend = ProcessCryptoBackend(self.private_key, self.fingerprint, self.crypto_processes)
+
+            for target, name in ((self._dispatch_worker, "MsgDispatcher"), (self._result_worker, "MsgResults")):
+                worker = threading.Thread(target=target, daemon=True, name=name)
+                worker.start()
+                self.message_workers.append(worker)
+        else:
             # Start message processing worker threads
             for i in range(self.num_message_workers):
                 worker = threading.Thread(target=self._message_worker, daemon=True, name=f"MsgWorker-{i}")
                 worker.start()
                 self.message_workers.append(worker)
 
-            print(f"Listening on {self.host}:{self.port}")
-            print(f"Your fingerprint: {self.fingerprint}")
-            print(f"Server started with {self.num_message_workers} message workers and ThreadPoolExecutor")
-
-            # Start accept loop in daemon thread
-            accept_thread = threading.Thread(target=self._accept_loop, daemon=True)
-            accept_thread.start()
-
-        except OSError as e:
-            if "Address already in use" in str(e):
-                print(f"Port {self.port} already in use")
-                raise
-            else:
-                raise
+        print(f"Listening on {self.host}:{self.port}")
+        print(f"Your fingerprint: {self.fingerprint}")
+        if self.crypto_backend:
+            print(f"Server started with {self.crypto_backend.processes} crypto processes and {self.ENGINE_NAME}")
+        else:
+            print(f"Server started with {self.num_message_workers} message workers and {self.ENGINE_NAME}")
 
     def _accept_loop(self):
         """
@@ -108,41 +295,78 @@ class ChatServer:
                 conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
                 # Submit to thread pool for handling
-                self.executor.submit(self._handle_client, conn, addr)
+                self.executor.submit(self._handle_client, conn, addr, metrics.clock())
 
             except Exception as e:
                 if self.running:
                     print(f"Error accepting connection: {e}")
 
-    def _handle_client(self, conn, addr):
+    def _handle_client(self, conn, addr, accepted: float = None):
         """
-        Handle incoming message from a peer.
-        Reads message and puts in queue for processing by worker threads.
+        Handle a persistent connection from a peer.
+        Reads length-prefixed messages until the peer disconnects or the
+        connection stays idle longer than idle_timeout, and puts each one
+        in the queue for processing by worker threads. Reading pauses while
+        the queue is full, so TCP backpressure slows the sender down.
 
         Args:
             conn: Socket connection
             addr: Client address tuple
+            accepted: metrics.clock() time the connection was accepted (optional)
         """
+        # Time spent waiting for a pool thread
+        if accepted is not None:
+            metrics.since('server.accept', accepted)
+        metrics.increment('server.connections')
+
+        with self.connections_lock:
+            self.connections.add(conn)
+
+        state = _ConnectionState(lambda frame: framing.send_frame(conn, frame), addr[0])
+        reader = framing.FrameReader(conn)
+
         try:
-            # Read 4-byte length prefix (big-endian uint32)
-            length_data = self._recv_exact(conn, 4)
-            if not length_data:
-                return
+            # Idle deadline between messages
+            conn.settimeout(self.idle_timeout)
 
-            message_length = struct.unpack('!I', length_data)[0]
+            while self.running:
+                # Read 4-byte length prefix (big-endian uint32)
+                try:
+                    message_length = reader.read_length()
+                except socket.timeout:
+                    # Connection idle for too long
+                    break
+                if message_length is None:
+                    break
+
+                if not self._check_frame_size(message_length, addr):
+                    break
+
+                # Read message data into a pooled buffer
+                start = metrics.clock()
+                frame = reader.read_payload(message_length)
+                if frame is None:
+                    break
+                metrics.since('server.recv', start)
+                message_data = frame.view
+
+                # Answer version negotiation on the same connection
+                if message_data[0] == message.FRAME_HELLO:
+                    state.acks = self._accepts_acks(message_data)
+                    frame.release()
+                    state.send(message.pack_hello())
+                    continue
 
-            # Read message data
-            message_data = self._recv_exact(conn, message_length)
-            if not message_data:
-                return
+                # File transfers take over the connection until they finish
+                if message_data[0] == transfer.FRAME_FILE_MANIFEST:
+                    try:
+                        self._receive_file(conn, message_data, reader)
+                    finally:
+                        frame.release()
+                    break
 
-            # Put message in queue for processing (non-blocking)
-            try:
-                self.message_queue.put((message_data, addr), block=False)
-            except:
-                # Queue full, drop message
-                if self.running:
-                    print(f"Message queue full, dropping message from {addr}")
+                # Workers release the frame once its envelopes are processed
+                self._enqueue_frame(message_data, addr, state, frame)
 
         except Exception as e:
             # Catch all errors and close connection gracefully
@@ -151,303 +375,1820 @@ class ChatServer:
 
         finally:
             # Always close connection
+            with self.connections_lock:
+                self.connections.discard(conn)
             conn.close()
 
-    def _message_worker(self):
-        """
-        Worker thread that processes messages from the queue.
-        This separates network I/O from crypto operations for better performance.
+    def _check_frame_size(self, frame_length: int, addr) -> bool:
         """
-        while self.running:
-            try:
-                # Get message from queue with timeout
-                message_data, addr = self.message_queue.get(timeout=0.5)
+        Check a length prefix before anything is allocated for the frame.
+        A rejected frame cannot be skipped, so the connection has to be closed.
 
-                # Parse message
-                envelope = message.parse_message(message_data)
+        Args:
+            frame_length: Announced frame length
+            addr: Client address tuple
 
-                # Get sender's fingerprint
-                sender_fingerprint = envelope['sender_fingerprint']
+        Returns:
+            True if the frame may be read
+        """
+        if 0 < frame_length <= self.max_frame_size:
+            return True
 
-                # Load sender's public key (with caching)
-                try:
-                    sender_public_key = keystore.load_peer_key(sender_fingerprint)
-                except FileNotFoundError:
-                    print(f"Unknown sender: {sender_fingerprint}")
-                    continue
+        self._count_rejected('frame_size')
+        print(f"Invalid frame size {frame_length} from {addr[0]}, closing connection")
+        return False
 
-                # Check for duplicate (replay protection)
-                if message.check_duplicate(envelope['message_id']):
-                    # Drop duplicate silently
-                    continue
+    def _count_rejected(self, stage: str, count: int = 1):
+        """
+        Count envelopes rejected by a validation stage.
+        """
+        with self.validation_lock:
+            self.rejected[stage] += count
 
-                # Verify and decrypt message
-                try:
-                    plaintext = message.verify_and_decrypt(envelope, sender_public_key, self.private_key)
-                except ValueError as e:
-                    print(f"Invalid message from {sender_fingerprint}: {e}")
-                    continue
+    def validation_stats(self) -> dict:
+        """
+        Get how many envelopes passed validation and how many each stage rejected.
 
-                # Call message callback with decrypted message
-                self.message_callback(sender_fingerprint, plaintext, envelope['timestamp'])
+        Returns:
+            Dictionary with 'accepted' count and 'rejected' mapping stage to count
+            (stages in VALIDATION_STAGES order)
+        """
+        with self.validation_lock:
+            return {'accepted': self.accepted, 'rejected': dict(self.rejected)}
 
-            except Empty:
-                # No messages in queue, continue
-                continue
-            except Exception as e:
-                if self.running:
-                    print(f"Error processing message: {e}")
+    def admission_stats(self) -> dict:
+        """
+        Get per-source counters of envelopes admitted, throttled and rejected.
+
+        Returns:
+            Dictionary from admission.AdmissionControl.stats()
+        """
+        return self.admission.stats()
 
-    def _recv_exact(self, conn, num_bytes):
+    @staticmethod
+    def _accepts_acks(hello_frame) -> bool:
         """
-        Receive exact number of bytes from socket.
+        Check whether the client's hello frame asks for delivery acks.
 
         Args:
-            conn: Socket connection
-            num_bytes: Number of bytes to receive
+            hello_frame: Hello frame received from the client
 
         Returns:
-            Bytes received or None if connection closed
+            True if acks should be sent on this connection
         """
-        data = b''
-        while len(data) < num_bytes:
-            chunk = conn.recv(num_bytes - len(data))
-            if not chunk:
-                return None
-            data += chunk
-        return data
+        try:
+            return 'ack' in message.negotiate(hello_frame)[1]
+        except ValueError:
+            return False
 
-    def stop(self):
-        """
-        Stop the chat server.
+    def _queue_item(self, message_data, addr, state: _ConnectionState, frame: framing.Frame = None) -> tuple:
         """
-        self.running = False
-        if self.server_socket:
-            self.server_socket.close()
-
-        # Shutdown executor gracefully
-        self.executor.shutdown(wait=True, cancel_futures=False)
+        Build the message queue item for a received message or batch frame.
 
-        print("Server stopped")
+        Args:
+            message_data: Frame bytes or memoryview
+            addr: Client address tuple
+            state: Connection state
+            frame: Pooled frame holding message_data, released after processing (optional)
 
+        Returns:
+            Tuple of (envelopes, addr, state, sequence number, frame, time received)
+        """
+        # Batch frames are split here and queued with one operation
+        if message_data[0] == message.FRAME_BATCH:
+            try:
+                envelopes = message.unpack_batch(message_data)
+            except ValueError:
+                self._count_rejected('schema')
+                raise
+        else:
+            envelopes = [message_data]
 
-class ConnectionPool:
-    """
-    Connection pool for reusing connections to frequently contacted peers.
-    Significantly improves performance for repeated messages to same peer.
-    """
+        return envelopes, addr, state, state.next_seq(), frame, metrics.clock()
 
-    def __init__(self, max_connections_per_peer=3, connection_timeout=30):
+    def _admission_delay(self, item: tuple) -> float:
         """
-        Initialize connection pool.
+        Charge a queue item to its source IP and claimed senders.
 
         Args:
-            max_connections_per_peer: Maximum cached connections per peer
-            connection_timeout: Timeout for idle connections (seconds)
+            item: Message queue item from _queue_item
+
+        Returns:
+            Seconds the connection has to wait before queueing the item
+
+        Raises:
+            ConnectionError: If the source is so far over its rate limit that the frame is rejected
         """
-        self.pools = defaultdict(list)
-        self.pool_locks = defaultdict(threading.Lock)
-        self.max_connections_per_peer = max_connections_per_peer
-        self.connection_timeout = connection_timeout
-        self.last_used = {}
+        envelopes, addr = item[0], item[1]
+        if self.admission.sender_rate:
+            senders = [message.claimed_sender(envelope) for envelope in envelopes]
+        else:
+            senders = [None] * len(envelopes)
 
-    def get_connection(self, host, port):
+        delay = self.admission.admit(addr[0], senders)
+        if delay is None:
+            metrics.increment('server.dropped.rate_limited', len(envelopes))
+            raise ConnectionError(f"Rate limit exceeded by {addr[0]}")
+        return delay
+
+    def _enqueue_frame(self, message_data, addr, state: _ConnectionState, frame: framing.Frame):
         """
-        Get connection from pool or create new one.
+        Queue the envelopes of a received message or batch frame for processing,
+        waiting while the source is over its rate limit or the queue is full.
 
         Args:
-            host: Target host
-            port: Target port
+            message_data: Frame payload
+            addr: Client address tuple
+            state: Connection state
+            frame: Pooled frame holding message_data, released here if not queued
 
-        Returns:
-            Socket connection or None
+        Raises:
+            ConnectionError: If the frame is rejected or the queue stayed full for idle_timeout
         """
-        peer_key = f"{host}:{port}"
-
-        with self.pool_locks[peer_key]:
-            # Try to get connection from pool
-            while self.pools[peer_key]:
-                conn, timestamp = self.pools[peer_key].pop()
+        try:
+            item = self._queue_item(message_data, addr, state, frame)
 
-                # Check if connection is still valid and not too old
-                if time.time() - timestamp < self.connection_timeout:
-                    try:
-                        # Quick check if connection is alive
-                        conn.getpeername()
-                        return conn
-                    except:
-                        # Connection dead, close it
-                        try:
-                            conn.close()
-                        except:
-                            pass
+            # Not reading meanwhile slows this sender down, other connections go on
+            delay = self._admission_delay(item)
+            if delay:
+                time.sleep(delay)
 
-        # No valid connection in pool, return None (caller creates new)
-        return None
+            try:
+                self.message_queue.put(item, timeout=self.idle_timeout)
+            except Full:
+                # Closing the connection tells the sender, unlike dropping silently
+                metrics.increment('server.dropped.queue_full', len(item[0]))
+                raise ConnectionError(f"Message queue full for {self.idle_timeout}s")
+        except BaseException:
+            frame.release()
+            raise
 
-    def return_connection(self, host, port, conn):
+    def _complete(self, state: _ConnectionState, seq: int):
         """
-        Return connection to pool for reuse.
+        Ack a processed frame, granting credit by the room left in the message
+        queue for the connection's source.
 
         Args:
-            host: Target host
-            port: Target port
-            conn: Socket connection
+            state: Connection state the frame arrived on
+            seq: Sequence number of the frame
         """
-        peer_key = f"{host}:{port}"
+        if state.acks:
+            free = self.message_queue.free(state.source)
+            state.complete(seq, max(1, min(self.ack_window, free)))
 
-        with self.pool_locks[peer_key]:
-            # Only keep up to max_connections_per_peer
-            if len(self.pools[peer_key]) < self.max_connections_per_peer:
-                self.pools[peer_key].append((conn, time.time()))
-            else:
-                # Pool full, close connection
-                try:
-                    conn.close()
-                except:
-                    pass
-
-    def close_all(self):
+    def _message_worker(self):
         """
-        Close all pooled connections.
+        Worker thread that processes messages from the queue.
+        This separates network I/O from crypto operations for better performance.
         """
-        for peer_key in self.pools:
-            with self.pool_locks[peer_key]:
-                for conn, _ in self.pools[peer_key]:
-                    try:
-                        conn.close()
-                    except:
-                        pass
-                self.pools[peer_key].clear()
-
+        while self.running:
+            try:
+                # Get messages from queue with timeout
+                envelopes, addr, state, seq, frame, received = self.message_queue.get(timeout=0.5)
+            except Empty:
+                # No messages in queue, continue
+                continue
+            metrics.since('server.queue_wait', received)
 
-# Global connection pool for reusing connections
-_connection_pool = ConnectionPool()
+            for message_data in envelopes:
+                try:
+                    self._process_message(message_data, addr)
+                except Exception as e:
+                    if self.running:
+                        print(f"Error processing message: {e}")
 
+            if frame is not None:
+                frame.release()
+            self._complete(state, seq)
 
-def send_message(recipient_host: str, recipient_port: int, recipient_fingerprint: str,
-                plaintext: str, sender_private_key, sender_fingerprint: str, use_pooling=True):
-    """
-    Send encrypted message to peer with connection pooling for performance.
+    def _screen(self, message_data: bytes, addr):
+        """
+        Run the validation stages that need no crypto, cheapest first, so
+        garbage, stale and replayed envelopes cost microseconds.
 
-    Args:
-        recipient_host: Recipient's IP address
-        recipient_port: Recipient's port number
-        recipient_fingerprint: Recipient's key fingerprint
-        plaintext: Message text to send
-        sender_private_key: Sender's RSA private key
-        sender_fingerprint: Sender's key fingerprint
-        use_pooling: Whether to use connection pooling (default: True)
+        The message ID is added to the replay cache tentatively: callers
+        forget it again if verification fails, so a forged envelope does not
+        block the genuine one for the rest of the replay window. While the
+        forgery is being verified, though, a genuine envelope with the same
+        ID is dropped as a replay; it gets through only if sent again after
+        the forgery was rejected.
 
-    Returns:
-        True if sent successfully
+        Args:
+            message_data: Serialized message bytes
+            addr: Client address tuple
 
-    Raises:
-        ConnectionError: If connection or send fails
-        ValueError: If recipient key not found
-    """
-    try:
-        # Load recipient's public key (with caching in keystore)
+        Returns:
+            Tuple of (envelope, sender_public_key), or None if rejected
+        """
+        # Schema: msgpack structure and field types
+        start = metrics.clock()
+        try:
+            envelope = message.parse_message(message_data)
+            metrics.since('server.parse', start)
+        except ValueError as e:
+            self._count_rejected('schema')
+            print(f"Invalid message from {addr[0]}: {e}")
+            return None
+
+        # Known sender (keys are cached)
+        sender_fingerprint = envelope['sender_fingerprint']
         try:
-            recipient_public_key = keystore.load_peer_key(recipient_fingerprint)
+            sender_public_key = keystore.load_peer_key(sender_fingerprint)
         except FileNotFoundError:
-            raise ValueError(f"Peer not found: {recipient_fingerprint}")
+            self._count_rejected('unknown_sender')
+            print(f"Unknown sender: {sender_fingerprint}")
+            return None
 
-        # Create encrypted message
-        message_data = message.create_message(
-            plaintext,
-            recipient_public_key,
-            sender_private_key,
-            sender_fingerprint
-        )
+        # Timestamp window
+        try:
+            message.check_timestamp(envelope['timestamp'])
+        except ValueError as e:
+            self._count_rejected('timestamp')
+            print(f"Invalid message from {sender_fingerprint}: {e}")
+            return None
 
-        # Try to get connection from pool
-        sock = None
-        if use_pooling:
-            sock = _connection_pool.get_connection(recipient_host, recipient_port)
+        # Replay protection, duplicates are dropped silently
+        if message.check_duplicate(envelope['message_id'], envelope['timestamp']):
+            self._count_rejected('replay')
+            return None
 
-        # Create new connection if not from pool
-        if sock is None:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.settimeout(10)
+        return envelope, sender_public_key
 
-            # Enable TCP_NODELAY for lower latency
-            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    def _process_message(self, message_data: bytes, addr):
+        """
+        Validate, verify and decrypt one message and deliver it to the callback.
 
-            # Connect to recipient
-            sock.connect((recipient_host, recipient_port))
+        Args:
+            message_data: Serialized message bytes
+            addr: Client address tuple
+        """
+        screened = self._screen(message_data, addr)
+        if screened is None:
+            return
+        envelope, sender_public_key = screened
+        sender_fingerprint = envelope['sender_fingerprint']
 
+        # Verify and decrypt message
         try:
-            # Send 4-byte length prefix (big-endian uint32)
-            message_length = len(message_data)
-            length_prefix = struct.pack('!I', message_length)
-            sock.sendall(length_prefix)
+            plaintext = message.verify_and_decrypt(envelope, sender_public_key, self.private_key, self.fingerprint)
+        except ValueError as e:
+            message.forget_message(envelope['message_id'], envelope['timestamp'])
+            self._count_rejected('crypto')
+            print(f"Invalid message from {sender_fingerprint}: {e}")
+            return
 
-            # Send message data
-            sock.sendall(message_data)
+        with self.validation_lock:
+            self.accepted += 1
 
-            # Return connection to pool for reuse
-            if use_pooling:
-                _connection_pool.return_connection(recipient_host, recipient_port, sock)
-            else:
-                sock.close()
+        # Call message callback with decrypted message
+        self._deliver(envelope['message_id'], sender_fingerprint, plaintext, envelope['timestamp'])
 
-            return True
+    def _deliver(self, message_id, sender_fingerprint: str, plaintext: str, timestamp: float):
+        """
+        Hand a verified and decrypted message to the message callback.
 
-        except:
-            # Error during send, close connection
+        Args:
+            message_id: Envelope message ID
+            sender_fingerprint: Sender's key fingerprint
+            plaintext: Decrypted message
+            timestamp: Envelope timestamp
+        """
+        start = metrics.clock()
+        self.message_callback(sender_fingerprint, plaintext, timestamp)
+        metrics.since('server.callback', start)
+
+    def _dispatch_worker(self):
+        """
+        Worker thread that batches queued messages for the crypto processes.
+        Replay protection stays in this process so it covers every worker.
+        """
+        while self.running:
             try:
-                sock.close()
-            except:
-                pass
-            raise
+                # Block for the first messages, then drain what is already queued
+                envelopes, addr, state, seq, frame, received = self.message_queue.get(timeout=0.5)
+                metrics.since('server.queue_wait', received)
+                batch_items = [(message_data, addr) for message_data in envelopes]
+                completions = [(state, seq)]
+                frames = [frame]
+                while len(batch_items) < self.crypto_batch_size:
+                    try:
+                        envelopes, addr, state, seq, frame, received = self.message_queue.get_nowait()
+                    except Empty:
+                        break
+                    metrics.since('server.queue_wait', received)
+                    batch_items.extend((message_data, addr) for message_data in envelopes)
+                    completions.append((state, seq))
+                    frames.append(frame)
+
+                # Only envelopes passing the cheap stages reach the processes,
+                # copied out of the pooled frames to be sent to them
+                batch = []
+                screened = []
+                for message_data, addr in batch_items:
+                    result = self._screen(message_data, addr)
+                    if result is not None:
+                        batch.append(bytes(message_data))
+                        screened.append((result[0]['message_id'], result[0]['timestamp']))
+
+                for frame in frames:
+                    if frame is not None:
+                        frame.release()
+
+                # Blocks when too many batches are in flight; frames are acked
+                # by the result worker once delivered, even if all were dropped
+                future = self.crypto_backend.submit(batch) if batch else None
+                self.pending_batches.put((future, completions, screened))
 
-    except socket.timeout:
-        raise ConnectionError(f"Could not connect to {recipient_host}:{recipient_port}")
-    except socket.error as e:
-        if "Connection refused" in str(e):
-            raise ConnectionError(f"Could not connect to {recipient_host}:{recipient_port}")
-        else:
-            raise ConnectionError(f"Failed to send message: {e}")
+            except Empty:
+                continue
+            except Exception as e:
+                if self.running:
+                    print(f"Error dispatching messages: {e}")
 
+    def _result_worker(self):
+        """
+        Worker thread that delivers crypto process results in submission order.
+        """
+        while self.running:
+            try:
+                future, completions, screened = self.pending_batches.get(timeout=0.5)
+            except Empty:
+                continue
 
-def send_batch_messages(recipients: list, plaintext: str, sender_private_key, sender_fingerprint: str):
-    """
-    Send same message to multiple recipients in parallel for maximum performance.
+            try:
+                results = future.result() if future else []
+            except Exception as e:
+                # Lost frames are not acked, so waiting senders see a failure;
+                # their IDs are forgotten so the retried envelopes are accepted
+                for message_id, timestamp in screened:
+                    message.forget_message(message_id, timestamp)
+                if self.running:
+                    print(f"Error processing message batch: {e}")
+                continue
 
-    Args:
-        recipients: List of (host, port, fingerprint) tuples
-        plaintext: Message text to send
-        sender_private_key: Sender's RSA private key
+            for (message_id, timestamp), (sender_fingerprint, plaintext, _, error) in zip(screened, results):
+                if error is not None:
+                    message.forget_message(message_id, timestamp)
+                    self._count_rejected('crypto')
+                    print(f"Invalid message from {sender_fingerprint}: {error}")
+                    continue
+
+                with self.validation_lock:
+                    self.accepted += 1
+
+                try:
+                    self._deliver(message_id, sender_fingerprint, plaintext, timestamp)
+                except Exception as e:
+                    print(f"Error processing message: {e}")
+
+            for state, seq in completions:
+                self._complete(state, seq)
+
+    def _receive_file(self, conn, manifest_frame, reader: framing.FrameReader = None):
+        """
+        Receive a streamed file transfer on this connection.
+        Chunks are decrypted and written to disk as they arrive, so memory
+        stays bounded by one chunk regardless of file size.
+
+        Args:
+            conn: Socket connection
+            manifest_frame: Manifest frame that started the transfer
+            reader: FrameReader the manifest was read with (default: a new one)
+        """
+        if self.file_callback is None:
+            print("Incoming file transfer refused (file transfers disabled)")
+            return
+
+        manifest = transfer.parse_manifest(manifest_frame)
+        sender_fingerprint = manifest['sender_fingerprint']
+
+        try:
+            sender_public_key = keystore.load_peer_key(sender_fingerprint)
+        except FileNotFoundError:
+            print(f"Unknown sender: {sender_fingerprint}")
+            return
+
+        key, metadata = transfer.verify_manifest(manifest, sender_public_key, self.private_key)
+        transfer_id = manifest['transfer_id']
+
+        # Drop partial downloads their senders gave up on
+        pruned = transfer.prune_partials(self.download_dir)
+        if pruned:
+            metrics.increment('transfer.partials_pruned', pruned)
+
+        incoming = transfer.IncomingTransfer(self.download_dir, sender_fingerprint, transfer_id, metadata)
+        reader = reader or framing.FrameReader(conn)
+        try:
+            # Tell sender where to resume
+            framing.send_frame(conn, transfer.pack_ack(incoming.received))
+
+            while self.running:
+                received = reader.read_frame(transfer.MAX_CHUNK_FRAME)
+                if received is None:
+                    return
+
+                # Each frame is decrypted before the next is read, so its buffer is reused
+                frame = received.view
+                try:
+                    if frame[0] == transfer.FRAME_FILE_CHUNK:
+                        index, data = transfer.decrypt_chunk(key, transfer_id, frame)
+                        incoming.write_chunk(index, data)
+
+                        # Acknowledge chunks once they are on disk
+                        if incoming.received % transfer.ACK_INTERVAL == 0:
+                            incoming.flush()
+                            framing.send_frame(conn, transfer.pack_ack(incoming.received))
+
+                    elif frame[0] == transfer.FRAME_FILE_END:
+                        chunk_count, file_hash = transfer.decrypt_end(key, transfer_id, frame)
+                        path = incoming.finish(chunk_count, file_hash)
+                        framing.send_frame(conn, transfer.pack_ack(incoming.received, complete=True))
+
+                        self.file_callback(sender_fingerprint, str(path), manifest['timestamp'])
+                        return
+
+                    else:
+                        raise ValueError(f"Unexpected frame type {frame[0]} during file transfer")
+                finally:
+                    received.release()
+
+        finally:
+            incoming.close()
+
+    def stop(self):
+        """
+        Stop the chat server.
+        """
+        self.running = False
+        if self.server_socket:
+            self.server_socket.close()
+
+        # Wake up handlers blocked on idle persistent connections
+        with self.connections_lock:
+            for conn in list(self.connections):
+                try:
+                    conn.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+        # Shutdown executor gracefully
+        self.executor.shutdown(wait=True, cancel_futures=False)
+
+        self._stop_processing()
+
+    def _stop_processing(self):
+        """
+        Stop the crypto backend and save the replay cache.
+        """
+        if self.crypto_backend:
+            self.crypto_backend.shutdown()
+        metrics.registry.remove_gauge('server.queue_depth')
+
+        if self.replay_snapshot_stop:
+            self.replay_snapshot_stop.set()
+            message.get_replay_cache().snapshot()
+
+        print("Server stopped")
+
+
+# Server engines selectable with --engine
+SERVER_ENGINES = ('threads', 'asyncio')
+
+
+def create_server(engine: str = 'threads', listener_processes: int = 1, **kwargs) -> ChatServer:
+    """
+    Create a chat server with the given connection engine.
+
+    Args:
+        engine: 'threads' (one pool thread per connection) or 'asyncio'
+                (one event loop for all connections, for many idle peers)
+        listener_processes: Number of processes sharing the port through
+                            SO_REUSEPORT, each running the engine (default: 1)
+        **kwargs: ChatServer arguments
+
+    Returns:
+        ChatServer, AsyncChatServer or listeners.MultiProcessServer
+
+    Raises:
+        ValueError: If engine is unknown
+    """
+    if engine not in SERVER_ENGINES:
+        raise ValueError(f"Unknown server engine: {engine}")
+
+    if listener_processes > 1:
+        from .listeners import MultiProcessServer
+        return MultiProcessServer(engine, listener_processes, **kwargs)
+
+    if engine == 'asyncio':
+        from .async_server import AsyncChatServer
+        return AsyncChatServer(**kwargs)
+    return ChatServer(**kwargs)
+
+
+class PeerConnection:
+    """
+    Outgoing persistent connection to a peer.
+
+    On connections where the peer sends delivery acks, sent frames are
+    numbered and sending pauses while the credit granted by the peer's
+    last ack is used up, so an overloaded receiver slows senders down
+    instead of dropping their messages.
+    """
+
+    # Frames that may be sent before the first ack arrives
+    INITIAL_CREDIT = 32
+
+    def __init__(self, sock, acks: bool = False):
+        """
+        Initialize peer connection.
+
+        Args:
+            sock: Connected socket
+            acks: Whether the peer sends delivery acks on this connection
+        """
+        self.sock = sock
+        self.acks = acks
+        self.sent = 0
+        self.processed = 0
+        self.limit = self.INITIAL_CREDIT
+
+        # Hello replies received, answers to heartbeats
+        self.hellos = 0
+
+        # Bytes received from the peer that do not form a whole frame yet
+        self.inbox = bytearray()
+        self.recv_buffer = memoryview(bytearray(4096))
+
+    def send(self, message_data: bytes) -> int:
+        """
+        Send one frame, first waiting for credit if the peer sends acks.
+
+        Args:
+            message_data: Frame bytes
+
+        Returns:
+            Sequence number of the frame
+
+        Raises:
+            OSError: If the connection fails or no credit arrives in time
+            ValueError: If the peer sends an unexpected frame
+        """
+        if self.acks and self.sent >= self.limit:
+            start = metrics.clock()
+            while self.sent >= self.limit:
+                self._receive()
+            metrics.since('send.credit_wait', start)
+
+        start = metrics.clock()
+        framing.send_frame(self.sock, message_data)
+        metrics.since('send.write', start)
+        self.sent += 1
+        return self.sent
+
+    def wait_delivered(self, seq: int, timeout: float):
+        """
+        Wait until the peer has processed a frame. Returns at once on
+        connections without acks, where a written frame counts as delivered.
+
+        Args:
+            seq: Sequence number returned by send()
+            timeout: Seconds to wait
+
+        Raises:
+            OSError: If the connection fails or the timeout expires
+            ValueError: If the peer sends an unexpected frame
+        """
+        if not self.acks:
+            return
+
+        deadline = time.monotonic() + timeout
+        while self.processed < seq:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise socket.timeout("Timed out waiting for delivery ack")
+            self._receive(remaining)
+
+    def ping(self, timeout: float):
+        """
+        Send a hello frame as a heartbeat and wait for the peer's reply,
+        applying acks that arrive first. Only for connections with acks,
+        where the peer is known to answer hello frames.
+
+        Args:
+            timeout: Seconds to wait for the reply
+
+        Raises:
+            OSError: If the connection fails or no reply arrives in time
+            ValueError: If the peer sends an unexpected frame
+        """
+        replies = self.hellos
+        framing.send_frame(self.sock, message.pack_hello())
+
+        deadline = time.monotonic() + timeout
+        while self.hellos == replies:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise socket.timeout("Timed out waiting for heartbeat reply")
+            self._receive(remaining)
+
+    def poll(self):
+        """
+        Apply the acks and hello replies the peer sent, for callers that
+        select on the socket instead of blocking in send() or
+        wait_delivered(). Only call it once the socket is readable; the
+        socket timeout is left alone, so another thread may write at the
+        same time.
+
+        Raises:
+            OSError: If the connection fails
+            ValueError: If the peer sends an unexpected frame
+        """
+        self._receive()
+
+    def _receive(self, timeout: float = None):
+        """
+        Receive what the peer sent and apply every complete ack frame.
+
+        Args:
+            timeout: Seconds to wait for data (default: socket timeout)
+
+        Raises:
+            ConnectionError: If the peer closed the connection or announced an oversized frame
+        """
+        if timeout is not None:
+            previous = self.sock.gettimeout()
+            self.sock.settimeout(min(timeout, previous) if previous else timeout)
+            try:
+                read = self.sock.recv_into(self.recv_buffer)
+            finally:
+                self.sock.settimeout(previous)
+        else:
+            read = self.sock.recv_into(self.recv_buffer)
+
+        if not read:
+            raise ConnectionError("Connection closed by peer")
+        self.inbox += self.recv_buffer[:read]
+
+        # Frames are parsed in place; the view is released before the inbox shrinks
+        offset = 0
+        with memoryview(self.inbox) as inbox:
+            while len(inbox) - offset >= framing.HEADER.size:
+                frame_length = framing.HEADER.unpack_from(inbox, offset)[0]
+                if frame_length > message.MAX_FRAME_SIZE:
+                    raise ConnectionError(f"Invalid frame size from peer: {frame_length}")
+                start = offset + framing.HEADER.size
+                if len(inbox) - start < frame_length:
+                    break
+                offset = start + frame_length
+
+                # Hello replies to pipelined hellos and heartbeats carry nothing new
+                if frame_length and inbox[start] == message.FRAME_HELLO:
+                    self.hellos += 1
+                    continue
+
+                processed, window = message.unpack_delivery_ack(inbox[start:offset])
+                self.processed = max(self.processed, processed)
+                self.limit = max(self.limit, processed + window)
+        del self.inbox[:offset]
+
+    def is_alive(self) -> bool:
+        """
+        Check whether the connection can be reused, applying acks that
+        arrived while it was idle.
+
+        An idle connection should have nothing to read except acks. If the
+        peer closed it or sent anything else, it is not safe to reuse.
+
+        Returns:
+            True if connection can be reused, False otherwise
+        """
+        try:
+            readable, _, errored = select.select([self.sock], [], [self.sock], 0)
+            if errored:
+                return False
+            if readable:
+                if not self.acks:
+                    return False
+                self._receive()
+            return True
+        except (OSError, ValueError):
+            return False
+
+    def close(self):
+        """
+        Close the connection.
+        """
+        self.sock.close()
+
+
+class ConnectionPool:
+    """
+    Connection pool for reusing connections to frequently contacted peers.
+    Significantly improves performance for repeated messages to same peer.
+
+    Idle connections of all peers share one LRU order: when the pool is
+    full, the connection idle longest is closed, whichever peer it belongs
+    to. A background reaper closes connections idle longer than
+    connection_timeout, so peers contacted once do not hold sockets.
+    The lock is only held for dictionary updates, never for I/O, so the
+    pool can be used from any thread, including an event loop.
+    """
+
+    def __init__(self, max_connections_per_peer=3, connection_timeout=30, max_connections=256,
+                 reap_interval=5):
+        """
+        Initialize connection pool.
+
+        Args:
+            max_connections_per_peer: Maximum cached connections per peer
+            connection_timeout: Timeout for idle connections (seconds)
+            max_connections: Maximum cached connections over all peers (default: 256)
+            reap_interval: Seconds between idle connection sweeps (default: 5)
+        """
+        self.max_connections_per_peer = max_connections_per_peer
+        self.connection_timeout = connection_timeout
+        self.max_connections = max_connections
+        self.reap_interval = reap_interval
+
+        # Idle connections per peer, most recently returned last
+        self.pools = {}
+
+        # All idle connections, least recently returned first: conn -> (peer_key, time returned)
+        self.idle = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+        self.expired = 0
+
+        self.reaper = None
+        self.closed = threading.Event()
+
+    def _remove(self, conn):
+        """
+        Take an idle connection out of the pool (lock held).
+        """
+        peer_key, _ = self.idle.pop(conn)
+        pool = self.pools[peer_key]
+        pool.remove(conn)
+        if not pool:
+            del self.pools[peer_key]
+
+    def get_connection(self, host, port):
+        """
+        Get connection from pool or create new one.
+
+        Args:
+            host: Target host
+            port: Target port
+
+        Returns:
+            PeerConnection or None
+        """
+        peer_key = (host, port)
+
+        while True:
+            with self.lock:
+                pool = self.pools.get(peer_key)
+                if not pool:
+                    self.misses += 1
+                    break
+                conn = pool[-1]
+                returned = self.idle[conn][1]
+                self._remove(conn)
+
+            # Check if connection is still valid and not too old
+            if time.monotonic() - returned < self.connection_timeout and conn.is_alive():
+                with self.lock:
+                    self.hits += 1
+                metrics.increment('pool.hits')
+                return conn
+
+            # Connection expired or closed by peer, close it
+            with self.lock:
+                self.stale += 1
+            metrics.increment('pool.stale')
+            _close_quietly(conn)
+
+        # No valid connection in pool, return None (caller creates new)
+        metrics.increment('pool.misses')
+        return None
+
+    def take(self, host, port):
+        """
+        Take a peer's most recently returned idle connection out of the pool
+        without checking it or counting a hit or miss, e.g. for a heartbeat.
+
+        Args:
+            host: Target host
+            port: Target port
+
+        Returns:
+            Tuple of (PeerConnection, monotonic time it was returned), or None
+        """
+        with self.lock:
+            pool = self.pools.get((host, port))
+            if not pool:
+                return None
+            conn = pool[-1]
+            returned = self.idle[conn][1]
+            self._remove(conn)
+        return conn, returned
+
+    def return_connection(self, host, port, conn, returned=None):
+        """
+        Return connection to pool for reuse, evicting the connection idle
+        longest if the peer's or the whole pool's limit is reached.
+
+        Args:
+            host: Target host
+            port: Target port
+            conn: PeerConnection
+            returned: Monotonic time to count idleness from, to put back a
+                      connection from take() without refreshing it (default: now)
+        """
+        peer_key = (host, port)
+        evicted = []
+
+        with self.lock:
+            if self.closed.is_set():
+                evicted.append(conn)
+            else:
+                pool = self.pools.get(peer_key, ())
+                if len(pool) >= self.max_connections_per_peer:
+                    evicted.append(pool[0])
+                for oldest in self.idle:
+                    if len(self.idle) - len(evicted) < self.max_connections:
+                        break
+                    if oldest not in evicted:
+                        evicted.append(oldest)
+                for old in evicted:
+                    self._remove(old)
+
+                self.pools.setdefault(peer_key, []).append(conn)
+                self.idle[conn] = (peer_key, returned if returned is not None else time.monotonic())
+                self.evictions += len(evicted)
+
+                if self.reaper is None:
+                    self.reaper = threading.Thread(target=self._reap_loop, daemon=True, name="PoolReaper")
+                    self.reaper.start()
+
+        if evicted:
+            metrics.increment('pool.evictions', len(evicted))
+        for old in evicted:
+            _close_quietly(old)
+
+    def _reap_loop(self):
+        """
+        Close idle connections older than connection_timeout until the pool is closed.
+        """
+        while not self.closed.wait(self.reap_interval):
+            self.reap()
+
+    def reap(self) -> int:
+        """
+        Close connections idle longer than connection_timeout.
+
+        Returns:
+            Number of connections closed
+        """
+        expired = []
+        deadline = time.monotonic() - self.connection_timeout
+
+        with self.lock:
+            # Connections put back after a heartbeat keep their older idle time, so scan them all
+            for conn, (_, returned) in self.idle.items():
+                if returned <= deadline:
+                    expired.append(conn)
+            for conn in expired:
+                self._remove(conn)
+            self.expired += len(expired)
+
+        if expired:
+            metrics.increment('pool.expired', len(expired))
+        for conn in expired:
+            _close_quietly(conn)
+        return len(expired)
+
+    def stats(self) -> dict:
+        """
+        Get pool counters.
+
+        Returns:
+            Dictionary with 'idle' connections, 'peers' with idle connections,
+            and 'hits', 'misses', 'stale', 'evictions' and 'expired' counts
+        """
+        with self.lock:
+            return {
+                'idle': len(self.idle),
+                'peers': len(self.pools),
+                'hits': self.hits,
+                'misses': self.misses,
+                'stale': self.stale,
+                'evictions': self.evictions,
+                'expired': self.expired
+            }
+
+    def close_all(self, stop: bool = False):
+        """
+        Close all pooled connections.
+
+        Args:
+            stop: Also stop the reaper and close connections returned later
+                  instead of pooling them (default: False)
+        """
+        with self.lock:
+            connections = list(self.idle)
+            self.idle.clear()
+            self.pools.clear()
+            if stop:
+                self.closed.set()
+
+        for conn in connections:
+            _close_quietly(conn)
+
+
+def _close_quietly(conn):
+    try:
+        conn.close()
+    except OSError:
+        pass
+
+
+# Global connection pool for reusing connections
+_connection_pool = ConnectionPool()
+metrics.registry.set_gauge('pool.idle', lambda: len(_connection_pool.idle))
+
+# Negotiated per peer address ("host:port" -> (version, features, time))
+_peer_versions = {}
+_peer_versions_lock = threading.Lock()
+
+# Seconds to wait for a hello reply; older peers never answer
+HELLO_TIMEOUT = 2
+
+# Renegotiate after this many seconds in case the peer was upgraded or downgraded
+PEER_VERSION_TTL = 600
+
+# Seconds to wait for a delivery ack with wait_for_delivery
+DELIVERY_TIMEOUT = 30
+
+# TCP keepalive on outgoing connections: first probe after this many idle
+# seconds, then every KEEPALIVE_INTERVAL seconds, dead after KEEPALIVE_COUNT
+KEEPALIVE_IDLE = 30
+KEEPALIVE_INTERVAL = 10
+KEEPALIVE_COUNT = 3
+
+
+def _enable_keepalive(sock):
+    """
+    Turn on TCP keepalive probes, with shorter timings where the platform allows.
+    """
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    for option, value in (('TCP_KEEPIDLE', KEEPALIVE_IDLE), ('TCP_KEEPINTVL', KEEPALIVE_INTERVAL),
+                          ('TCP_KEEPCNT', KEEPALIVE_COUNT)):
+        if hasattr(socket, option):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+
+
+def _open_connection(host: str, port: int, timeout: float = addresses.CONNECT_TIMEOUT):
+    """
+    Open a new TCP socket to a peer, over whichever of its addresses
+    answers first (see addresses.connect).
+
+    Args:
+        host: Target host (the peer's primary address)
+        port: Target port
+        timeout: Seconds to wait for any address (default: 10)
+
+    Returns:
+        Connected socket
+    """
+    # Connect to recipient
+    start = metrics.clock()
+    sock = addresses.connect(host, port, timeout)
+    metrics.since('send.connect', start)
+
+    try:
+        sock.settimeout(10)
+
+        # Enable TCP_NODELAY for lower latency
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        # Detect dead peers on pooled connections without sending anything
+        _enable_keepalive(sock)
+    except:
+        sock.close()
+        raise
+    return sock
+
+
+def _negotiate(recipient_host: str, recipient_port: int, timeout: float = addresses.CONNECT_TIMEOUT) -> tuple:
+    """
+    Get the envelope version and features to use with a peer, asking it
+    with a hello frame on a new connection if not known yet. The connection
+    is pooled afterwards, so negotiation costs no extra connection setup.
+
+    Args:
+        recipient_host: Recipient's IP address
+        recipient_port: Recipient's port number
+        timeout: Seconds to wait for the connection (default: 10)
+
+    Returns:
+        Tuple of (version, frozenset of features); (1, empty set) for peers
+        that do not answer hello frames
+
+    Raises:
+        ConnectionError: If the peer cannot be reached
+    """
+    peer_key = f"{recipient_host}:{recipient_port}"
+
+    with _peer_versions_lock:
+        cached = _peer_versions.get(peer_key)
+    if cached is not None and time.time() - cached[2] < PEER_VERSION_TTL:
+        return cached[0], cached[1]
+
+    try:
+        sock = _open_connection(recipient_host, recipient_port, timeout)
+    except socket.error:
+        raise ConnectionError(f"Could not connect to {recipient_host}:{recipient_port}")
+
+    try:
+        sock.settimeout(HELLO_TIMEOUT)
+        framing.send_frame(sock, message.pack_hello())
+        version, features = message.negotiate(_recv_frame(sock))
+        sock.settimeout(10)
+        _connection_pool.return_connection(recipient_host, recipient_port, PeerConnection(sock, 'ack' in features))
+    except (OSError, ValueError):
+        # Peer predates version negotiation
+        sock.close()
+        version, features = 1, frozenset()
+
+    with _peer_versions_lock:
+        _peer_versions[peer_key] = (version, features, time.time())
+    return version, features
+
+
+def negotiate_version(recipient_host: str, recipient_port: int) -> int:
+    """
+    Get the envelope version to use with a peer (see _negotiate).
+
+    Args:
+        recipient_host: Recipient's IP address
+        recipient_port: Recipient's port number
+
+    Returns:
+        Envelope version (1 for peers that do not answer hello frames)
+
+    Raises:
+        ConnectionError: If the peer cannot be reached
+    """
+    return _negotiate(recipient_host, recipient_port)[0]
+
+
+def negotiate_features(recipient_host: str, recipient_port: int, timeout: float = addresses.CONNECT_TIMEOUT) -> tuple:
+    """
+    Get the envelope version and optional frame types to use with a peer (see _negotiate).
+
+    Args:
+        recipient_host: Recipient's IP address
+        recipient_port: Recipient's port number
+        timeout: Seconds to wait for a new connection (default: 10)
+
+    Returns:
+        Tuple of (version, frozenset of features)
+
+    Raises:
+        ConnectionError: If the peer cannot be reached
+    """
+    return _negotiate(recipient_host, recipient_port, timeout)
+
+
+def cached_version(recipient_host: str, recipient_port: int) -> int:
+    """
+    Get the envelope version negotiated with a peer earlier, without contacting it.
+
+    Args:
+        recipient_host: Recipient's IP address
+        recipient_port: Recipient's port number
+
+    Returns:
+        Negotiated envelope version, or 1 if not negotiated yet
+    """
+    return cached_features(recipient_host, recipient_port)[0]
+
+
+def cached_features(recipient_host: str, recipient_port: int, default=(1, frozenset())) -> tuple:
+    """
+    Get the envelope version and features negotiated with a peer earlier,
+    without contacting it.
+
+    Args:
+        recipient_host: Recipient's IP address
+        recipient_port: Recipient's port number
+        default: Returned if not negotiated yet (default: (1, empty set),
+                 envelopes every peer reads)
+
+    Returns:
+        Tuple of (version, frozenset of features), or default
+    """
+    with _peer_versions_lock:
+        cached = _peer_versions.get(f"{recipient_host}:{recipient_port}")
+    return (cached[0], cached[1]) if cached is not None else default
+
+
+def _connect_peer(recipient_host: str, recipient_port: int,
+                  timeout: float = addresses.CONNECT_TIMEOUT) -> PeerConnection:
+    """
+    Open a new connection to a peer, asking for delivery acks if the peer
+    is known to send them. The hello frame is pipelined with the first
+    message; its reply is skipped when acks are read.
+
+    Args:
+        recipient_host: Recipient's IP address
+        recipient_port: Recipient's port number
+        timeout: Seconds to wait for the connection (default: 10)
+
+    Returns:
+        PeerConnection
+    """
+    with _peer_versions_lock:
+        cached = _peer_versions.get(f"{recipient_host}:{recipient_port}")
+    acks = cached is not None and 'ack' in cached[1]
+
+    sock = _open_connection(recipient_host, recipient_port, timeout)
+    if acks:
+        try:
+            framing.send_frame(sock, message.pack_hello())
+        except:
+            sock.close()
+            raise
+    return PeerConnection(sock, acks)
+
+
+def checkout_connection(recipient_host: str, recipient_port: int,
+                        timeout: float = addresses.CONNECT_TIMEOUT) -> tuple:
+    """
+    Take a pooled connection to a peer, or open a new one, for a caller
+    that writes on it and reads its acks itself. Give it back with
+    checkin_connection, or close it.
+
+    Args:
+        recipient_host: Recipient's IP address
+        recipient_port: Recipient's port number
+        timeout: Seconds to wait for a new connection (default: 10)
+
+    Returns:
+        Tuple of (PeerConnection, whether it came from the pool); a pooled
+        connection may still turn out stale on the first write
+
+    Raises:
+        ConnectionError: If the peer cannot be reached
+    """
+    start = metrics.clock()
+    conn = _connection_pool.get_connection(recipient_host, recipient_port)
+    if conn is not None:
+        metrics.since('send.pool_hit', start)
+        return conn, True
+
+    try:
+        return _connect_peer(recipient_host, recipient_port, timeout), False
+    except socket.error:
+        raise ConnectionError(f"Could not connect to {recipient_host}:{recipient_port}")
+
+
+def checkin_connection(recipient_host: str, recipient_port: int, conn: PeerConnection):
+    """
+    Give a connection from checkout_connection back to the pool.
+
+    Args:
+        recipient_host: Recipient's IP address
+        recipient_port: Recipient's port number
+        conn: PeerConnection with no frames waiting for acks
+    """
+    _connection_pool.return_connection(recipient_host, recipient_port, conn)
+
+
+def heartbeat(recipient_host: str, recipient_port: int, timeout: float = HELLO_TIMEOUT) -> bool:
+    """
+    Check whether a peer is reachable. An idle pooled connection is
+    checked with a hello frame where the peer answers them, and put back
+    without counting as used; without one, a probe connection is opened
+    (and sends a hello if the peer answers them) and closed again, so
+    checks do not keep connections to peers that are not messaged.
+
+    Args:
+        recipient_host: Recipient's IP address
+        recipient_port: Recipient's port number
+        timeout: Seconds to wait for a connection or reply (default: 2)
+
+    Returns:
+        True if the peer answered
+    """
+    taken = _connection_pool.take(recipient_host, recipient_port)
+    if taken is not None:
+        conn, returned = taken
+        try:
+            if not conn.is_alive():
+                raise ConnectionError("Connection closed by peer")
+            if conn.acks:
+                conn.ping(timeout)
+        except (OSError, ValueError):
+            # Stale connection, probe the peer afresh
+            _close_quietly(conn)
+        else:
+            metrics.increment('presence.heartbeats')
+            _connection_pool.return_connection(recipient_host, recipient_port, conn, returned)
+            return True
+
+    with _peer_versions_lock:
+        cached = _peer_versions.get(f"{recipient_host}:{recipient_port}")
+    metrics.increment('presence.probes')
+
+    try:
+        sock = _open_connection(recipient_host, recipient_port, timeout)
+    except OSError:
+        return False
+
+    try:
+        # Peers that predate version negotiation only get the connection
+        if cached is not None and cached[1]:
+            sock.settimeout(timeout)
+            framing.send_frame(sock, message.pack_hello())
+            message.negotiate(_recv_frame(sock))
+        return True
+    except (OSError, ValueError):
+        return False
+    finally:
+        sock.close()
+
+
+def send_data(recipient_host: str, recipient_port: int, message_data: bytes, use_pooling=True,
+              wait_for_delivery=False):
+    """
+    Send an already serialized message envelope to a peer.
+
+    Args:
+        recipient_host: Recipient's IP address
+        recipient_port: Recipient's port number
+        message_data: Serialized message bytes
+        use_pooling: Whether to use connection pooling (default: True)
+        wait_for_delivery: Wait until the peer acks that it processed the
+                           message; for peers without delivery acks, sending
+                           counts as delivered (default: False)
+
+    Returns:
+        True if sent (and delivered, with wait_for_delivery) successfully
+
+    Raises:
+        ConnectionError: If connection, send or delivery fails
+    """
+    try:
+        # Try to get connection from pool
+        conn = None
+        if use_pooling:
+            start = metrics.clock()
+            conn = _connection_pool.get_connection(recipient_host, recipient_port)
+            if conn is not None:
+                metrics.since('send.pool_hit', start)
+
+        if conn is not None:
+            try:
+                seq = conn.send(message_data)
+            except (OSError, ValueError):
+                # Pooled connection went stale, retry once on a fresh one
+                try:
+                    conn.close()
+                except:
+                    pass
+                conn = None
+
+        if conn is None:
+            # Create new connection
+            conn = _connect_peer(recipient_host, recipient_port)
+            try:
+                seq = conn.send(message_data)
+            except:
+                conn.close()
+                raise
+
+        try:
+            if wait_for_delivery:
+                conn.wait_delivered(seq, DELIVERY_TIMEOUT)
+        except:
+            # Connection state unknown, do not reuse it
+            conn.close()
+            raise
+
+        # Return connection to pool for reuse
+        if use_pooling:
+            _connection_pool.return_connection(recipient_host, recipient_port, conn)
+        else:
+            conn.close()
+
+        return True
+
+    except socket.timeout:
+        if wait_for_delivery:
+            raise ConnectionError(f"No delivery ack from {recipient_host}:{recipient_port}")
+        raise ConnectionError(f"Could not connect to {recipient_host}:{recipient_port}")
+    except ValueError as e:
+        raise ConnectionError(f"Unexpected reply from {recipient_host}:{recipient_port}: {e}")
+    except socket.error as e:
+        if "Connection refused" in str(e):
+            raise ConnectionError(f"Could not connect to {recipient_host}:{recipient_port}")
+        else:
+            raise ConnectionError(f"Failed to send message: {e}")
+
+
+class _PendingSend:
+    """
+    One message waiting in a FrameCoalescer queue.
+    """
+
+    __slots__ = ('data', 'wait', 'done', 'error', 'lead')
+
+    def __init__(self, data: bytes, wait: bool):
+        self.data = data
+        self.wait = wait
+        self.done = threading.Event()
+        self.error = None
+        self.lead = False
+
+
+class _PeerSendQueue:
+    """
+    Outgoing messages for one peer waiting to be coalesced.
+    """
+
+    __slots__ = ('pending', 'sending', 'last_batch_size', 'last_flush', 'lingering')
+
+    def __init__(self):
+        self.pending = []
+        self.sending = False
+        self.last_batch_size = 0
+        self.last_flush = 0.0
+
+        # Whether the queue is in FrameCoalescer.lingering
+        self.lingering = False
+
+
+class FrameCoalescer:
+    """
+    Per-peer micro-batching of outgoing envelopes.
+
+    The first sender to an idle peer writes its message immediately, so
+    latency is unchanged when idle. Messages for the same peer that arrive
+    while a write is in progress are queued and the next sender in line
+    writes them all as one batch frame, so a burst costs one write instead
+    of one per message. While batches keep forming, writers wait up to
+    max_delay to let the batch fill. A peer's queue is forgotten once it
+    is empty and idle, so peers contacted once leave no state behind.
+    """
+
+    # A peer counts as busy if its last batch was written this recently (seconds)
+    BURST_WINDOW = 0.05
+
+    def __init__(self, max_delay=0.001, max_batch_bytes=256 * 1024, max_batch_messages=256):
+        """
+        Initialize frame coalescer.
+
+        Args:
+            max_delay: Seconds to wait for more messages before flushing a
+                       batch under load; idle sends never wait (default: 0.001)
+            max_batch_bytes: Maximum envelope bytes per batch frame (default: 256 KiB)
+            max_batch_messages: Maximum envelopes per batch frame (default: 256)
+        """
+        self.max_delay = max_delay
+        self.max_batch_bytes = max_batch_bytes
+        self.max_batch_messages = max_batch_messages
+
+        # Peer key -> _PeerSendQueue while the peer is being sent to
+        self.queues = {}
+        self.queues_lock = threading.Lock()
+
+        # (peer key, queue) of idle queues kept for BURST_WINDOW after a
+        # batch, so a send right after a burst still lingers; oldest first
+        self.lingering = deque()
+
+    def send(self, recipient_host: str, recipient_port: int, message_data: bytes, wait_for_delivery=False):
+        """
+        Send a serialized envelope, coalescing it with concurrent sends to the same peer.
+
+        Args:
+            recipient_host: Recipient's IP address
+            recipient_port: Recipient's port number
+            message_data: Serialized message bytes
+            wait_for_delivery: Wait for the peer's delivery ack (see send_data);
+                               the whole batch waits if any message in it does
+
+        Returns:
+            True if sent successfully
+
+        Raises:
+            ConnectionError: If connection, send or delivery fails
+        """
+        peer_key = f"{recipient_host}:{recipient_port}"
+        pending = _PendingSend(message_data, wait_for_delivery)
+
+        with self.queues_lock:
+            queue = self.queues.get(peer_key)
+            if queue is None:
+                queue = self.queues[peer_key] = _PeerSendQueue()
+            queue.pending.append(pending)
+            lead = not queue.sending
+            queue.sending = True
+
+            # Keep batching while recent writes carried several messages
+            linger = (queue.last_batch_size > 1 and
+                      time.monotonic() - queue.last_flush < self.BURST_WINDOW)
+
+        if lead:
+            self._flush(queue, recipient_host, recipient_port, linger)
+
+        while True:
+            pending.done.wait()
+            if not pending.lead:
+                break
+
+            # Previous writer handed over, we write the queued batch
+            pending.lead = False
+            pending.done.clear()
+            self._flush(queue, recipient_host, recipient_port, linger=True)
+
+        if pending.error is not None:
+            raise pending.error
+        return True
+
+    def _flush(self, queue: _PeerSendQueue, recipient_host: str, recipient_port: int, linger: bool):
+        """
+        Write one batch of queued messages for a peer, then hand the queue
+        over to the next waiting sender.
+
+        Args:
+            queue: Send queue of the peer
+            recipient_host: Recipient's IP address
+            recipient_port: Recipient's port number
+            linger: Whether to wait max_delay for more messages first
+        """
+        if linger and self.max_delay:
+            time.sleep(self.max_delay)
+
+        with self.queues_lock:
+            batch = [queue.pending[0]]
+            size = len(batch[0].data)
+            for item in queue.pending[1:self.max_batch_messages]:
+                size += len(item.data)
+                if size > self.max_batch_bytes:
+                    break
+                batch.append(item)
+            del queue.pending[:len(batch)]
+            queue.last_batch_size = len(batch)
+            queue.last_flush = time.monotonic()
+
+        wait = any(item.wait for item in batch)
+        try:
+            if len(batch) == 1:
+                send_data(recipient_host, recipient_port, batch[0].data, wait_for_delivery=wait)
+            else:
+                send_data(recipient_host, recipient_port, message.pack_batch([item.data for item in batch]),
+                          wait_for_delivery=wait)
+            error = None
+        except Exception as e:
+            # Every waiter in the batch gets the error, none may hang
+            error = e
+
+        for item in batch:
+            item.error = error
+            item.done.set()
+
+        with self.queues_lock:
+            if not queue.pending:
+                queue.sending = False
+                peer_key = f"{recipient_host}:{recipient_port}"
+                if queue.last_batch_size <= 1:
+                    self._forget(peer_key, queue)
+                elif not queue.lingering:
+                    queue.lingering = True
+                    self.lingering.append((peer_key, queue))
+
+                # Forget queues whose burst is over; busy ones come back once idle
+                now = time.monotonic()
+                while self.lingering:
+                    old_key, old_queue = self.lingering[0]
+                    idle = not old_queue.sending and not old_queue.pending
+                    if idle and now - old_queue.last_flush < self.BURST_WINDOW:
+                        break
+                    self.lingering.popleft()
+                    old_queue.lingering = False
+                    if idle:
+                        self._forget(old_key, old_queue)
+                return
+            successor = queue.pending[0]
+            successor.lead = True
+        successor.done.set()
+
+
+    def _forget(self, peer_key: str, queue: _PeerSendQueue):
+        """
+        Drop a peer's queue if it is still the current one and idle (queues_lock held).
+        """
+        if self.queues.get(peer_key) is queue and not queue.sending and not queue.pending:
+            del self.queues[peer_key]
+
+
+# Global frame coalescer for send_message
+_frame_coalescer = FrameCoalescer()
+
+
+def configure_coalescing(max_delay=0.001, max_batch_bytes=256 * 1024, max_batch_messages=256):
+    """
+    Replace the frame coalescer used by send_message.
+
+    Args:
+        max_delay: Seconds to wait for more messages under load (0 disables waiting)
+        max_batch_bytes: Maximum envelope bytes per batch frame
+        max_batch_messages: Maximum envelopes per batch frame (1 disables batching)
+    """
+    global _frame_coalescer
+    _frame_coalescer = FrameCoalescer(max_delay, max_batch_bytes, max_batch_messages)
+
+
+def configure_pool(max_connections=256, max_connections_per_peer=3, connection_timeout=30):
+    """
+    Replace the connection pool used by send_data, closing the connections of the old one.
+
+    Args:
+        max_connections: Maximum cached connections over all peers
+        max_connections_per_peer: Maximum cached connections per peer
+        connection_timeout: Seconds a connection may stay idle in the pool
+    """
+    global _connection_pool
+    old_pool = _connection_pool
+    _connection_pool = ConnectionPool(max_connections_per_peer, connection_timeout, max_connections)
+    old_pool.close_all(stop=True)
+
+
+def pool_stats() -> dict:
+    """
+    Get the counters of the connection pool used by send_data (see ConnectionPool.stats).
+    """
+    return _connection_pool.stats()
+
+
+def _recv_frame(sock) -> bytearray:
+    """
+    Receive one length-prefixed frame on the sending side.
+
+    Args:
+        sock: Connected socket
+
+    Returns:
+        Frame bytes
+
+    Raises:
+        ConnectionError: If the peer closed the connection or announced an oversized frame
+    """
+    try:
+        frame = framing.recv_frame(sock, message.MAX_FRAME_SIZE)
+    except ValueError as e:
+        raise ConnectionError(f"{e} from peer")
+    if frame is None:
+        raise ConnectionError("Connection closed by peer")
+    return frame
+
+
+def send_file(recipient_host: str, recipient_port: int, recipient_fingerprint: str, file_path: str,
+              sender_private_key, sender_fingerprint: str, transfer_id: str = None, progress_callback=None):
+    """
+    Stream file to peer in encrypted chunks with constant memory.
+    If the transfer breaks, calling again with the returned transfer_id
+    resumes from the last chunk the recipient acknowledged.
+
+    Args:
+        recipient_host: Recipient's IP address
+        recipient_port: Recipient's port number
+        recipient_fingerprint: Recipient's key fingerprint
+        file_path: Path of file to send
+        sender_private_key: Sender's private key
+        sender_fingerprint: Sender's key fingerprint
+        transfer_id: ID of an interrupted transfer to resume (optional)
+        progress_callback: Function called with (bytes_acknowledged, total_bytes) (optional)
+
+    Returns:
+        Transfer ID
+
+    Raises:
+        ConnectionError: If connection or transfer fails
+        ValueError: If recipient key not found
+    """
+    try:
+        recipient_public_key = keystore.load_peer_key(recipient_fingerprint)
+    except FileNotFoundError:
+        raise ValueError(f"Peer not found: {recipient_fingerprint}")
+
+    size = os.path.getsize(file_path)
+    chunk_size = transfer.CHUNK_SIZE
+    chunk_count = -(-size // chunk_size)
+
+    manifest_frame, transfer_id, key = transfer.create_manifest(
+        os.path.basename(file_path),
+        size,
+        recipient_public_key,
+        sender_private_key,
+        sender_fingerprint,
+        transfer_id
+    )
+
+    try:
+        # Transfers use a dedicated connection, never a pooled one
+        sock = _open_connection(recipient_host, recipient_port)
+    except socket.error:
+        raise ConnectionError(f"Could not connect to {recipient_host}:{recipient_port}")
+
+    try:
+        sock.settimeout(60)
+        framing.send_frame(sock, manifest_frame)
+
+        # Receiver tells us where to resume
+        acked, _ = transfer.unpack_ack(_recv_frame(sock))
+        if acked > chunk_count:
+            raise ValueError("Receiver acknowledged more chunks than the file has")
+
+        hasher = hashlib.sha256()
+        buffer = bytearray(chunk_size)
+        view = memoryview(buffer)
+
+        with open(file_path, 'rb') as f:
+            # Hash the part the receiver already has
+            for _ in range(acked):
+                read = f.readinto(buffer)
+                hasher.update(view[:read])
+
+            index = acked
+            while index < chunk_count:
+                read = f.readinto(buffer)
+                if not read:
+                    raise ValueError("File shrank during transfer")
+
+                chunk = view[:read]
+                hasher.update(chunk)
+                framing.send_frame_parts(sock, transfer.encrypt_chunk(key, transfer_id, index, chunk))
+                index += 1
+
+                # Wait for acks when too far ahead of the receiver
+                while index - acked >= transfer.WINDOW:
+                    acked, _ = transfer.unpack_ack(_recv_frame(sock))
+                    if progress_callback:
+                        progress_callback(min(acked * chunk_size, size), size)
+
+        framing.send_frame(sock, transfer.encrypt_end(key, transfer_id, hasher.digest(), chunk_count))
+
+        # Drain acks until receiver confirms the verified file
+        while True:
+            acked, complete = transfer.unpack_ack(_recv_frame(sock))
+            if complete:
+                break
+
+        if progress_callback:
+            progress_callback(size, size)
+
+        return transfer_id
+
+    except (OSError, ValueError) as e:
+        raise ConnectionError(f"File transfer {transfer_id} failed: {e}")
+
+    finally:
+        sock.close()
+
+
+def send_message(recipient_host: str, recipient_port: int, recipient_fingerprint: str,
+                plaintext: str, sender_private_key, sender_fingerprint: str, use_pooling=True,
+                use_sessions=True, wait_for_delivery=False):
+    """
+    Send encrypted message to peer with connection pooling for performance.
+
+    Args:
+        recipient_host: Recipient's IP address
+        recipient_port: Recipient's port number
+        recipient_fingerprint: Recipient's key fingerprint
+        plaintext: Message text to send
+        sender_private_key: Sender's RSA private key
+        sender_fingerprint: Sender's key fingerprint
+        use_pooling: Whether to use connection pooling (default: True)
+        use_sessions: Whether to encrypt with a per-peer session key instead of
+                      per-message RSA operations, for recipients that announced
+                      session support (default: True)
+        wait_for_delivery: Wait until the recipient acks that it processed the
+                           message; for peers without delivery acks, sending
+                           counts as delivered (default: False)
+
+    Returns:
+        True if sent (and delivered, with wait_for_delivery) successfully
+
+    Raises:
+        ConnectionError: If connection, send or delivery fails
+        ValueError: If recipient key not found
+    """
+    # Load recipient's public key (with caching in keystore)
+    try:
+        recipient_public_key = keystore.load_peer_key(recipient_fingerprint)
+    except FileNotFoundError:
+        raise ValueError(f"Peer not found: {recipient_fingerprint}")
+
+    # Use the most compact envelope format the recipient understands
+    version, features = _negotiate(recipient_host, recipient_port)
+
+    # Create encrypted message; peers that did not announce sessions cannot read session envelopes
+    if use_sessions:
+        message_data = message.create_peer_message(
+            plaintext,
+            recipient_fingerprint,
+            recipient_public_key,
+            sender_private_key,
+            sender_fingerprint,
+            version,
+            features
+        )
+    else:
+        message_data = message.create_message(
+            plaintext,
+            recipient_public_key,
+            sender_private_key,
+            sender_fingerprint,
+            version
+        )
+
+    # Coalesce concurrent sends to peers that accept batch frames
+    if use_pooling and 'batch' in features:
+        return _frame_coalescer.send(recipient_host, recipient_port, message_data, wait_for_delivery)
+
+    return send_data(recipient_host, recipient_port, message_data, use_pooling, wait_for_delivery)
+
+
+def send_batch_messages(recipients: list, plaintext: str, sender_private_key, sender_fingerprint: str,
+                        wait_for_delivery=False, presence=None, engine=None):
+    """
+    Send same message to multiple recipients in parallel for maximum performance.
+    The message is encrypted and signed once into a multi-recipient envelope
+    and the same bytes are sent to every recipient that announced 'multi';
+    older recipients each get their own envelope. Sending runs on a send
+    engine (see sender.SendEngine), so connects and ack waits of slow
+    recipients hold no thread of their own. With a presence monitor,
+    recipients known to be offline fail at once instead of each waiting out
+    a connect timeout, and the results update their presence.
+
+    Args:
+        recipients: List of (host, port, fingerprint) tuples
+        plaintext: Message text to send
+        sender_private_key: Sender's RSA private key
         sender_fingerprint: Sender's key fingerprint
+        wait_for_delivery: Count a recipient as successful only once it acks
+                           that it processed the message (default: False)
+        presence: presence.PresenceMonitor tracking the recipients (optional)
+        engine: sender.SendEngine of the node (default: one shared by the process)
 
     Returns:
-        Dictionary mapping recipient fingerprint to success status
+        Tuple of (dictionary mapping recipient fingerprint to success status,
+        dictionary mapping failed recipient fingerprint to error message)
     """
+    if engine is None:
+        from .sender import shared_engine
+        engine = shared_engine()
+
     results = {}
     errors = {}
 
-    # Use ThreadPoolExecutor for parallel sends
-    with ThreadPoolExecutor(max_workers=min(len(recipients), 10), thread_name_prefix="BatchSend") as executor:
-        futures = {}
-
-        # Submit all send operations
-        for host, port, fingerprint in recipients:
-            future = executor.submit(
-                send_message,
-                host, port, fingerprint,
-                plaintext, sender_private_key, sender_fingerprint
-            )
-            futures[future] = fingerprint
-
-        # Collect results
-        for future in futures:
-            fingerprint = futures[future]
-            try:
-                future.result(timeout=15)
-                results[fingerprint] = True
-            except Exception as e:
-                results[fingerprint] = False
-                errors[fingerprint] = str(e)
+    targets = []
+    for host, port, fingerprint in recipients:
+        if presence is not None and presence.is_offline(fingerprint):
+            metrics.increment('send.offline_skipped')
+            results[fingerprint] = False
+            errors[fingerprint] = f"Peer offline: {fingerprint}"
+            continue
+        targets.append((host, port, fingerprint))
+
+    futures, rejected = engine.broadcast(targets, plaintext, wait_for_delivery,
+                                         private_key=sender_private_key, fingerprint=sender_fingerprint)
+    for fingerprint, error in rejected.items():
+        results[fingerprint] = False
+        errors[fingerprint] = error
+
+    # The engine fails sends after its connect timeout, or the delivery timeout for acks
+    for fingerprint, future in futures.items():
+        try:
+            future.result()
+            results[fingerprint] = True
+        except Exception as e:
+            results[fingerprint] = False
+            errors[fingerprint] = str(e)
+
+        # An engine with the same monitor has told it already
+        if presence is not None and presence is not engine.presence:
+            if results[fingerprint]:
+                presence.seen(fingerprint)
+            else:
+                presence.failed(fingerprint)
 
     return results, errors
@@ -0,0 +1,645 @@
+"""
+Outbox module for Enclave.
+Outgoing messages are appended to a log on disk and sending returns at
+once. A background flusher hands them per peer to the node's send engine
+(see sender.SendEngine), retries unreachable peers with exponential
+backoff, sends everything queued for a peer as batch frames once it is
+reachable again, and resumes after a restart. Connects and ack waits run
+in the engine, so no outbox thread waits on a peer. With a presence
+monitor, peers known to be offline are not retried at all until the
+monitor sees them back, and then at once.
+
+Receivers reject envelopes older than five minutes, so the log keeps each
+plaintext sealed to our own key, once per broadcast in a seal record the
+entries of all recipients refer to. The envelope built when a message is
+queued is reused for every retry while it is fresh, and rebuilt from the
+sealed copy only once it has gone stale.
+"""
+
+import os
+import time
+import uuid
+import random
+import threading
+import msgpack
+from pathlib import Path
+from functools import partial
+from . import crypto, keystore, message, network, sender
+
+
+# First retry delay and maximum retry delay (seconds)
+RETRY_BASE = 1
+RETRY_MAX = 300
+
+# Undelivered messages are dropped after this many seconds
+MAX_AGE = 7 * 24 * 3600
+
+# Envelopes older than this are rebuilt before sending, well inside the
+# receivers' 5-minute timestamp window
+ENVELOPE_MAX_AGE = 240
+
+# Most messages handed to the send engine per delivery round for a peer
+BATCH_MESSAGES = 64
+
+# Rewrite the log once it holds this many delivered or dropped messages
+COMPACT_THRESHOLD = 1000
+
+
+class _Entry:
+    """
+    One queued message for one recipient.
+    """
+
+    __slots__ = ('entry_id', 'fingerprint', 'host', 'port', 'created', 'sealed', 'seal_id',
+                 'plaintext', 'envelope', 'version', 'requires', 'envelope_time')
+
+    def __init__(self, entry_id: bytes, fingerprint: str, host: str, port: int, created: float, sealed: dict,
+                 seal_id: bytes = None):
+        self.entry_id = entry_id
+        self.fingerprint = fingerprint
+        self.host = host
+        self.port = port
+        self.created = created
+        self.sealed = sealed
+
+        # Seal record shared with the other recipients of a broadcast, else None
+        self.seal_id = seal_id
+
+        # Only kept in memory; rebuilt from sealed after a restart
+        self.plaintext = None
+        self.envelope = None
+        self.version = 1
+        self.envelope_time = 0.0
+
+        # Features the peer must have announced to read the envelope
+        self.requires = frozenset()
+
+    def record(self) -> dict:
+        """
+        Log record that restores this entry; entries of a broadcast refer to
+        their seal record instead of carrying the sealed copy.
+        """
+        record = {'op': 'add', 'id': self.entry_id, 'fp': self.fingerprint, 'host': self.host,
+                  'port': self.port, 'created': self.created}
+        if self.seal_id is None:
+            record['sealed'] = self.sealed
+        else:
+            record['sid'] = self.seal_id
+        return record
+
+    def seal_record(self) -> dict:
+        """
+        Log record holding the sealed copy shared by a broadcast's entries.
+        """
+        return {'op': 'seal', 'sid': self.seal_id, 'sealed': self.sealed}
+
+
+class _PeerQueue:
+    """
+    Queued messages and retry state for one recipient.
+    """
+
+    __slots__ = ('entries', 'attempts', 'next_attempt', 'busy')
+
+    def __init__(self):
+        self.entries = []
+        self.attempts = 0
+        self.next_attempt = 0.0
+        self.busy = False
+
+
+class Outbox:
+    """
+    Durable outgoing message queue with per-peer retry.
+    """
+
+    def __init__(self, private_key, fingerprint: str, path=keystore.OUTBOX_PATH,
+                 delivery_callback=None, workers: int = 4, presence=None, engine=None):
+        """
+        Initialize outbox.
+
+        Args:
+            private_key: User's private key for signing and sealing
+            fingerprint: User's key fingerprint
+            path: Log file (default: keys/outbox.log)
+            delivery_callback: Function called once per message when it is delivered
+                               or dropped (signature: callback(recipient_fingerprint,
+                               entry_id, plaintext, error)); error is None on delivery
+            workers: Number of worker threads of the send engine created
+                     when none is given (default: 4)
+            presence: presence.PresenceMonitor consulted to hold messages for
+                      offline peers, and told about delivery results by the
+                      engine created when none is given (optional)
+            engine: Started sender.SendEngine of the node to deliver with; it
+                    must outlive the outbox (default: one owned by the outbox)
+        """
+        self.private_key = private_key
+        self.public_key = private_key.public_key()
+        self.fingerprint = fingerprint
+        self.path = Path(path)
+        self.delivery_callback = delivery_callback
+        self.presence = presence
+
+        self.owns_engine = engine is None
+        self.engine = engine if engine is not None else sender.SendEngine(
+            private_key, fingerprint, workers, presence=presence)
+
+        self.queues = {}
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.running = False
+
+        self.log = None
+        self.dirty = False
+        self.finished = 0
+
+        self.flusher = None
+
+        if presence is not None:
+            presence.add_listener(self._on_presence)
+
+    def start(self):
+        """
+        Load messages left from the last run and start delivering.
+        """
+        self._load()
+
+        self.log = open(self.path, 'ab')
+        os.chmod(self.path, 0o600)
+
+        self.running = True
+        if self.owns_engine:
+            self.engine.start()
+        self.flusher = threading.Thread(target=self._flush_loop, daemon=True, name="OutboxFlusher")
+        self.flusher.start()
+
+        queued = sum(len(queue.entries) for queue in self.queues.values())
+        if queued:
+            print(f"Outbox: {queued} queued message(s) from last run")
+
+    def stop(self):
+        """
+        Stop delivering and sync the log. Messages still queued are sent on the next start.
+        """
+        if not self.running:
+            return
+        self.running = False
+        self.wake.set()
+        self.flusher.join()
+
+        # Our own engine fails what is in flight, which is retried on the
+        # next start; a node's engine may still finish deliveries, logged
+        # if they finish before the log is closed
+        if self.owns_engine:
+            self.engine.stop()
+
+        with self.lock:
+            self._sync()
+            self.log.close()
+            self.log = None
+
+    def send(self, recipient_host: str, recipient_port: int, recipient_fingerprint: str, plaintext: str) -> str:
+        """
+        Queue a message for a peer.
+
+        Args:
+            recipient_host: Recipient's IP address
+            recipient_port: Recipient's port number
+            recipient_fingerprint: Recipient's key fingerprint
+            plaintext: Message text to send
+
+        Returns:
+            Entry ID (hex) passed to the delivery callback
+
+        Raises:
+            ValueError: If recipient key not found
+        """
+        try:
+            recipient_public_key = keystore.load_peer_key(recipient_fingerprint)
+        except FileNotFoundError:
+            raise ValueError(f"Peer not found: {recipient_fingerprint}")
+
+        # Peers not negotiated with yet get a classic envelope, which every peer reads
+        version, features = network.cached_features(recipient_host, recipient_port)
+        envelope = message.create_peer_message(
+            plaintext,
+            recipient_fingerprint,
+            recipient_public_key,
+            self.private_key,
+            self.fingerprint,
+            version,
+            features
+        )
+
+        entry = self._new_entry(recipient_fingerprint, recipient_host, recipient_port, plaintext, envelope, version,
+                                features & {'session'})
+        self._enqueue([entry])
+        return entry.entry_id.hex()
+
+    def broadcast(self, recipients: list, plaintext: str) -> tuple:
+        """
+        Queue the same message for several peers, sealed to our own key once
+        and encrypted and signed once into a multi-recipient envelope per
+        envelope version for peers known to read them. Envelopes for the
+        other peers are built per peer when they are delivered.
+
+        Args:
+            recipients: List of (host, port, fingerprint) tuples
+            plaintext: Message text to send
+
+        Returns:
+            Tuple of (dictionary mapping recipient fingerprint to entry ID,
+            dictionary mapping rejected recipient fingerprint to error message)
+        """
+        entry_ids = {}
+        errors = {}
+
+        groups = {}
+        for host, port, fingerprint in recipients:
+            try:
+                public_key = keystore.load_peer_key(fingerprint)
+            except FileNotFoundError:
+                errors[fingerprint] = f"Peer not found: {fingerprint}"
+                continue
+            version, features = network.cached_features(host, port)
+            if 'multi' not in features:
+                # Older or not yet negotiated peer
+                version = None
+            groups.setdefault(version, []).append((host, port, fingerprint, public_key))
+
+        if not groups:
+            return entry_ids, errors
+
+        # One sealed copy, logged once, for all recipients
+        sealed = crypto.encrypt_message(plaintext, self.public_key)
+        seal_id = uuid.uuid4().bytes
+
+        entries = []
+        for version, group in groups.items():
+            if version is None:
+                envelope, requires = None, ()
+            else:
+                requires = {'multi'}
+                envelope = message.create_multi_message(
+                    plaintext,
+                    {fingerprint: public_key for _, _, fingerprint, public_key in group},
+                    self.private_key,
+                    self.fingerprint,
+                    version
+                )
+            for host, port, fingerprint, _ in group:
+                entry = self._new_entry(fingerprint, host, port, plaintext, envelope, version or 1, requires,
+                                        sealed, seal_id)
+                entries.append(entry)
+                entry_ids[fingerprint] = entry.entry_id.hex()
+
+        self._enqueue(entries)
+        return entry_ids, errors
+
+    def pending(self) -> dict:
+        """
+        Get the number of queued messages per recipient.
+
+        Returns:
+            Dictionary mapping recipient fingerprint to queued message count
+        """
+        with self.lock:
+            return {fp: len(queue.entries) for fp, queue in self.queues.items() if queue.entries}
+
+    def _new_entry(self, fingerprint: str, host: str, port: int, plaintext: str, envelope: bytes,
+                   version: int, requires=frozenset(), sealed: dict = None, seal_id: bytes = None) -> _Entry:
+        """
+        Build an entry with its envelope and sealed plaintext, sealing it
+        unless a broadcast's shared sealed copy is given.
+        """
+        if sealed is None:
+            sealed = crypto.encrypt_message(plaintext, self.public_key)
+        entry = _Entry(uuid.uuid4().bytes, fingerprint, host, port, time.time(), sealed, seal_id)
+        entry.plaintext = plaintext
+        entry.envelope = envelope
+        entry.version = version
+        entry.requires = frozenset(requires)
+        entry.envelope_time = entry.created
+        return entry
+
+    def _enqueue(self, entries: list):
+        """
+        Log entries and hand them to the flusher.
+        """
+        with self.lock:
+            if self.log is None:
+                raise ValueError("Outbox not started")
+
+            self._append(_records(entries))
+            for entry in entries:
+                queue = self.queues.get(entry.fingerprint)
+                if queue is None:
+                    queue = self.queues[entry.fingerprint] = _PeerQueue()
+                queue.entries.append(entry)
+
+        self.wake.set()
+
+    def _append(self, records: list):
+        """
+        Append records to the log (lock held). Data reaches the OS at once
+        and is synced to disk by the flusher within a second.
+        """
+        if self.log is None:
+            return
+        self.log.write(b''.join(msgpack.packb(record, use_bin_type=True) for record in records))
+        self.log.flush()
+        self.dirty = True
+
+    def _sync(self):
+        """
+        Sync the log to disk if it changed (lock held).
+        """
+        if self.dirty and self.log is not None:
+            os.fsync(self.log.fileno())
+            self.dirty = False
+
+    def _load(self):
+        """
+        Restore queued entries from the log and compact it.
+        """
+        entries = {}
+        seals = {}
+        finished = 0
+
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'rb') as f:
+                    for record in msgpack.Unpacker(f, raw=False):
+                        if record.get('op') == 'seal':
+                            seals[record['sid']] = record['sealed']
+                        elif record.get('op') == 'add':
+                            # Seal records are written before the entries referring to them
+                            seal_id = record.get('sid')
+                            sealed = record['sealed'] if seal_id is None else seals.get(seal_id)
+                            if sealed is None:
+                                continue
+                            entries[record['id']] = _Entry(record['id'], record['fp'], record['host'],
+                                                           record['port'], record['created'], sealed, seal_id)
+                        elif record.get('op') == 'done':
+                            entries.pop(record['id'], None)
+                            finished += 1
+            except (OSError, ValueError) as e:
+                # A torn last record from a crash loses only that record
+                print(f"Warning: Outbox log damaged, recovered {len(entries)} message(s): {e}")
+
+        for entry in entries.values():
+            queue = self.queues.get(entry.fingerprint)
+            if queue is None:
+                queue = self.queues[entry.fingerprint] = _PeerQueue()
+            queue.entries.append(entry)
+
+        # Start from a clean log without finished entries or a torn tail
+        self._rewrite(list(entries.values()))
+
+    def _rewrite(self, entries: list):
+        """
+        Replace the log with one holding only the given entries.
+        """
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(b''.join(msgpack.packb(record, use_bin_type=True) for record in _records(entries)))
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(temp_path, 0o600)
+        os.replace(temp_path, self.path)
+
+    def _compact(self):
+        """
+        Drop finished entries from the log (lock held).
+        """
+        self.log.close()
+        self._rewrite([entry for queue in self.queues.values() for entry in queue.entries])
+        self.log = open(self.path, 'ab')
+        self.finished = 0
+        self.dirty = False
+
+    def _flush_loop(self):
+        """
+        Background thread that starts deliveries to peers whose retry time has come.
+        """
+        timeout = 1.0
+        while self.running:
+            self.wake.wait(timeout)
+            self.wake.clear()
+            if not self.running:
+                break
+
+            now = time.time()
+            due = []
+            expired = []
+            held = set()
+
+            with self.lock:
+                for fingerprint, queue in self.queues.items():
+                    # Drop messages nobody could deliver in time
+                    while queue.entries and now - queue.entries[0].created > MAX_AGE and not queue.busy:
+                        expired.append(queue.entries.pop(0))
+
+                    if queue.entries and not queue.busy and queue.next_attempt <= now:
+                        # Peers known to be down wait for the presence monitor to see them back
+                        if self.presence is not None and self.presence.is_offline(fingerprint):
+                            held.add(fingerprint)
+                            continue
+                        queue.busy = True
+                        due.append(fingerprint)
+
+                if expired:
+                    self._finish(expired)
+
+                if self.finished >= COMPACT_THRESHOLD:
+                    self._compact()
+                self._sync()
+
+                # Wake up for the earliest retry, and at least every second to sync the log
+                retries = [queue.next_attempt for fingerprint, queue in self.queues.items()
+                           if queue.entries and not queue.busy and fingerprint not in held]
+                timeout = min([1.0] + [max(0.0, retry - now) for retry in retries])
+
+            for fingerprint in due:
+                self._deliver(fingerprint)
+
+            for entry in expired:
+                self._report(entry, "Not delivered within the outbox retention time")
+
+    def _on_presence(self, fingerprint: str, online: bool, last_seen: float):
+        """
+        Retry a peer's queued messages at once when it comes back online.
+        """
+        if not online:
+            return
+        with self.lock:
+            queue = self.queues.get(fingerprint)
+            if queue is None or not queue.entries:
+                return
+            queue.attempts = 0
+            queue.next_attempt = 0.0
+        self.wake.set()
+
+    def _finish(self, entries: list):
+        """
+        Log entries as delivered or dropped (lock held).
+        """
+        self._append([{'op': 'done', 'id': entry.entry_id} for entry in entries])
+        self.finished += len(entries)
+
+    def _report(self, entry: _Entry, error=None):
+        """
+        Call the delivery callback for an entry.
+        """
+        if self.delivery_callback:
+            try:
+                self.delivery_callback(entry.fingerprint, entry.entry_id.hex(), entry.plaintext, error)
+            except Exception as e:
+                print(f"Error in delivery callback: {e}")
+
+    def _prepare(self, entry: _Entry, version: int, features: frozenset) -> bytes:
+        """
+        Rebuild an entry's envelope if it is missing, stale, too new for the
+        peer or of a type the peer did not announce. Runs on a send engine
+        worker once the peer is negotiated.
+
+        Returns:
+            Envelope to send
+
+        Raises:
+            ValueError: If the recipient key is gone, the sealed copy is damaged
+                        or the message is too large to send
+        """
+        if entry.plaintext is None:
+            entry.plaintext = crypto.decrypt_message(entry.sealed, self.private_key)
+
+        if (entry.envelope is None or entry.version > version or not entry.requires <= features or
+                time.time() - entry.envelope_time >= ENVELOPE_MAX_AGE):
+            try:
+                recipient_public_key = keystore.load_peer_key(entry.fingerprint)
+            except FileNotFoundError:
+                raise ValueError(f"Peer not found: {entry.fingerprint}")
+
+            entry.envelope = message.create_peer_message(
+                entry.plaintext,
+                entry.fingerprint,
+                recipient_public_key,
+                self.private_key,
+                self.fingerprint,
+                version,
+                features
+            )
+            entry.version = version
+            entry.requires = features & {'session'}
+            entry.envelope_time = time.time()
+
+        # Receivers close connections announcing longer frames, retrying would not help
+        if len(entry.envelope) > message.MAX_FRAME_SIZE:
+            raise ValueError("Message too large")
+        return entry.envelope
+
+    def _deliver(self, fingerprint: str):
+        """
+        Hand the oldest queued messages for a peer to the send engine, which
+        builds their envelopes and writes them as batch frames where the peer
+        accepts them. The round finishes once the peer acked all of them or
+        sending failed.
+
+        Args:
+            fingerprint: Recipient's key fingerprint
+        """
+        with self.lock:
+            queue = self.queues[fingerprint]
+            batch = list(queue.entries[:BATCH_MESSAGES])
+
+            # Latest known address of the peer
+            host, port = queue.entries[-1].host, queue.entries[-1].port
+
+        try:
+            futures = self.engine.submit(host, port, fingerprint,
+                                         [partial(self._prepare, entry) for entry in batch],
+                                         wait_for_delivery=True)
+        except ValueError as e:
+            # Engine stopped or the peer's queue is full, try again later
+            self._settle(fingerprint, batch, [], ConnectionError(str(e)))
+            return
+
+        remaining = [len(futures)]
+
+        def done(_):
+            with self.lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+            self._settle(fingerprint, batch, futures)
+
+        for future in futures:
+            future.add_done_callback(done)
+
+    def _settle(self, fingerprint: str, batch: list, futures: list, error=None):
+        """
+        Log the results of a delivery round and schedule a retry with
+        exponential backoff if the peer was unreachable.
+
+        Args:
+            fingerprint: Recipient's key fingerprint
+            batch: Entries of the round
+            futures: Engine futures of the entries, all resolved
+            error: ConnectionError if the round could not start
+        """
+        delivered = []
+        dropped = []
+        for entry, future in zip(batch, futures):
+            failure = future.exception()
+            if failure is None:
+                delivered.append(entry)
+            elif isinstance(failure, ConnectionError):
+                error = error or failure
+            else:
+                # Cannot be built or sent at all, retrying would not help
+                dropped.append((entry, str(failure)))
+
+        with self.lock:
+            queue = self.queues[fingerprint]
+            finished = delivered + [entry for entry, _ in dropped]
+            if finished:
+                finished_ids = {entry.entry_id for entry in finished}
+                queue.entries = [entry for entry in queue.entries if entry.entry_id not in finished_ids]
+                self._finish(finished)
+
+            if error is None:
+                queue.attempts = 0
+                queue.next_attempt = 0.0
+            else:
+                # Exponential backoff with jitter so peers coming back are not hit at once
+                delay = min(RETRY_MAX, RETRY_BASE * 2 ** queue.attempts) * random.uniform(0.5, 1.0)
+                queue.attempts += 1
+                queue.next_attempt = time.time() + delay
+            queue.busy = False
+            remaining = len(queue.entries)
+
+        if error is not None:
+            print(f"Peer {fingerprint[:12]} unreachable ({error}), retrying {remaining} message(s) in {delay:.1f}s")
+
+        for entry in delivered:
+            self._report(entry)
+        for entry, reason in dropped:
+            self._report(entry, reason)
+
+        # More queued for this peer, or a retry is due
+        self.wake.set()
+
+
+def _records(entries: list) -> list:
+    """
+    Log records restoring entries, each broadcast's seal record first.
+    """
+    records = []
+    seals = set()
+    for entry in entries:
+        if entry.seal_id is not None and entry.seal_id not in seals:
+            seals.add(entry.seal_id)
+            records.append(entry.seal_record())
+        records.append(entry.record())
+    return records
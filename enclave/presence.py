@@ -0,0 +1,270 @@
+"""
+Presence module for Enclave.
+Tracks which peers are reachable, so sends to peers known to be down fail
+at once (or stay queued) instead of each waiting out a connect timeout.
+
+A background thread checks every watched peer not heard from for
+HEARTBEAT_INTERVAL seconds: with a heartbeat over an idle pooled
+connection where there is one, otherwise with a short probe connection.
+Due peers are checked together on a small thread pool, so a round over
+many dead peers takes one HEARTBEAT_TIMEOUT, not one per peer. Messages
+received from a peer and successful sends count as heartbeats, so busy
+peers are never probed. A failed check or send marks a peer offline; it
+is online again once a check or send succeeds.
+"""
+
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from . import metrics, network
+
+
+# Seconds without hearing from a peer before it is checked
+HEARTBEAT_INTERVAL = 15
+
+# Seconds a heartbeat or probe may take
+HEARTBEAT_TIMEOUT = 3
+
+# Peers checked at once
+PROBE_WORKERS = 16
+
+# Seconds after its last check before a send to an offline peer triggers a recheck
+RECHECK_INTERVAL = 5
+
+
+class _PeerState:
+    """
+    Presence of one peer.
+    """
+
+    __slots__ = ('host', 'port', 'online', 'last_seen', 'last_checked', 'checking')
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+
+        # None until the first check or send
+        self.online = None
+
+        # Wall clock time the peer last answered, None if never
+        self.last_seen = None
+        self.last_checked = 0.0
+        self.checking = False
+
+
+class PresenceMonitor:
+    """
+    Online/offline state and last_seen time of watched peers.
+    """
+
+    def __init__(self, interval: float = HEARTBEAT_INTERVAL, timeout: float = HEARTBEAT_TIMEOUT,
+                 workers: int = PROBE_WORKERS):
+        """
+        Initialize presence monitor.
+
+        Args:
+            interval: Seconds without hearing from a peer before it is checked (default: 15)
+            timeout: Seconds a heartbeat or probe may take (default: 3)
+            workers: Number of peers checked at once (default: 16)
+        """
+        self.interval = interval
+        self.timeout = timeout
+        self.workers = workers
+
+        # Peer fingerprint -> _PeerState
+        self.peers = {}
+        self.lock = threading.Lock()
+
+        self.listeners = []
+        self.stop_event = threading.Event()
+        self.executor = None
+        self.thread = None
+
+    def add_listener(self, callback):
+        """
+        Register a function called when a peer goes online or offline.
+
+        Args:
+            callback: Function called with (fingerprint, online, last_seen)
+        """
+        self.listeners.append(callback)
+
+    def start(self):
+        """
+        Start checking peers in the background.
+        """
+        self.stop_event.clear()
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="Presence")
+        self.thread = threading.Thread(target=self._check_loop, daemon=True, name="PresenceMonitor")
+        self.thread.start()
+        metrics.registry.set_gauge('presence.offline', self.offline_count)
+
+    def stop(self):
+        """
+        Stop checking peers; checks in progress finish in the background.
+        """
+        if self.thread is None:
+            return
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
+        self.executor.shutdown(wait=False)
+        metrics.registry.remove_gauge('presence.offline')
+
+    def watch(self, fingerprint: str, host: str, port: int):
+        """
+        Start tracking a peer, or update its address.
+
+        Args:
+            fingerprint: Peer's key fingerprint
+            host: Peer's (primary) host
+            port: Peer's port
+        """
+        with self.lock:
+            state = self.peers.get(fingerprint)
+
+            # A new address starts unknown; checks of the old one in flight are ignored
+            if state is None or (state.host, state.port) != (host, port):
+                self.peers[fingerprint] = _PeerState(host, port)
+
+    def set_peers(self, peers: dict):
+        """
+        Track exactly these peers.
+
+        Args:
+            peers: Dictionary mapping fingerprint to (host, port)
+        """
+        for fingerprint, (host, port) in peers.items():
+            self.watch(fingerprint, host, port)
+        with self.lock:
+            for fingerprint in set(self.peers) - set(peers):
+                del self.peers[fingerprint]
+
+    def seen(self, fingerprint: str):
+        """
+        Record that a peer answered or sent something.
+        """
+        self._update(fingerprint, True)
+
+    def failed(self, fingerprint: str):
+        """
+        Record that a peer could not be reached.
+        """
+        self._update(fingerprint, False)
+
+    def is_offline(self, fingerprint: str) -> bool:
+        """
+        Check whether a peer is known to be down. Asking about an offline
+        peer not checked for RECHECK_INTERVAL seconds checks it again in the
+        background, so a peer that came back is noticed without waiting for
+        its next heartbeat.
+
+        Returns:
+            True if the last check or send failed; False if it succeeded or
+            the peer was not tried yet
+        """
+        with self.lock:
+            state = self.peers.get(fingerprint)
+            if state is None or state.online is not False:
+                return False
+            recheck = (self.executor is not None and not state.checking and
+                       time.monotonic() - state.last_checked >= RECHECK_INTERVAL)
+            if recheck:
+                state.checking = True
+
+        if recheck:
+            try:
+                self.executor.submit(self._check, fingerprint, state)
+            except RuntimeError:
+                # Stopped meanwhile
+                state.checking = False
+        return True
+
+    def offline_count(self) -> int:
+        """
+        Get the number of peers known to be down.
+        """
+        with self.lock:
+            return sum(1 for state in self.peers.values() if state.online is False)
+
+    def status(self) -> dict:
+        """
+        Get the presence of every watched peer.
+
+        Returns:
+            Dictionary mapping fingerprint to {'online', 'last_seen'}; online is
+            None for peers not tried yet
+        """
+        with self.lock:
+            return {fingerprint: {'online': state.online, 'last_seen': state.last_seen}
+                    for fingerprint, state in self.peers.items()}
+
+    def check(self) -> int:
+        """
+        Check every peer not heard from for interval seconds, all at once,
+        and wait for the results.
+
+        Returns:
+            Number of peers checked
+        """
+        due = []
+        now = time.monotonic()
+        with self.lock:
+            for fingerprint, state in self.peers.items():
+                if not state.checking and now - state.last_checked >= self.interval:
+                    state.checking = True
+                    due.append((fingerprint, state))
+
+        if due:
+            wait([self.executor.submit(self._check, fingerprint, state) for fingerprint, state in due])
+        return len(due)
+
+    def _check_loop(self):
+        """
+        Check due peers until stopped.
+        """
+        tick = min(1.0, self.interval)
+        while not self.stop_event.wait(tick):
+            try:
+                self.check()
+            except Exception as e:
+                print(f"Error checking peer presence: {e}")
+
+    def _check(self, fingerprint: str, state: _PeerState):
+        """
+        Heartbeat or probe one peer and record the result.
+        """
+        try:
+            online = network.heartbeat(state.host, state.port, self.timeout)
+        finally:
+            state.checking = False
+        self._update(fingerprint, online, state)
+
+    def _update(self, fingerprint: str, online: bool, state: _PeerState = None):
+        """
+        Record a peer's state and tell listeners if it changed.
+
+        Args:
+            fingerprint: Peer's key fingerprint
+            online: Whether the peer answered
+            state: State that was checked; ignored if the peer was unwatched
+                   or readdressed meanwhile (optional)
+        """
+        with self.lock:
+            current = self.peers.get(fingerprint)
+            if current is None or (state is not None and current is not state):
+                return
+            changed = current.online is not online
+            current.online = online
+            current.last_checked = time.monotonic()
+            if online:
+                current.last_seen = time.time()
+            last_seen = current.last_seen
+
+        if changed:
+            metrics.increment('presence.up' if online else 'presence.down')
+            for callback in self.listeners:
+                try:
+                    callback(fingerprint, online, last_seen)
+                except Exception as e:
+                    print(f"Error in presence callback: {e}")
@@ -0,0 +1,355 @@
+"""
+Profiling module for Enclave.
+Samples the stacks of all threads of the node from a background thread,
+tracks allocations with tracemalloc and accounts CPU time per thread, for
+a bounded duration so it is safe to turn on in a live node.
+
+Reports are written as flamegraph-compatible collapsed stacks
+(stacks.collapsed, for flamegraph.pl or speedscope), a top allocations
+report (allocations.txt) and per-thread CPU time (threads.txt).
+"""
+
+import os
+import sys
+import time
+import threading
+import tracemalloc
+from pathlib import Path
+from collections import Counter
+
+
+# Default directory for profile reports
+PROFILE_DIR = Path("profiles")
+
+# Default and longest allowed profiling duration in seconds
+DEFAULT_DURATION = 60
+MAX_DURATION = 600
+
+# Seconds between stack samples (100 Hz)
+DEFAULT_INTERVAL = 0.01
+
+# Seconds between per-thread CPU clock reads
+CPU_INTERVAL = 1.0
+
+# Frames kept per allocation by tracemalloc; one frame groups by line cheaply
+TRACEMALLOC_FRAMES = 1
+
+# Entries in the allocations report
+TOP_ALLOCATIONS = 30
+
+_HAS_THREAD_CLOCKS = hasattr(time, 'pthread_getcpuclockid')
+
+
+def thread_cpu_time(thread) -> float:
+    """
+    Get the CPU time used by a thread so far.
+
+    Returns:
+        Seconds, or None if unavailable (thread exited or unsupported platform)
+    """
+    if not _HAS_THREAD_CLOCKS or thread.ident is None:
+        return None
+    try:
+        return time.clock_gettime(time.pthread_getcpuclockid(thread.ident))
+    except (OSError, ValueError, OverflowError):
+        return None
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+
+
+class ProfileSession:
+    """
+    One profiling run over all threads of this process.
+    """
+
+    def __init__(self, duration: float = DEFAULT_DURATION, interval: float = DEFAULT_INTERVAL,
+                 allocations: bool = True, output_dir=PROFILE_DIR):
+        """
+        Initialize profiling session.
+
+        Args:
+            duration: Seconds after which profiling stops by itself (default: 60, at most 600)
+            interval: Seconds between stack samples (default: 0.01)
+            allocations: Whether to trace allocations with tracemalloc (default: True)
+            output_dir: Directory reports are written under (default: profiles)
+
+        Raises:
+            ValueError: If duration or interval is out of range
+        """
+        if not 0 < duration <= MAX_DURATION:
+            raise ValueError(f"Profiling duration must be between 0 and {MAX_DURATION} seconds")
+        if not 0.001 <= interval <= 1:
+            raise ValueError("Sampling interval must be between 0.001 and 1 second")
+
+        self.duration = duration
+        self.interval = interval
+        self.allocations = allocations
+        self.output_dir = Path(output_dir)
+
+        # Collapsed stack -> samples
+        self.stacks = Counter()
+        self.samples = 0
+
+        # Thread ident -> [name, CPU seconds at first read, at last read]
+        self.thread_cpu = {}
+
+        self.started = None
+        self.started_cpu = None
+        self.stopped = None
+        self.started_tracemalloc = False
+        self.stop_event = threading.Event()
+        self.sampler = None
+        self.report = None
+
+    def start(self):
+        """
+        Start sampling in a background thread.
+        """
+        self.started = time.time()
+        self.started_cpu = time.process_time()
+        self._read_thread_cpu(initial=True)
+
+        # Leave tracing alone if it was enabled elsewhere (e.g. PYTHONTRACEMALLOC)
+        if self.allocations and not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+            self.started_tracemalloc = True
+
+        self.sampler = threading.Thread(target=self._sample_loop, daemon=True, name="Profiler")
+        self.sampler.start()
+
+    def _sample_loop(self):
+        """
+        Take stack samples until stopped or the duration is over.
+        """
+        me = threading.get_ident()
+        deadline = self.started + self.duration
+        next_cpu_read = time.monotonic() + CPU_INTERVAL
+
+        while not self.stop_event.wait(self.interval):
+            if time.time() >= deadline:
+                break
+
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame))
+                    frame = frame.f_back
+                stack.append(names.get(ident, f"thread-{ident}"))
+                stack.reverse()
+                self.stacks[";".join(stack)] += 1
+            self.samples += 1
+
+            if time.monotonic() >= next_cpu_read:
+                self._read_thread_cpu()
+                next_cpu_read += CPU_INTERVAL
+
+        # Ran out of time: finish without waiting for stop()
+        if not self.stop_event.is_set():
+            threading.Thread(target=self.stop, daemon=True, name="ProfilerStop").start()
+
+    def _read_thread_cpu(self, initial: bool = False):
+        """
+        Read the CPU clocks of all live threads.
+
+        Args:
+            initial: Whether this is the read at start; threads first seen
+                     later started during the session and count from zero
+        """
+        for thread in threading.enumerate():
+            cpu = thread_cpu_time(thread)
+            if cpu is None:
+                continue
+
+            entry = self.thread_cpu.get(thread.ident)
+            if entry is None or entry[0] != thread.name:
+                self.thread_cpu[thread.ident] = [thread.name, cpu if initial else 0.0, cpu]
+            else:
+                entry[2] = cpu
+
+    @property
+    def running(self) -> bool:
+        return self.started is not None and self.stopped is None
+
+    def stop(self) -> dict:
+        """
+        Stop profiling and write the reports. Calling it again returns the same report.
+
+        Returns:
+            Report dictionary from _write_report()
+        """
+        with _lock:
+            if self.stopped is not None:
+                return self.report
+
+            self.stop_event.set()
+            if self.sampler and self.sampler is not threading.current_thread():
+                self.sampler.join()
+
+            self.stopped = time.time()
+            self._read_thread_cpu()
+
+            snapshot = None
+            if self.allocations and tracemalloc.is_tracing():
+                snapshot = tracemalloc.take_snapshot()
+                if self.started_tracemalloc:
+                    tracemalloc.stop()
+
+            self.report = self._write_report(snapshot)
+
+        print(f"Profile written to {self.report['directory']}")
+        return self.report
+
+    def _write_report(self, snapshot) -> dict:
+        """
+        Write collapsed stacks, allocations and thread CPU reports.
+
+        Args:
+            snapshot: tracemalloc snapshot, or None
+
+        Returns:
+            Dictionary with the report directory, sample count, wall and CPU
+            seconds, per-thread CPU seconds and the top allocations
+        """
+        directory = self.output_dir / time.strftime("profile-%Y%m%d-%H%M%S", time.localtime(self.started))
+        directory.mkdir(parents=True, exist_ok=True)
+
+        with open(directory / "stacks.collapsed", 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+        threads = sorted(
+            ({'name': name, 'cpu_seconds': round(last - first, 6)}
+             for name, first, last in self.thread_cpu.values()),
+            key=lambda entry: entry['cpu_seconds'],
+            reverse=True
+        )
+        wall = self.stopped - self.started
+        cpu = time.process_time() - self.started_cpu
+        with open(directory / "threads.txt", 'w') as f:
+            f.write(f"Wall time: {wall:.3f}s  Process CPU time: {cpu:.3f}s  Samples: {self.samples}\n\n")
+            if not _HAS_THREAD_CLOCKS:
+                f.write("Per-thread CPU clocks are not available on this platform\n")
+            for entry in threads:
+                f.write(f"{entry['cpu_seconds']:>10.3f}s  {entry['name']}\n")
+
+        allocations = []
+        if snapshot is not None:
+            statistics = snapshot.filter_traces((
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, __file__),
+            )).statistics('lineno')
+            for stat in statistics[:TOP_ALLOCATIONS]:
+                frame = stat.traceback[0]
+                allocations.append({'location': f"{frame.filename}:{frame.lineno}",
+                                    'size': stat.size, 'count': stat.count})
+
+            with open(directory / "allocations.txt", 'w') as f:
+                total = sum(stat.size for stat in statistics)
+                f.write(f"Live memory allocated while profiling: {total / 1024:.1f} KiB\n\n")
+                for entry in allocations:
+                    f.write(f"{entry['size'] / 1024:>10.1f} KiB {entry['count']:>8} blocks  {entry['location']}\n")
+
+        return {
+            'directory': str(directory),
+            'samples': self.samples,
+            'wall_seconds': round(wall, 3),
+            'cpu_seconds': round(cpu, 3),
+            'threads': threads,
+            'allocations': allocations
+        }
+
+    def status(self) -> dict:
+        """
+        Get the session state.
+
+        Returns:
+            Dictionary with 'running', 'started', 'duration', 'samples' and,
+            once stopped, 'report'
+        """
+        return {
+            'running': self.running,
+            'started': self.started,
+            'duration': self.duration,
+            'samples': self.samples,
+            'report': self.report
+        }
+
+
+# Current or last session, one at a time per process
+_session = None
+_lock = threading.RLock()
+
+
+def start(duration: float = DEFAULT_DURATION, interval: float = DEFAULT_INTERVAL, allocations: bool = True,
+          output_dir=PROFILE_DIR) -> dict:
+    """
+    Start profiling this process.
+
+    Args:
+        duration: Seconds after which profiling stops by itself (default: 60, at most 600)
+        interval: Seconds between stack samples (default: 0.01)
+        allocations: Whether to trace allocations with tracemalloc (default: True)
+        output_dir: Directory reports are written under (default: profiles)
+
+    Returns:
+        Session status
+
+    Raises:
+        ValueError: If a session is already running or arguments are out of range
+    """
+    global _session
+
+    with _lock:
+        if _session is not None and _session.running:
+            raise ValueError("Profiling is already running")
+        _session = ProfileSession(duration, interval, allocations, output_dir)
+        _session.start()
+        return _session.status()
+
+
+def stop() -> dict:
+    """
+    Stop the running profiling session.
+
+    Returns:
+        Report dictionary
+
+    Raises:
+        ValueError: If no session was started
+    """
+    with _lock:
+        session = _session
+    if session is None:
+        raise ValueError("Profiling was not started")
+    return session.stop()
+
+
+def finish():
+    """
+    Stop the running session, if any, so a shutting down node keeps its partial profile.
+    """
+    with _lock:
+        session = _session
+    if session is not None and session.running:
+        session.stop()
+
+
+def status() -> dict:
+    """
+    Get the state of the current or last session.
+
+    Returns:
+        Session status, or {'running': False} if profiling was never started
+    """
+    with _lock:
+        session = _session
+    if session is None:
+        return {'running': False}
+    return session.status()
@@ -0,0 +1,265 @@
+"""
+Replay protection module for Enclave.
+Keeps message IDs seen inside the timestamp window in time-bucketed sets,
+sharded by ID to reduce lock contention, with optional disk snapshots so
+protection survives restarts.
+"""
+
+import os
+import time
+import uuid
+import hashlib
+import threading
+import msgpack
+
+
+# Messages outside this window (seconds) are rejected by timestamp checks,
+# so their IDs do not need to be remembered
+DEFAULT_WINDOW = 300
+DEFAULT_BUCKET_SECONDS = 10
+DEFAULT_SHARDS = 16
+
+_SNAPSHOT_VERSION = 1
+_ID_SIZE = 16
+
+
+def compact_id(message_id) -> bytes:
+    """
+    Convert a message ID to 16 binary bytes.
+
+    Args:
+        message_id: UUID string or 16-byte binary ID
+
+    Returns:
+        16-byte ID
+
+    Raises:
+        ValueError: If message_id is neither a string nor 16 bytes
+    """
+    if isinstance(message_id, (bytes, bytearray, memoryview)):
+        if len(message_id) != _ID_SIZE:
+            raise ValueError(f"Binary message ID must be {_ID_SIZE} bytes")
+        return bytes(message_id)
+
+    if not isinstance(message_id, str):
+        raise ValueError(f"Invalid message ID type: {type(message_id).__name__}")
+
+    try:
+        return uuid.UUID(message_id).bytes
+    except ValueError:
+        # Not a UUID, hash to a fixed-size ID
+        return hashlib.blake2b(message_id.encode('utf-8'), digest_size=_ID_SIZE).digest()
+
+
+class _Shard:
+    """
+    One shard of the replay cache: bucket index -> set of IDs.
+    """
+
+    __slots__ = ('lock', 'buckets')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = {}
+
+
+class ReplayCache:
+    """
+    Constant-time replay cache keyed by envelope timestamp.
+
+    A replayed envelope carries the same (signed) timestamp as the original,
+    so its ID is always found in the single bucket for that timestamp.
+    Buckets are dropped once they fall out of the window.
+    """
+
+    def __init__(self, window: int = DEFAULT_WINDOW, bucket_seconds: int = DEFAULT_BUCKET_SECONDS,
+                 shards: int = DEFAULT_SHARDS, snapshot_path=None):
+        """
+        Initialize replay cache.
+
+        Args:
+            window: Timestamp window in seconds (default: 300)
+            bucket_seconds: Width of one time bucket in seconds (default: 10)
+            shards: Number of independently locked shards (default: 16)
+            snapshot_path: File to load from and snapshot to (optional)
+        """
+        self.window = window
+        self.bucket_seconds = bucket_seconds
+        self.shards = [_Shard() for _ in range(shards)]
+        self.snapshot_path = snapshot_path
+
+        # Oldest bucket still kept, advanced by expiry
+        self.oldest_bucket = self._bucket(time.time() - window)
+
+        if snapshot_path and os.path.exists(snapshot_path):
+            self.load(snapshot_path)
+
+    def _bucket(self, timestamp: float) -> int:
+        return int(timestamp // self.bucket_seconds)
+
+    def check_and_add(self, message_id, timestamp: float = None) -> bool:
+        """
+        Check if message ID was seen before and remember it.
+
+        Args:
+            message_id: UUID string or 16-byte binary ID
+            timestamp: Envelope timestamp (default: now)
+
+        Returns:
+            True if duplicate (already seen), False if new
+
+        Raises:
+            ValueError: If message_id is neither a string nor 16 bytes
+        """
+        if timestamp is None:
+            timestamp = time.time()
+
+        id_bytes = compact_id(message_id)
+        bucket = self._bucket(timestamp)
+
+        # Expire old buckets at most once per bucket interval
+        cutoff = self._bucket(time.time() - self.window)
+        if cutoff > self.oldest_bucket:
+            self.expire(cutoff)
+
+        shard = self.shards[id_bytes[0] % len(self.shards)]
+        with shard.lock:
+            ids = shard.buckets.get(bucket)
+            if ids is None:
+                ids = shard.buckets[bucket] = set()
+            elif id_bytes in ids:
+                return True
+
+            ids.add(id_bytes)
+            return False
+
+    def discard(self, message_id, timestamp: float):
+        """
+        Forget a message ID, e.g. when its message turned out to be invalid.
+
+        Args:
+            message_id: UUID string or 16-byte binary ID
+            timestamp: Envelope timestamp used when it was added
+        """
+        id_bytes = compact_id(message_id)
+        shard = self.shards[id_bytes[0] % len(self.shards)]
+        with shard.lock:
+            ids = shard.buckets.get(self._bucket(timestamp))
+            if ids is not None:
+                ids.discard(id_bytes)
+
+    def expire(self, cutoff: int = None):
+        """
+        Drop buckets older than the window.
+
+        Args:
+            cutoff: First bucket index to keep (default: computed from now)
+        """
+        if cutoff is None:
+            cutoff = self._bucket(time.time() - self.window)
+        self.oldest_bucket = cutoff
+
+        for shard in self.shards:
+            with shard.lock:
+                for bucket in [b for b in shard.buckets if b < cutoff]:
+                    del shard.buckets[bucket]
+
+    def __len__(self):
+        return sum(len(ids) for shard in self.shards for ids in shard.buckets.values())
+
+    def clear(self):
+        """
+        Forget all message IDs.
+        """
+        for shard in self.shards:
+            with shard.lock:
+                shard.buckets.clear()
+
+    def snapshot(self, path=None):
+        """
+        Write cache contents to disk atomically.
+
+        Args:
+            path: Snapshot file (default: snapshot_path)
+        """
+        path = path or self.snapshot_path
+        if not path:
+            return
+
+        self.expire()
+
+        # Merge shards per bucket, IDs concatenated as fixed-size records
+        merged = {}
+        for shard in self.shards:
+            with shard.lock:
+                for bucket, ids in shard.buckets.items():
+                    merged.setdefault(bucket, []).append(b''.join(ids))
+
+        data = msgpack.packb({
+            'version': _SNAPSHOT_VERSION,
+            'bucket_seconds': self.bucket_seconds,
+            'buckets': [[bucket, b''.join(parts)] for bucket, parts in merged.items()]
+        }, use_bin_type=True)
+
+        temp_path = f"{path}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.chmod(temp_path, 0o600)
+        os.replace(temp_path, path)
+
+    def load(self, path=None):
+        """
+        Load cache contents from a snapshot, skipping expired buckets.
+
+        Args:
+            path: Snapshot file (default: snapshot_path)
+        """
+        path = path or self.snapshot_path
+
+        try:
+            with open(path, 'rb') as f:
+                snapshot = msgpack.unpackb(f.read(), raw=False)
+        except (OSError, ValueError) as e:
+            print(f"Warning: Could not load replay cache snapshot: {e}")
+            return
+
+        if snapshot.get('version') != _SNAPSHOT_VERSION or snapshot.get('bucket_seconds') != self.bucket_seconds:
+            print("Warning: Ignoring incompatible replay cache snapshot")
+            return
+
+        cutoff = self._bucket(time.time() - self.window)
+        for bucket, records in snapshot['buckets']:
+            if bucket < cutoff:
+                continue
+            # Group by shard first so each shard lock is taken once per bucket
+            per_shard = [[] for _ in self.shards]
+            for offset in range(0, len(records), _ID_SIZE):
+                id_bytes = records[offset:offset + _ID_SIZE]
+                per_shard[id_bytes[0] % len(self.shards)].append(id_bytes)
+
+            for shard, ids in zip(self.shards, per_shard):
+                if ids:
+                    with shard.lock:
+                        shard.buckets.setdefault(bucket, set()).update(ids)
+
+    def start_snapshots(self, interval: float = 30):
+        """
+        Snapshot to disk periodically in a background thread.
+
+        Args:
+            interval: Seconds between snapshots (default: 30)
+
+        Returns:
+            Event that stops the thread when set
+        """
+        stop_event = threading.Event()
+
+        def snapshot_loop():
+            while not stop_event.wait(interval):
+                try:
+                    self.snapshot()
+                except OSError as e:
+                    print(f"Warning: Replay cache snapshot failed: {e}")
+
+        threading.Thread(target=snapshot_loop, daemon=True, name="ReplaySnapshot").start()
+        return stop_event
@@ -0,0 +1,816 @@
+"""
+Send engine for Enclave.
+One long-lived engine per node sends direct messages, outbox deliveries
+and broadcasts with a fixed pool of worker threads instead of a thread
+per send or broadcast.
+
+Each peer has a FIFO queue, so messages to a peer are written in the
+order they were submitted. Work for a peer runs in three stages, each at
+most once at a time per peer. Connecting (including version negotiation)
+runs on a separate pool of connector threads with a short timeout, so an
+unreachable peer never holds a worker. Encrypting and writing run on the
+workers; the next messages are encrypted while the previous ones are on
+the wire, and messages queued during a write go out together as one
+batch frame. Workers never wait for the peer either: a reactor thread
+reads delivery acks for all connections, resolves the sends waiting for
+them and resumes writes that ran out of credit. Sends return futures
+resolved once the message is written, or acked by the peer with
+wait_for_delivery. With a presence monitor, sends to peers known to be
+offline fail at once.
+"""
+
+import socket
+import selectors
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+from queue import Queue
+from . import keystore, message, metrics, network
+
+
+# Worker threads shared by all peers
+DEFAULT_WORKERS = 4
+
+# Threads opening connections; connects wait on the network, not the CPU
+CONNECT_WORKERS = 32
+
+# Seconds to wait for a new connection to a peer
+CONNECT_TIMEOUT = 5
+
+# Most messages queued for one peer before sends are refused
+MAX_QUEUED_PER_PEER = 10000
+
+# Limits for one batch frame
+MAX_BATCH_BYTES = 256 * 1024
+MAX_BATCH_MESSAGES = 256
+
+
+class _SharedEnvelope:
+    """
+    Multi-recipient envelope of a broadcast, built once per envelope
+    version by whichever worker needs it first. Only used for peers that
+    announced 'multi'.
+    """
+
+    __slots__ = ('plaintext', 'recipient_keys', 'private_key', 'fingerprint', 'data', 'lock')
+
+    def __init__(self, plaintext: str, recipient_keys: dict, private_key, fingerprint: str):
+        self.plaintext = plaintext
+        self.recipient_keys = recipient_keys
+        self.private_key = private_key
+        self.fingerprint = fingerprint
+
+        # Envelope version -> bytes or ValueError
+        self.data = {}
+        self.lock = threading.Lock()
+
+    def build(self, version: int) -> bytes:
+        """
+        Get the envelope for a version, encrypting and signing it on first use.
+
+        Raises:
+            ValueError: If the message cannot be encrypted (e.g. too large)
+        """
+        with self.lock:
+            data = self.data.get(version)
+            if data is None:
+                try:
+                    data = message.create_multi_message(self.plaintext, self.recipient_keys,
+                                                        self.private_key, self.fingerprint, version)
+                except ValueError as e:
+                    data = e
+                self.data[version] = data
+        if isinstance(data, ValueError):
+            raise data
+        return data
+
+
+class _Job:
+    """
+    One message for one peer, built by calling build(version, features)
+    once the peer's envelope version and features are known.
+    """
+
+    __slots__ = ('build', 'data', 'wait', 'future', 'queued')
+
+    def __init__(self, build, wait: bool):
+        self.build = build
+        self.data = None
+        self.wait = wait
+        self.future = Future()
+        self.queued = metrics.clock()
+
+
+class _PeerQueue:
+    """
+    Messages for one peer waiting to be encrypted (pending), to be written
+    (ready) and to be acked (waiters), and the connection they use.
+    """
+
+    __slots__ = ('fingerprint', 'host', 'port', 'pending', 'ready', 'waiters', 'conn', 'reused',
+                 'version', 'features', 'connecting', 'encrypting', 'writing', 'stalled')
+
+    def __init__(self, fingerprint: str, host: str, port: int):
+        self.fingerprint = fingerprint
+        self.host = host
+        self.port = port
+        self.pending = deque()
+        self.ready = deque()
+
+        # (sequence number, jobs, deadline) per written frame with jobs waiting for its ack
+        self.waiters = deque()
+
+        # Connection while messages are queued; reused while a pooled one has not written yet
+        self.conn = None
+        self.reused = False
+
+        # Negotiated when connecting; None until then
+        self.version = None
+        self.features = None
+
+        self.connecting = False
+        self.encrypting = False
+        self.writing = False
+
+        # Deadline for credit while the write stage waits for an ack, else None
+        self.stalled = None
+
+    def __len__(self):
+        return len(self.pending) + len(self.ready)
+
+
+class SendEngine:
+    """
+    Long-lived sender with per-peer ordered queues, a bounded worker pool
+    and one reactor thread waiting for acks.
+    """
+
+    def __init__(self, private_key, fingerprint: str, workers: int = DEFAULT_WORKERS,
+                 max_queued: int = MAX_QUEUED_PER_PEER, presence=None):
+        """
+        Initialize send engine.
+
+        Args:
+            private_key: User's private key for signing; None for an engine
+                         only given submit() and broadcasts signed by the caller
+            fingerprint: User's key fingerprint
+            workers: Number of worker threads shared by all peers (default: 4)
+            max_queued: Most messages queued for one peer (default: 10000)
+            presence: presence.PresenceMonitor told about send results and
+                      consulted to fail sends to offline peers (optional)
+        """
+        self.private_key = private_key
+        self.fingerprint = fingerprint
+        self.num_workers = workers
+        self.max_queued = max_queued
+        self.presence = presence
+
+        # Peer fingerprint -> _PeerQueue, removed once the peer has nothing queued
+        self.queues = {}
+        self.lock = threading.Lock()
+
+        # (stage, peer queue) tasks for the workers, None to stop one
+        self.tasks = Queue()
+        self.workers = []
+        self.connector = None
+        self.running = False
+
+        # Connections the reactor reads acks from (connection -> peer queue),
+        # those in its selector, and those to close or pool once it has
+        # dropped them: (connection, host, port, whether to pool it)
+        self.watching = {}
+        self.registered = set()
+        self.retired = []
+        self.reactor = None
+        self.wakeup = None
+
+    def start(self):
+        """
+        Start the worker, connector and reactor threads.
+        """
+        self.running = True
+        self.connector = ThreadPoolExecutor(max_workers=CONNECT_WORKERS, thread_name_prefix="SendConnect")
+        for i in range(self.num_workers):
+            worker = threading.Thread(target=self._worker, daemon=True, name=f"SendWorker-{i}")
+            worker.start()
+            self.workers.append(worker)
+
+        self.wakeup = socket.socketpair()
+        for sock in self.wakeup:
+            sock.setblocking(False)
+        self.reactor = threading.Thread(target=self._react, daemon=True, name="SendReactor")
+        self.reactor.start()
+        metrics.registry.set_gauge('send.queued', self.queued)
+
+    def stop(self):
+        """
+        Stop the threads once their current task is done. Messages still
+        queued or waiting for acks fail with ConnectionError.
+        """
+        with self.lock:
+            if not self.running:
+                return
+            self.running = False
+
+        for _ in self.workers:
+            self.tasks.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+        # Connects still running find the engine stopped and close their connection
+        self.connector.shutdown(wait=False)
+        self._wake()
+        self.reactor.join()
+        for sock in self.wakeup:
+            sock.close()
+        metrics.registry.remove_gauge('send.queued')
+
+        with self.lock:
+            jobs = []
+            for queue in self.queues.values():
+                jobs.extend(queue.pending)
+                jobs.extend(queue.ready)
+                for _, waiting, _ in queue.waiters:
+                    jobs.extend(waiting)
+                queue.pending.clear()
+                queue.ready.clear()
+                queue.waiters.clear()
+                if queue.conn is not None:
+                    queue.conn.close()
+                    queue.conn = None
+            self.queues.clear()
+            self.watching.clear()
+        _fail(jobs, ConnectionError("Send engine stopped"))
+
+    def queued(self) -> int:
+        """
+        Get the number of messages queued for all peers.
+        """
+        with self.lock:
+            return sum(len(queue) for queue in self.queues.values())
+
+    def send(self, recipient_host: str, recipient_port: int, recipient_fingerprint: str, plaintext: str,
+             wait_for_delivery=False, callback=None) -> Future:
+        """
+        Queue a message for a peer, encrypted with the per-peer session key.
+
+        Args:
+            recipient_host: Recipient's IP address
+            recipient_port: Recipient's port number
+            recipient_fingerprint: Recipient's key fingerprint
+            plaintext: Message text to send
+            wait_for_delivery: Resolve the future only once the peer acks that it
+                               processed the message (default: False)
+            callback: Function called with the future once it is resolved (optional)
+
+        Returns:
+            Future resolving to True, or raising ConnectionError if sending
+            failed or the peer is offline, or ValueError if the message could
+            not be encrypted
+
+        Raises:
+            ValueError: If recipient key not found, the peer's queue is full
+                        or the engine is not running
+        """
+        try:
+            keystore.load_peer_key(recipient_fingerprint)
+        except FileNotFoundError:
+            raise ValueError(f"Peer not found: {recipient_fingerprint}")
+
+        build = partial(_seal, plaintext, recipient_fingerprint, None, self.private_key, self.fingerprint)
+        job = _Job(build, wait_for_delivery)
+        if callback:
+            job.future.add_done_callback(callback)
+        if self._offline(recipient_fingerprint):
+            job.future.set_exception(ConnectionError(f"Peer offline: {recipient_fingerprint}"))
+            return job.future
+        self._submit(recipient_host, recipient_port, recipient_fingerprint, [job])
+        return job.future
+
+    def submit(self, recipient_host: str, recipient_port: int, recipient_fingerprint: str, builders: list,
+               wait_for_delivery=False) -> list:
+        """
+        Queue messages built by the caller for a peer, in order. Each builder
+        is called on a worker with the peer's envelope version and features
+        once they are negotiated, and returns the envelope.
+
+        Args:
+            recipient_host: Recipient's IP address
+            recipient_port: Recipient's port number
+            recipient_fingerprint: Recipient's key fingerprint
+            builders: Functions (signature: builder(version, features) -> bytes)
+                      raising ValueError if the message cannot be built
+            wait_for_delivery: Resolve the futures only once the peer acks (default: False)
+
+        Returns:
+            List of futures in builder order, resolving as for send()
+
+        Raises:
+            ValueError: If the peer's queue is full or the engine is not running
+        """
+        jobs = [_Job(build, wait_for_delivery) for build in builders]
+        if self._offline(recipient_fingerprint):
+            _fail(jobs, ConnectionError(f"Peer offline: {recipient_fingerprint}"))
+        elif jobs:
+            self._submit(recipient_host, recipient_port, recipient_fingerprint, jobs)
+        return [job.future for job in jobs]
+
+    def broadcast(self, recipients: list, plaintext: str, wait_for_delivery=False,
+                  private_key=None, fingerprint: str = None) -> tuple:
+        """
+        Queue the same message for several peers, encrypted and signed once
+        into a multi-recipient envelope per envelope version for peers that
+        read them; peers known not to, and peers that turn out not to when
+        negotiated, get their own envelope.
+
+        Args:
+            recipients: List of (host, port, fingerprint) tuples
+            plaintext: Message text to send
+            wait_for_delivery: Resolve futures only once peers ack (default: False)
+            private_key: Key to sign with instead of the engine's (optional)
+            fingerprint: Fingerprint of that key (optional)
+
+        Returns:
+            Tuple of (dictionary mapping recipient fingerprint to future,
+            dictionary mapping rejected or offline recipient fingerprint to error message)
+        """
+        if private_key is None:
+            private_key, fingerprint = self.private_key, self.fingerprint
+        futures = {}
+        errors = {}
+
+        targets = []
+        recipient_keys = {}
+        for host, port, recipient in recipients:
+            if self._offline(recipient):
+                errors[recipient] = f"Peer offline: {recipient}"
+                continue
+            try:
+                public_key = keystore.load_peer_key(recipient)
+            except FileNotFoundError:
+                errors[recipient] = f"Peer not found: {recipient}"
+                continue
+            targets.append((host, port, recipient))
+
+            # Peers not negotiated with yet may still read the shared envelope
+            features = network.cached_features(host, port, None)
+            if features is None or 'multi' in features[1]:
+                recipient_keys[recipient] = public_key
+
+        shared = _SharedEnvelope(plaintext, recipient_keys, private_key, fingerprint) if recipient_keys else None
+        for host, port, recipient in targets:
+            job = _Job(partial(_seal, plaintext, recipient, shared if recipient in recipient_keys else None,
+                               private_key, fingerprint), wait_for_delivery)
+            try:
+                self._submit(host, port, recipient, [job])
+            except ValueError as e:
+                errors[recipient] = str(e)
+                continue
+            futures[recipient] = job.future
+
+        return futures, errors
+
+    def _offline(self, fingerprint: str) -> bool:
+        """
+        Check whether a peer is known to be offline, counting skipped sends.
+        """
+        if self.presence is not None and self.presence.is_offline(fingerprint):
+            metrics.increment('send.offline_skipped')
+            return True
+        return False
+
+    def _submit(self, host: str, port: int, fingerprint: str, jobs: list):
+        """
+        Append jobs to a peer's queue and schedule the stage that comes next.
+        """
+        with self.lock:
+            if not self.running:
+                raise ValueError("Send engine not started")
+
+            queue = self.queues.get(fingerprint)
+            if queue is None:
+                queue = self.queues[fingerprint] = _PeerQueue(fingerprint, host, port)
+            if len(queue) + len(jobs) > self.max_queued:
+                raise ValueError(f"Send queue full for peer: {fingerprint}")
+
+            # Latest known address of the peer, used from the next connection on
+            queue.host, queue.port = host, port
+            queue.pending.extend(jobs)
+            stages = self._schedule(queue)
+
+        self._dispatch(queue, stages)
+
+    def _schedule(self, queue: _PeerQueue) -> list:
+        """
+        Mark the stages a peer's queue needs next as running (lock held).
+
+        Returns:
+            Stages to hand to _dispatch once the lock is released
+        """
+        stages = []
+        if queue.conn is None and not queue.connecting and (queue.pending or queue.ready):
+            queue.connecting = True
+            stages.append(self._connect)
+        if queue.pending and queue.features is not None and not queue.encrypting:
+            queue.encrypting = True
+            stages.append(self._encrypt)
+        if queue.ready and queue.conn is not None and not queue.writing:
+            queue.writing = True
+            stages.append(self._write)
+        return stages
+
+    def _dispatch(self, queue: _PeerQueue, stages: list):
+        """
+        Run stages from _schedule: connecting on the connector threads, the rest on the workers.
+        """
+        for stage in stages:
+            if stage == self._connect:
+                try:
+                    self.connector.submit(stage, queue)
+                except RuntimeError:
+                    # Stopped meanwhile; stop() fails the queued jobs
+                    pass
+            else:
+                self.tasks.put((stage, queue))
+
+    def _worker(self):
+        """
+        Run stage tasks until stopped.
+        """
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                break
+            stage, queue = task
+            try:
+                stage(queue)
+            except Exception as e:
+                print(f"Error in send engine: {e}")
+
+    def _release(self, queue: _PeerQueue):
+        """
+        Forget a peer's queue and pool its connection once nothing is
+        queued, running or waiting for acks for it (lock held).
+        """
+        if (queue or queue.waiters or queue.connecting or queue.encrypting or queue.writing or
+                queue.stalled is not None):
+            return
+        if self.queues.get(queue.fingerprint) is queue:
+            del self.queues[queue.fingerprint]
+        if queue.conn is not None:
+            self._retire(queue.conn, queue.host, queue.port, True)
+            queue.conn = None
+
+    def _retire(self, conn, host: str, port: int, reuse: bool):
+        """
+        Pool or close a connection no peer queue uses anymore (lock held).
+        Connections still in the reactor's selector are left to the reactor.
+        """
+        self.watching.pop(conn, None)
+        if conn in self.registered:
+            self.retired.append((conn, host, port, reuse))
+            self._wake()
+        elif reuse and self.running:
+            network.checkin_connection(host, port, conn)
+        else:
+            conn.close()
+
+    def _disconnect(self, queue: _PeerQueue, conn) -> list:
+        """
+        Drop a failed connection of a peer queue (lock held).
+
+        Returns:
+            Jobs that were waiting for acks on it, for the caller to fail
+        """
+        if queue.conn is not conn:
+            return []
+        jobs = [job for _, waiting, _ in queue.waiters for job in waiting]
+        queue.waiters.clear()
+        queue.conn = None
+        queue.stalled = None
+        self._retire(conn, queue.host, queue.port, False)
+        return jobs
+
+    def _connect(self, queue: _PeerQueue):
+        """
+        Connect stage, on a connector thread: negotiate with the peer and
+        take a pooled or new connection, then schedule encryption and writes.
+        """
+        with self.lock:
+            host, port, fingerprint = queue.host, queue.port, queue.fingerprint
+
+        error = None
+        if self._offline(fingerprint):
+            error = ConnectionError(f"Peer offline: {fingerprint}")
+        else:
+            try:
+                version, features = network.negotiate_features(host, port, CONNECT_TIMEOUT)
+                conn, reused = network.checkout_connection(host, port, CONNECT_TIMEOUT)
+            except ConnectionError as e:
+                self._report(fingerprint, False)
+                error = e
+
+        with self.lock:
+            queue.connecting = False
+            if error is not None or not self.running:
+                if error is None:
+                    conn.close()
+                jobs = [*queue.pending, *queue.ready]
+                queue.pending.clear()
+                queue.ready.clear()
+                self._release(queue)
+                stages = []
+            else:
+                queue.conn, queue.reused = conn, reused
+                queue.version, queue.features = version, features
+                stages = self._schedule(queue)
+                self._release(queue)
+
+        if error is not None:
+            _fail(jobs, error)
+        self._dispatch(queue, stages)
+
+    def _encrypt(self, queue: _PeerQueue):
+        """
+        Encryption stage: build envelopes for pending messages in order and
+        schedule the write stage.
+        """
+        while True:
+            with self.lock:
+                if not queue.pending:
+                    queue.encrypting = False
+                    self._release(queue)
+                    return
+                jobs = list(queue.pending)
+                queue.pending.clear()
+                version, features = queue.version, queue.features
+
+            encrypted = []
+            for job in jobs:
+                try:
+                    job.data = job.build(version, features)
+                except Exception as e:
+                    # Builders may come from submit(); their errors belong to their message
+                    job.future.set_exception(e)
+                    continue
+                job.build = None
+                encrypted.append(job)
+
+            with self.lock:
+                queue.ready.extend(encrypted)
+                stages = self._schedule(queue)
+            self._dispatch(queue, stages)
+
+    def _write(self, queue: _PeerQueue):
+        """
+        Write stage: send ready envelopes in order, as batch frames where the
+        peer accepts them. Futures of messages not waiting for acks resolve
+        once written; the others are left to the reactor. If the peer has
+        granted no credit, the stage parks until the reactor resumes it.
+        """
+        while True:
+            with self.lock:
+                conn = queue.conn
+                if not queue.ready or conn is None:
+                    queue.writing = False
+                    stages = self._schedule(queue)
+                    self._release(queue)
+                    break
+
+                if conn.acks and conn.sent >= conn.limit:
+                    # Out of credit until the peer acks; the reactor reschedules this stage
+                    queue.stalled = time.monotonic() + network.DELIVERY_TIMEOUT
+                    self.watching[conn] = queue
+                    self._wake()
+                    return
+
+                batch = [queue.ready.popleft()]
+                size = len(batch[0].data)
+                while 'batch' in queue.features and queue.ready and len(batch) < MAX_BATCH_MESSAGES:
+                    size += len(queue.ready[0].data)
+                    if size > MAX_BATCH_BYTES:
+                        break
+                    batch.append(queue.ready.popleft())
+                reused = queue.reused
+
+            if self._offline(queue.fingerprint):
+                _fail(batch, ConnectionError(f"Peer offline: {queue.fingerprint}"))
+                continue
+
+            now = metrics.clock()
+            for job in batch:
+                metrics.observe('send.queue_wait', now - job.queued)
+
+            data = batch[0].data if len(batch) == 1 else message.pack_batch([job.data for job in batch])
+            try:
+                seq = conn.send(data)
+            except (OSError, ValueError) as e:
+                with self.lock:
+                    failed = self._disconnect(queue, conn)
+                    if reused:
+                        # Pooled connection went stale, retry once on a fresh one
+                        queue.ready.extendleft(reversed(batch))
+                        queue.writing = False
+                        stages = self._schedule(queue)
+                        self._release(queue)
+                if reused:
+                    _fail(failed, ConnectionError(f"Failed to send message: {e}"))
+                    self._dispatch(queue, stages)
+                    return
+                self._report(queue.fingerprint, False)
+                _fail(batch + failed, ConnectionError(f"Failed to send message: {e}"))
+                continue
+
+            self._report(queue.fingerprint, True)
+            done = batch
+            if conn.acks:
+                waiting = [job for job in batch if job.wait]
+                if waiting:
+                    done = [job for job in batch if not job.wait]
+                    with self.lock:
+                        attached = queue.conn is conn
+                        if attached:
+                            queue.waiters.append((seq, waiting, time.monotonic() + network.DELIVERY_TIMEOUT))
+                            self.watching[conn] = queue
+                            self._wake()
+                    if not attached:
+                        # Dropped by the reactor meanwhile, the ack can no longer arrive
+                        _fail(waiting, ConnectionError("Connection closed by peer"))
+                    elif conn.processed >= seq:
+                        # The reactor read the ack before the waiter was added
+                        self._acked(queue, conn)
+            with self.lock:
+                queue.reused = False
+            for job in done:
+                job.future.set_result(True)
+
+        self._dispatch(queue, stages)
+
+    def _wake(self):
+        """
+        Make the reactor look at its connections again.
+        """
+        try:
+            self.wakeup[1].send(b'\0')
+        except (BlockingIOError, OSError):
+            # Already woken, or stopped
+            pass
+
+    def _react(self):
+        """
+        Reactor thread: read acks from connections with messages waiting for
+        them or writes waiting for credit, resolve those messages, resume
+        those writes and fail both when the peer does not answer in time.
+        """
+        selector = selectors.DefaultSelector()
+        selector.register(self.wakeup[0], selectors.EVENT_READ)
+        try:
+            while True:
+                with self.lock:
+                    # Follow the watched connections, before pooling or closing retired ones
+                    for conn in list(self.registered):
+                        if conn not in self.watching:
+                            selector.unregister(conn.sock)
+                            self.registered.discard(conn)
+                    retired, self.retired = self.retired, []
+                    for conn, host, port, reuse in retired:
+                        if reuse and self.running:
+                            network.checkin_connection(host, port, conn)
+                        else:
+                            conn.close()
+                    if not self.running:
+                        break
+                    for conn, queue in self.watching.items():
+                        if conn not in self.registered:
+                            selector.register(conn.sock, selectors.EVENT_READ, (conn, queue))
+                            self.registered.add(conn)
+
+                    deadlines = [deadline for queue in self.watching.values()
+                                 for deadline in (queue.stalled, queue.waiters[0][2] if queue.waiters else None)
+                                 if deadline is not None]
+                timeout = max(0.0, min(deadlines) - time.monotonic()) if deadlines else None
+
+                for key, _ in selector.select(timeout):
+                    if key.data is None:
+                        try:
+                            while self.wakeup[0].recv(4096):
+                                pass
+                        except BlockingIOError:
+                            pass
+                        continue
+                    conn, queue = key.data
+                    try:
+                        conn.poll()
+                    except (OSError, ValueError) as e:
+                        self._fail_connection(queue, conn, ConnectionError(f"Delivery failed: {e}"))
+                        continue
+                    self._acked(queue, conn)
+
+                self._expire()
+        finally:
+            selector.close()
+
+    def _acked(self, queue: _PeerQueue, conn):
+        """
+        Resolve messages the peer acked and resume a write waiting for credit.
+        """
+        done = []
+        stages = []
+        with self.lock:
+            if queue.conn is not conn:
+                return
+            while queue.waiters and queue.waiters[0][0] <= conn.processed:
+                done.extend(queue.waiters.popleft()[1])
+            if queue.stalled is not None and conn.sent < conn.limit:
+                queue.stalled = None
+                stages.append(self._write)
+            if not queue.waiters and queue.stalled is None:
+                self.watching.pop(conn, None)
+                self._release(queue)
+
+        for job in done:
+            job.future.set_result(True)
+        self._dispatch(queue, stages)
+
+    def _expire(self):
+        """
+        Drop connections whose peer did not ack or grant credit in time.
+        """
+        now = time.monotonic()
+        with self.lock:
+            late = [(queue, conn) for conn, queue in self.watching.items()
+                    if (queue.stalled is not None and queue.stalled <= now) or
+                    (queue.waiters and queue.waiters[0][2] <= now)]
+        for queue, conn in late:
+            self._fail_connection(queue, conn, ConnectionError(f"No delivery ack from {queue.host}:{queue.port}"))
+
+    def _fail_connection(self, queue: _PeerQueue, conn, error: ConnectionError):
+        """
+        Fail what waits for acks on a broken or silent connection; queued
+        messages go out on a new connection.
+        """
+        with self.lock:
+            stalled = queue.stalled is not None and queue.conn is conn
+            jobs = self._disconnect(queue, conn)
+            if stalled:
+                queue.writing = False
+            stages = self._schedule(queue)
+            self._release(queue)
+
+        self._report(queue.fingerprint, False)
+        _fail(jobs, error)
+        self._dispatch(queue, stages)
+
+    def _report(self, fingerprint: str, reached: bool):
+        """
+        Tell the presence monitor whether a peer was reached.
+        """
+        if self.presence is not None:
+            if reached:
+                self.presence.seen(fingerprint)
+            else:
+                self.presence.failed(fingerprint)
+
+
+def _seal(plaintext: str, recipient_fingerprint: str, shared: _SharedEnvelope, private_key,
+          fingerprint: str, version: int, features: frozenset) -> bytes:
+    """
+    Build a message's envelope for a peer: the shared envelope if the peer
+    reads multi-recipient envelopes, else its own.
+
+    Raises:
+        ValueError: If recipient key not found or the message cannot be encrypted
+    """
+    if shared is not None and 'multi' in features:
+        return shared.build(version)
+    try:
+        recipient_public_key = keystore.load_peer_key(recipient_fingerprint)
+    except FileNotFoundError:
+        raise ValueError(f"Peer not found: {recipient_fingerprint}")
+    return message.create_peer_message(plaintext, recipient_fingerprint, recipient_public_key,
+                                       private_key, fingerprint, version, features)
+
+
+def _fail(jobs: list, error: Exception):
+    for job in jobs:
+        job.future.set_exception(error)
+
+
+# Engine of send_batch_messages callers that do not pass their own
+_shared_engine = None
+_shared_engine_lock = threading.Lock()
+
+
+def shared_engine() -> SendEngine:
+    """
+    Get the process-wide engine for broadcasts signed by the caller, started on first use.
+    """
+    global _shared_engine
+    with _shared_engine_lock:
+        if _shared_engine is None:
+            _shared_engine = SendEngine(None, None)
+            _shared_engine.start()
+        return _shared_engine
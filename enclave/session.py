@@ -0,0 +1,207 @@
+"""
+Session key module for Enclave.
+Handles per-peer symmetric session keys so that RSA operations are only
+paid once per session instead of once per message.
+
+A session is opened by the sender: it picks a random secret, wraps it with
+the recipient's public key and signs the session header with its own
+identity key. Every message of the session carries this header, so the
+receiver can open the session from any message (no handshake round-trip,
+robust to reordering and restarts) and caches the derived key afterwards.
+"""
+
+import os
+import time
+import threading
+from collections import OrderedDict
+import msgpack
+from . import crypto
+
+
+# Rekey after this many messages or seconds, whichever comes first
+SESSION_MAX_MESSAGES = 10000
+SESSION_MAX_AGE = 3600
+
+# Allowed clock skew when checking session creation time (seconds)
+SESSION_CLOCK_SKEW = 300
+
+# Maximum number of incoming sessions kept in cache
+MAX_INCOMING_SESSIONS = 4096
+
+# HKDF context string for session message keys
+_KEY_INFO = b"enclave session v1"
+
+# Outgoing sessions ((sender_fingerprint, recipient_fingerprint) -> Session)
+_outgoing_sessions = {}
+_outgoing_lock = threading.Lock()
+
+# Incoming session keys (session_id -> (sender_fingerprint, created, key))
+_incoming_sessions = OrderedDict()
+_incoming_lock = threading.Lock()
+
+
+class Session:
+    """
+    Outgoing session with a single peer.
+    """
+
+    def __init__(self, recipient_public_key, sender_private_key, sender_fingerprint: str):
+        """
+        Create a new session and sign its header.
+
+        Args:
+            recipient_public_key: Recipient's RSA public key
+            sender_private_key: Sender's RSA private key
+            sender_fingerprint: Sender's key fingerprint
+        """
+        self.session_id = os.urandom(16)
+        self.created = time.time()
+        self.messages_sent = 0
+
+        secret = os.urandom(32)
+        self.key = crypto.derive_key(secret, self.session_id, _KEY_INFO)
+
+        header = {
+            'session_id': self.session_id,
+            'created': self.created,
+            'sender_fingerprint': sender_fingerprint,
+            'encrypted_key': crypto.wrap_key(secret, recipient_public_key)
+        }
+        header['signature'] = crypto.sign_message(_pack_header(header), sender_private_key)
+        self.header = header
+
+    def expired(self) -> bool:
+        """
+        Check whether the session must be rekeyed.
+
+        Returns:
+            True if the session has reached its message or age limit
+        """
+        return (self.messages_sent >= SESSION_MAX_MESSAGES or
+                time.time() - self.created >= SESSION_MAX_AGE)
+
+
+def _pack_header(header: dict) -> bytes:
+    """
+    Serialize the signed part of a session header.
+
+    Args:
+        header: Session header dictionary
+
+    Returns:
+        Bytes covered by the header signature
+    """
+    return msgpack.packb([
+        header['session_id'],
+        header['created'],
+        header['sender_fingerprint'],
+        header['encrypted_key']
+    ], use_bin_type=True)
+
+
+def get_outgoing_session(recipient_fingerprint: str, recipient_public_key,
+                         sender_private_key, sender_fingerprint: str) -> Session:
+    """
+    Get the current session with a peer, creating or rekeying it if needed.
+
+    Args:
+        recipient_fingerprint: Recipient's key fingerprint
+        recipient_public_key: Recipient's RSA public key
+        sender_private_key: Sender's RSA private key
+        sender_fingerprint: Sender's key fingerprint
+
+    Returns:
+        Session with its message counter already incremented
+    """
+    session_key = (sender_fingerprint, recipient_fingerprint)
+
+    with _outgoing_lock:
+        session = _outgoing_sessions.get(session_key)
+        if session is None or session.expired():
+            session = Session(recipient_public_key, sender_private_key, sender_fingerprint)
+            _outgoing_sessions[session_key] = session
+
+        session.messages_sent += 1
+        return session
+
+
+def _check_session_age(created: float):
+    """
+    Check that a session is not expired or created in the future.
+
+    Args:
+        created: Session creation timestamp
+
+    Raises:
+        ValueError: If the session is outside its lifetime
+    """
+    current_time = time.time()
+    if created > current_time + SESSION_CLOCK_SKEW:
+        raise ValueError("Session created in the future")
+    if created < current_time - SESSION_MAX_AGE - SESSION_CLOCK_SKEW:
+        raise ValueError("Session expired")
+
+
+def open_session(header: dict, sender_fingerprint: str, sender_public_key, my_private_key) -> bytes:
+    """
+    Get the key of an incoming session, verifying its header on first use.
+
+    Args:
+        header: Session header from message envelope
+        sender_fingerprint: Sender's key fingerprint claimed by the envelope
+        sender_public_key: Sender's RSA public key
+        my_private_key: Recipient's RSA private key
+
+    Returns:
+        32-byte session key
+
+    Raises:
+        ValueError: If the session header is invalid or expired
+    """
+    session_id = header['session_id']
+
+    # Check cache first
+    with _incoming_lock:
+        cached = _incoming_sessions.get(session_id)
+        if cached is not None:
+            _incoming_sessions.move_to_end(session_id)
+
+    if cached is not None:
+        cached_sender, created, key = cached
+        if cached_sender != sender_fingerprint:
+            raise ValueError("Session belongs to another sender")
+
+        # Headers are only verified on first use, so the age comes from the
+        # verified creation time, never from this message's unchecked header
+        _check_session_age(created)
+        return key
+
+    _check_session_age(header['created'])
+
+    # Not in cache, verify header and unwrap session secret
+    if header['sender_fingerprint'] != sender_fingerprint:
+        raise ValueError("Session belongs to another sender")
+
+    if not crypto.verify_signature(_pack_header(header), header['signature'], sender_public_key):
+        raise ValueError("Invalid session signature")
+
+    secret = crypto.unwrap_key(header['encrypted_key'], my_private_key)
+    key = crypto.derive_key(secret, session_id, _KEY_INFO)
+
+    # Add to cache, evicting least recently used sessions
+    with _incoming_lock:
+        _incoming_sessions[session_id] = (sender_fingerprint, header['created'], key)
+        while len(_incoming_sessions) > MAX_INCOMING_SESSIONS:
+            _incoming_sessions.popitem(last=False)
+
+    return key
+
+
+def clear_sessions():
+    """
+    Drop all cached sessions, forcing new sessions on the next message.
+    """
+    with _outgoing_lock:
+        _outgoing_sessions.clear()
+    with _incoming_lock:
+        _incoming_sessions.clear()
@@ -0,0 +1,476 @@
+"""
+File transfer protocol module for Enclave.
+Handles transfer manifests, chunk encryption and resumable partial files.
+
+A transfer runs on its own connection:
+1. Sender sends a signed manifest carrying a per-transfer AES key wrapped
+   for the recipient and the encrypted file metadata.
+2. Receiver answers with an ack holding the index of the first missing
+   chunk (non-zero when resuming a partial download).
+3. Sender streams AES-256-GCM encrypted chunks; the receiver acks every
+   ACK_INTERVAL chunks once they are written, and the sender never runs
+   more than WINDOW chunks ahead of the last ack.
+4. Sender finishes with an encrypted SHA-256 of the whole file; the
+   receiver checks it and acks completion.
+
+Frames are sent with the normal 4-byte length prefix. Their first byte is
+a frame type below 0x80, which never starts a msgpack map envelope.
+"""
+
+import os
+import time
+import uuid
+import struct
+import hashlib
+import msgpack
+from pathlib import Path
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from . import crypto
+
+
+# Frame types (first payload byte)
+FRAME_FILE_MANIFEST = 0x01
+FRAME_FILE_CHUNK = 0x02
+FRAME_FILE_END = 0x03
+FRAME_FILE_ACK = 0x04
+
+# Transfer parameters
+CHUNK_SIZE = 1024 * 1024  # 1 MiB plaintext per chunk
+ACK_INTERVAL = 8          # Receiver acks after this many chunks
+WINDOW = 32               # Max unacknowledged chunks in flight (bounds memory)
+
+# Largest accepted chunk frame: type + index + nonce + ciphertext + tag
+MAX_CHUNK_FRAME = 1 + 8 + 12 + CHUNK_SIZE + 16
+
+_CHUNK_HEADER = struct.Struct('!BQ12s')
+_ACK = struct.Struct('!BQ?')
+
+# Partial downloads live here until complete
+PARTIAL_DIR_NAME = ".partial"
+
+# Seconds a partial download is kept without progress before it is pruned
+PARTIAL_MAX_AGE = 7 * 24 * 3600
+
+
+def create_manifest(name: str, size: int, recipient_public_key, sender_private_key,
+                    sender_fingerprint: str, transfer_id: str = None) -> tuple:
+    """
+    Create signed transfer manifest with a fresh per-transfer key.
+
+    Args:
+        name: File name shown to the recipient
+        size: File size in bytes
+        recipient_public_key: Recipient's public key
+        sender_private_key: Sender's private key
+        sender_fingerprint: Sender's key fingerprint
+        transfer_id: ID of a transfer to resume (default: new ID)
+
+    Returns:
+        Tuple of (manifest frame bytes, transfer_id, key)
+    """
+    transfer_id = transfer_id or str(uuid.uuid4())
+    key = os.urandom(32)
+
+    # File metadata is encrypted so only the recipient sees it
+    metadata = msgpack.packb({'name': name, 'size': size, 'chunk_size': CHUNK_SIZE}, use_bin_type=True)
+    nonce = os.urandom(12)
+    encrypted_metadata = AESGCM(key).encrypt(nonce, metadata, transfer_id.encode('utf-8'))
+
+    manifest = {
+        'version': 1,
+        'type': 'file',
+        'transfer_id': transfer_id,
+        'timestamp': time.time(),
+        'sender_fingerprint': sender_fingerprint,
+        'key_type': crypto.get_key_type(sender_private_key),
+        'encrypted_key': crypto.wrap_key(key, recipient_public_key),
+        'metadata_nonce': nonce,
+        'metadata': encrypted_metadata
+    }
+    manifest['signature'] = crypto.sign_message(_pack_manifest(manifest), sender_private_key)
+
+    frame = bytes([FRAME_FILE_MANIFEST]) + msgpack.packb(manifest, use_bin_type=True)
+    return frame, transfer_id, key
+
+
+def _pack_manifest(manifest: dict) -> bytes:
+    """
+    Serialize the signed part of a manifest.
+
+    Args:
+        manifest: Manifest dictionary
+
+    Returns:
+        Bytes covered by the manifest signature
+    """
+    return msgpack.packb([
+        manifest['transfer_id'],
+        manifest['timestamp'],
+        manifest['sender_fingerprint'],
+        manifest['key_type'],
+        manifest['encrypted_key'],
+        manifest['metadata_nonce'],
+        manifest['metadata']
+    ], use_bin_type=True)
+
+
+def parse_manifest(frame) -> dict:
+    """
+    Parse transfer manifest frame.
+
+    Args:
+        frame: Frame bytes starting with FRAME_FILE_MANIFEST
+
+    Returns:
+        Manifest dictionary
+
+    Raises:
+        ValueError: If manifest format is invalid
+    """
+    try:
+        manifest = msgpack.unpackb(frame[1:], raw=False)
+
+        required_fields = ['version', 'transfer_id', 'timestamp', 'sender_fingerprint', 'key_type',
+                           'encrypted_key', 'metadata_nonce', 'metadata', 'signature']
+        for field in required_fields:
+            if field not in manifest:
+                raise ValueError(f"Missing required field: {field}")
+
+        if manifest['version'] != 1:
+            raise ValueError(f"Unsupported protocol version: {manifest['version']}")
+
+        return manifest
+
+    except Exception as e:
+        raise ValueError(f"Invalid manifest format: {str(e)}")
+
+
+def verify_manifest(manifest: dict, sender_public_key, my_private_key) -> tuple:
+    """
+    Verify manifest signature and timestamp, and unwrap the transfer key.
+
+    Args:
+        manifest: Parsed manifest
+        sender_public_key: Sender's public key
+        my_private_key: Recipient's private key
+
+    Returns:
+        Tuple of (key, metadata dictionary with name, size and chunk_size)
+
+    Raises:
+        ValueError: If verification or decryption fails
+    """
+    if manifest['key_type'] != crypto.get_key_type(sender_public_key):
+        raise ValueError("Sender key type mismatch")
+
+    if not crypto.verify_signature(_pack_manifest(manifest), manifest['signature'], sender_public_key):
+        raise ValueError("Invalid signature")
+
+    # Check timestamp (must be within 5 minutes of current time)
+    if abs(manifest['timestamp'] - time.time()) > 300:
+        raise ValueError("Manifest timestamp outside allowed window")
+
+    key = crypto.unwrap_key(manifest['encrypted_key'], my_private_key)
+
+    try:
+        metadata = msgpack.unpackb(AESGCM(key).decrypt(
+            manifest['metadata_nonce'],
+            manifest['metadata'],
+            manifest['transfer_id'].encode('utf-8')
+        ), raw=False)
+    except Exception:
+        raise ValueError("Manifest integrity check failed")
+
+    if metadata['chunk_size'] > CHUNK_SIZE or metadata['chunk_size'] <= 0 or metadata['size'] < 0:
+        raise ValueError("Invalid manifest metadata")
+
+    return key, metadata
+
+
+def encrypt_chunk(key: bytes, transfer_id: str, index: int, data) -> list:
+    """
+    Encrypt one file chunk.
+
+    Args:
+        key: Per-transfer key
+        transfer_id: Transfer ID
+        index: Chunk index
+        data: Plaintext chunk (bytes-like)
+
+    Returns:
+        List of byte buffers forming the chunk frame
+    """
+    nonce = os.urandom(12)
+    aad = transfer_id.encode('utf-8') + struct.pack('!Q', index)
+    ciphertext = AESGCM(key).encrypt(nonce, data, aad)
+    return [_CHUNK_HEADER.pack(FRAME_FILE_CHUNK, index, nonce), ciphertext]
+
+
+def decrypt_chunk(key: bytes, transfer_id: str, frame) -> tuple:
+    """
+    Decrypt one file chunk frame.
+
+    Args:
+        key: Per-transfer key
+        transfer_id: Transfer ID
+        frame: Frame bytes starting with FRAME_FILE_CHUNK
+
+    Returns:
+        Tuple of (index, plaintext bytes)
+
+    Raises:
+        ValueError: If the chunk fails authentication
+    """
+    _, index, nonce = _CHUNK_HEADER.unpack_from(frame)
+    aad = transfer_id.encode('utf-8') + struct.pack('!Q', index)
+    try:
+        plaintext = AESGCM(key).decrypt(nonce, memoryview(frame)[_CHUNK_HEADER.size:], aad)
+    except Exception:
+        raise ValueError("Chunk integrity check failed")
+    return index, plaintext
+
+
+def encrypt_end(key: bytes, transfer_id: str, file_hash: bytes, chunk_count: int) -> bytes:
+    """
+    Build final frame carrying the encrypted SHA-256 of the whole file.
+
+    Args:
+        key: Per-transfer key
+        transfer_id: Transfer ID
+        file_hash: SHA-256 digest of the file
+        chunk_count: Total number of chunks
+
+    Returns:
+        End frame bytes
+    """
+    nonce = os.urandom(12)
+    aad = transfer_id.encode('utf-8') + b'end'
+    payload = AESGCM(key).encrypt(nonce, struct.pack('!Q', chunk_count) + file_hash, aad)
+    return bytes([FRAME_FILE_END]) + nonce + payload
+
+
+def decrypt_end(key: bytes, transfer_id: str, frame) -> tuple:
+    """
+    Decrypt final frame.
+
+    Args:
+        key: Per-transfer key
+        transfer_id: Transfer ID
+        frame: Frame bytes starting with FRAME_FILE_END
+
+    Returns:
+        Tuple of (chunk_count, file_hash)
+
+    Raises:
+        ValueError: If the frame fails authentication
+    """
+    aad = transfer_id.encode('utf-8') + b'end'
+    try:
+        payload = AESGCM(key).decrypt(bytes(frame[1:13]), bytes(frame[13:]), aad)
+    except Exception:
+        raise ValueError("End frame integrity check failed")
+    return struct.unpack('!Q', payload[:8])[0], payload[8:]
+
+
+def pack_ack(next_index: int, complete: bool = False) -> bytes:
+    """
+    Build ack frame.
+
+    Args:
+        next_index: Index of the first chunk not yet written
+        complete: Whether the whole file was received and verified
+
+    Returns:
+        Ack frame bytes
+    """
+    return _ACK.pack(FRAME_FILE_ACK, next_index, complete)
+
+
+def unpack_ack(frame) -> tuple:
+    """
+    Parse ack frame.
+
+    Args:
+        frame: Frame bytes starting with FRAME_FILE_ACK
+
+    Returns:
+        Tuple of (next_index, complete)
+
+    Raises:
+        ValueError: If frame is not an ack
+    """
+    if len(frame) != _ACK.size or frame[0] != FRAME_FILE_ACK:
+        raise ValueError("Invalid ack frame")
+    _, next_index, complete = _ACK.unpack(frame)
+    return next_index, complete
+
+
+def prune_partials(download_dir, max_age: float = PARTIAL_MAX_AGE) -> int:
+    """
+    Delete partial downloads that made no progress for max_age seconds.
+
+    Args:
+        download_dir: Directory for completed files
+        max_age: Seconds since a partial file was last written (default: 7 days)
+
+    Returns:
+        Number of partial downloads deleted
+    """
+    partial_dir = Path(download_dir) / PARTIAL_DIR_NAME
+    if not partial_dir.is_dir():
+        return 0
+
+    cutoff = time.time() - max_age
+    pruned = 0
+    for meta_path in partial_dir.glob("*.meta"):
+        part_path = meta_path.with_suffix(".part")
+        try:
+            # Chunk writes touch the .part file, so its mtime tracks progress
+            mtime = (part_path if part_path.exists() else meta_path).stat().st_mtime
+            if mtime >= cutoff:
+                continue
+            part_path.unlink(missing_ok=True)
+            meta_path.unlink(missing_ok=True)
+            pruned += 1
+        except OSError:
+            # Resumed or finished meanwhile
+            continue
+
+    # Part files whose metadata is gone can never be resumed
+    for part_path in partial_dir.glob("*.part"):
+        try:
+            if not part_path.with_suffix(".meta").exists() and part_path.stat().st_mtime < cutoff:
+                part_path.unlink()
+                pruned += 1
+        except OSError:
+            continue
+
+    return pruned
+
+
+class IncomingTransfer:
+    """
+    Partial download written straight to disk, resumable across connections.
+    """
+
+    def __init__(self, download_dir, sender_fingerprint: str, transfer_id: str, metadata: dict):
+        """
+        Open or resume partial download.
+
+        Args:
+            download_dir: Directory for completed files
+            sender_fingerprint: Sender's key fingerprint
+            transfer_id: Transfer ID
+            metadata: Verified manifest metadata
+        """
+        self.download_dir = Path(download_dir)
+        self.transfer_id = transfer_id
+        self.metadata = metadata
+        self.chunk_size = metadata['chunk_size']
+        self.chunk_count = -(-metadata['size'] // self.chunk_size)
+
+        partial_dir = self.download_dir / PARTIAL_DIR_NAME
+        partial_dir.mkdir(parents=True, exist_ok=True)
+
+        # Transfer ID is only used in file names after validation
+        safe_id = str(uuid.UUID(transfer_id))
+        self.part_path = partial_dir / f"{safe_id}.part"
+        meta_path = partial_dir / f"{safe_id}.meta"
+
+        identity = msgpack.packb([sender_fingerprint, metadata['name'], metadata['size'], self.chunk_size],
+                                 use_bin_type=True)
+
+        # Resume only if the partial file belongs to the same sender and file
+        if not (meta_path.exists() and meta_path.read_bytes() == identity):
+            meta_path.write_bytes(identity)
+            self.part_path.write_bytes(b'')
+
+        self.meta_path = meta_path
+        self.hasher = hashlib.sha256()
+
+        # Keep only whole chunks and rebuild the running hash from disk
+        self.file = open(self.part_path, 'r+b')
+        self.received = min(os.path.getsize(self.part_path) // self.chunk_size, self.chunk_count)
+        self.file.truncate(self.received * self.chunk_size)
+
+        remaining = self.received * self.chunk_size
+        buffer = bytearray(min(self.chunk_size, 1024 * 1024))
+        view = memoryview(buffer)
+        while remaining:
+            read = self.file.readinto(view[:min(len(buffer), remaining)])
+            if not read:
+                break
+            self.hasher.update(view[:read])
+            remaining -= read
+
+    def write_chunk(self, index: int, data: bytes):
+        """
+        Append the next chunk.
+
+        Args:
+            index: Chunk index (must be the next expected one)
+            data: Plaintext chunk
+
+        Raises:
+            ValueError: If chunk is out of order or has the wrong size
+        """
+        if index != self.received or index >= self.chunk_count:
+            raise ValueError(f"Unexpected chunk {index}, expected {self.received}")
+
+        expected_size = min(self.chunk_size, self.metadata['size'] - index * self.chunk_size)
+        if len(data) != expected_size:
+            raise ValueError("Chunk size mismatch")
+
+        self.file.write(data)
+        self.hasher.update(data)
+        self.received += 1
+
+    def flush(self):
+        """
+        Flush written chunks to disk before acknowledging them.
+        """
+        self.file.flush()
+
+    def finish(self, chunk_count: int, file_hash: bytes) -> Path:
+        """
+        Verify the complete file and move it to the download directory.
+
+        Args:
+            chunk_count: Chunk count announced by the sender
+            file_hash: SHA-256 digest announced by the sender
+
+        Returns:
+            Path of the completed file
+
+        Raises:
+            ValueError: If the file is incomplete or corrupted
+        """
+        self.file.close()
+
+        if chunk_count != self.chunk_count or self.received != self.chunk_count:
+            raise ValueError("Transfer incomplete")
+
+        if self.hasher.digest() != file_hash:
+            # Corrupted partial file cannot be resumed
+            self.part_path.unlink()
+            self.meta_path.unlink()
+            raise ValueError("File hash mismatch")
+
+        # Never trust sender-provided paths
+        name = os.path.basename(self.metadata['name']).strip() or self.transfer_id
+        target = self.download_dir / name
+        counter = 1
+        while target.exists():
+            target = self.download_dir / f"{Path(name).stem} ({counter}){Path(name).suffix}"
+            counter += 1
+
+        os.replace(self.part_path, target)
+        self.meta_path.unlink()
+        return target
+
+    def close(self):
+        """
+        Close partial file, keeping it for a later resume.
+        """
+        if not self.file.closed:
+            self.file.close()
@@ -3,24 +3,34 @@ User interface module for Enclave.
 Provides interactive terminal chat interface using prompt_toolkit.
 """
 
+import os
 import sys
+import uuid
 import threading
 from datetime import datetime
 from prompt_toolkit import PromptSession
 from prompt_toolkit.formatted_text import HTML
 from prompt_toolkit.shortcuts import print_formatted_text
-from . import network, keystore
+from . import addresses, metrics, network, keystore
 
 
-def start_chat_session(server, my_fingerprint: str, sender_private_key, peers: dict):
+# Failed transfers that /sendfile --resume can continue: transfer ID -> (fingerprint, path)
+_interrupted_transfers = {}
+
+
+def start_chat_session(server, my_fingerprint: str, sender_private_key, peers: dict, client=None, outbox=None,
+                       presence=None):
     """
     Start interactive chat session.
 
     Args:
-        server: Running ChatServer instance
+        server: Running ChatServer instance (None when attached to a daemon)
         my_fingerprint: User's key fingerprint
-        sender_private_key: User's private key for signing outgoing messages
+        sender_private_key: User's private key for signing outgoing messages (None when attached to a daemon)
         peers: Dictionary mapping {fingerprint: (host, port)} for known peers
+        client: DaemonClient to send through instead of the local key (optional)
+        outbox: Started Outbox that delivers outgoing messages (None when attached to a daemon)
+        presence: Started PresenceMonitor tracking the peers (None when attached to a daemon)
     """
     # Create prompt session
     session = PromptSession()
@@ -33,7 +43,7 @@ def start_chat_session(server, my_fingerprint: str, sender_private_key, peers: d
     print("=" * 50)
     print()
     print("Commands: /send <fingerprint> <message> | /broadcast <message>")
-    print("          /peers | /add | /quit")
+    print("          /sendfile <fingerprint> <path> | /sendfile --resume <id> | /peers | /add | /stats | /quit")
     print()
 
     # Main chat loop
@@ -56,16 +66,18 @@ def start_chat_session(server, my_fingerprint: str, sender_private_key, peers: d
 
             # Parse command
             if user_input.startswith('/'):
-                _handle_command(user_input, server, my_fingerprint, sender_private_key, peers)
+                _handle_command(user_input, server, my_fingerprint, sender_private_key, peers, client, outbox,
+                                presence)
             else:
-                print("Unknown command. Use /send, /broadcast, /peers, /add, or /quit")
+                print("Unknown command. Use /send, /sendfile, /broadcast, /peers, /add, /stats, or /quit")
 
     except Exception as e:
         print(f"Error in chat session: {e}")
         _handle_quit(server)
 
 
-def _handle_command(user_input: str, server, my_fingerprint: str, sender_private_key, peers: dict):
+def _handle_command(user_input: str, server, my_fingerprint: str, sender_private_key, peers: dict, client=None,
+                    outbox=None, presence=None):
     """
     Handle user commands.
 
@@ -75,6 +87,9 @@ def _handle_command(user_input: str, server, my_fingerprint: str, sender_private
         my_fingerprint: User's fingerprint
         sender_private_key: User's private key
         peers: Peers dictionary
+        client: DaemonClient (optional)
+        outbox: Outbox (optional)
+        presence: PresenceMonitor (optional)
     """
     parts = user_input.split(maxsplit=2)
     command = parts[0].lower()
@@ -84,7 +99,7 @@ def _handle_command(user_input: str, server, my_fingerprint: str, sender_private
         sys.exit(0)
 
     elif command == "/peers":
-        _handle_peers(peers)
+        _handle_peers(peers, presence, client)
 
     elif command == "/send":
         if len(parts) < 3:
@@ -92,33 +107,44 @@ def _handle_command(user_input: str, server, my_fingerprint: str, sender_private
             return
         fingerprint_prefix = parts[1]
         message_text = parts[2]
-        _handle_send(fingerprint_prefix, message_text, peers, sender_private_key, my_fingerprint)
+        _handle_send(fingerprint_prefix, message_text, peers, outbox, client)
+
+    elif command == "/sendfile":
+        if len(parts) < 3:
+            print("Usage: /sendfile <fingerprint_prefix> <path> | /sendfile --resume <transfer_id>")
+            return
+        if parts[1] == "--resume":
+            _handle_resume_file(parts[2].strip(), peers, sender_private_key, my_fingerprint, client)
+            return
+        _handle_send_file(parts[1], parts[2].strip(), peers, sender_private_key, my_fingerprint, client)
 
     elif command == "/add":
-        _handle_add(peers)
+        _handle_add(peers, client, presence)
 
     elif command == "/broadcast":
         if len(parts) < 2:
             print("Usage: /broadcast <message>")
             return
         message_text = user_input[len("/broadcast "):].strip()
-        _handle_broadcast(message_text, peers, sender_private_key, my_fingerprint)
+        _handle_broadcast(message_text, peers, outbox, client)
+
+    elif command == "/stats":
+        _handle_stats(client)
 
     else:
-        print("Unknown command. Use /send, /broadcast, /peers, /add, or /quit")
+        print("Unknown command. Use /send, /sendfile, /broadcast, /peers, /add, /stats, or /quit")
 
 
-def _handle_send(fingerprint_prefix: str, message_text: str, peers: dict,
-                sender_private_key, sender_fingerprint: str):
+def _handle_send(fingerprint_prefix: str, message_text: str, peers: dict, outbox, client=None):
     """
-    Send message to peer.
+    Queue message to peer; delivery is reported by the delivery callback.
 
     Args:
         fingerprint_prefix: Prefix of recipient's fingerprint (min 8 chars)
         message_text: Message to send
         peers: Peers dictionary
-        sender_private_key: Sender's private key
-        sender_fingerprint: Sender's fingerprint
+        outbox: Outbox (None when attached to a daemon)
+        client: DaemonClient (optional)
     """
     # Check minimum prefix length
     if len(fingerprint_prefix) < 8:
@@ -142,92 +168,216 @@ def _handle_send(fingerprint_prefix: str, message_text: str, peers: dict,
     # Get recipient info
     recipient_fingerprint, recipient_host, recipient_port = matches[0]
 
-    # Send message in background thread (non-blocking)
-    def send_thread():
+    # Queue message (non-blocking), the outbox retries while the peer is unreachable
+    try:
+        if client:
+            client.call('queue', fingerprint=recipient_fingerprint, message=message_text)
+        else:
+            outbox.send(recipient_host, recipient_port, recipient_fingerprint, message_text)
+    except Exception as e:
+        print(f"Failed to send message: {e}")
+
+
+def _handle_send_file(fingerprint_prefix: str, file_path: str, peers: dict,
+                     sender_private_key, sender_fingerprint: str, client=None, transfer_id: str = None):
+    """
+    Stream file to peer. A failed transfer is remembered so that
+    /sendfile --resume continues it from the last acknowledged chunk.
+
+    Args:
+        fingerprint_prefix: Prefix of recipient's fingerprint (min 8 chars)
+        file_path: Path of file to send
+        peers: Peers dictionary
+        sender_private_key: Sender's private key
+        sender_fingerprint: Sender's fingerprint
+        client: DaemonClient (optional)
+        transfer_id: ID of an interrupted transfer to resume (optional)
+    """
+    # Check minimum prefix length
+    if len(fingerprint_prefix) < 8:
+        print("Fingerprint prefix must be at least 8 characters")
+        return
+
+    matches = [(fp, host, port) for fp, (host, port) in peers.items() if fp.startswith(fingerprint_prefix)]
+
+    if len(matches) == 0:
+        print("Peer not found")
+        return
+
+    if len(matches) > 1:
+        print("Ambiguous fingerprint, be more specific")
+        return
+
+    if not os.path.isfile(file_path):
+        print(f"File not found: {file_path}")
+        return
+
+    recipient_fingerprint, recipient_host, recipient_port = matches[0]
+
+    # Choose the ID up front so a failed transfer can be resumed
+    transfer_id = transfer_id or str(uuid.uuid4())
+
+    # Send file in background thread (non-blocking)
+    def send_file_thread():
         try:
-            network.send_message(
-                recipient_host,
-                recipient_port,
-                recipient_fingerprint,
-                message_text,
-                sender_private_key,
-                sender_fingerprint
-            )
-            print(f"Sent to {recipient_fingerprint[:12]}")
+            if client:
+                client.call('send_file', fingerprint=recipient_fingerprint, path=os.path.abspath(file_path),
+                            transfer_id=transfer_id)
+            else:
+                network.send_file(
+                    recipient_host,
+                    recipient_port,
+                    recipient_fingerprint,
+                    file_path,
+                    sender_private_key,
+                    sender_fingerprint,
+                    transfer_id
+                )
+            _interrupted_transfers.pop(transfer_id, None)
+            print(f"File sent to {recipient_fingerprint[:12]}: {os.path.basename(file_path)}")
         except Exception as e:
-            print(f"Failed to send message: {e}")
+            _interrupted_transfers[transfer_id] = (recipient_fingerprint, os.path.abspath(file_path))
+            print(f"Failed to send file: {e}")
+            print(f"Resume with: /sendfile --resume {transfer_id}")
 
-    thread = threading.Thread(target=send_thread, daemon=True)
+    print(f"Sending {os.path.basename(file_path)} to {recipient_fingerprint[:12]}...")
+    thread = threading.Thread(target=send_file_thread, daemon=True)
     thread.start()
 
 
-def _handle_broadcast(message_text: str, peers: dict, sender_private_key, sender_fingerprint: str):
+def _handle_resume_file(transfer_id: str, peers: dict, sender_private_key, sender_fingerprint: str,
+                        client=None):
     """
-    Broadcast message to all peers in parallel.
+    Resume a failed file transfer.
 
     Args:
-        message_text: Message to send
+        transfer_id: ID printed when the transfer failed
         peers: Peers dictionary
         sender_private_key: Sender's private key
         sender_fingerprint: Sender's fingerprint
+        client: DaemonClient (optional)
+    """
+    if transfer_id not in _interrupted_transfers:
+        print(f"No interrupted transfer with ID {transfer_id}")
+        return
+
+    recipient_fingerprint, file_path = _interrupted_transfers[transfer_id]
+    _handle_send_file(recipient_fingerprint, file_path, peers, sender_private_key, sender_fingerprint, client,
+                      transfer_id)
+
+
+def _handle_broadcast(message_text: str, peers: dict, outbox, client=None):
+    """
+    Queue message to all peers; deliveries are reported by the delivery callback.
+
+    Args:
+        message_text: Message to send
+        peers: Peers dictionary
+        outbox: Outbox (None when attached to a daemon)
+        client: DaemonClient (optional)
     """
     if not peers:
         print("No peers configured")
         return
 
-    print(f"Broadcasting to {len(peers)} peer(s)...")
-
     # Prepare recipient list for batch send
     recipients = [(host, port, fp) for fp, (host, port) in peers.items()]
 
-    # Send in background thread
-    def broadcast_thread():
-        try:
-            results, errors = network.send_batch_messages(
-                recipients,
-                message_text,
-                sender_private_key,
-                sender_fingerprint
-            )
-
-            # Report results
-            success_count = sum(1 for v in results.values() if v)
-            print(f"Broadcast complete: {success_count}/{len(peers)} sent successfully")
-
-            # Show errors if any
-            if errors:
-                for fp, error in errors.items():
-                    print(f"  Failed to {fp[:12]}: {error}")
+    try:
+        if client:
+            reply = client.call('queue_broadcast', message=message_text, fingerprints=list(peers))
+            entry_ids, errors = reply['ids'], reply['errors']
+        else:
+            entry_ids, errors = outbox.broadcast(recipients, message_text)
 
-        except Exception as e:
-            print(f"Broadcast failed: {e}")
+        print(f"Broadcast queued for {len(entry_ids)}/{len(peers)} peer(s)")
 
-    thread = threading.Thread(target=broadcast_thread, daemon=True)
-    thread.start()
+        # Show errors if any
+        for fp, error in errors.items():
+            print(f"  Failed to {fp[:12]}: {error}")
+
+    except Exception as e:
+        print(f"Broadcast failed: {e}")
+
+
+def _handle_stats(client=None):
+    """
+    Show hot-path latencies, queue depth and cache counters.
+
+    Args:
+        client: DaemonClient to read the daemon's metrics from (optional)
+    """
+    try:
+        snapshot = client.call('metrics') if client else metrics.snapshot()
+    except Exception as e:
+        print(f"Failed to get stats: {e}")
+        return
 
+    stats = metrics.summary(snapshot)
+    counters = stats['counters']
 
-def _handle_peers(peers: dict):
+    print()
+    print(f"{'Latency':<24} {'count':>8} {'mean ms':>9} {'p50 ms':>9} {'p99 ms':>9}")
+    for name, latency in stats['latencies'].items():
+        print(f"{name:<24} {latency['count']:>8} {latency['mean_ms']:>9.3f} "
+              f"{latency['p50_ms']:>9.3f} {latency['p99_ms']:>9.3f}")
+
+    print()
+    for name, value in stats['gauges'].items():
+        print(f"{name:<32} {value}")
+    for name, value in counters.items():
+        print(f"{name:<32} {value}")
+
+    # Hit rates of the connection pool and peer key cache
+    for label, hits, misses in (("Pool hit rate", 'pool.hits', 'pool.misses'),
+                                ("Key cache hit rate", 'keystore.cache_hits', 'keystore.cache_misses')):
+        total = counters.get(hits, 0) + counters.get(misses, 0)
+        if total:
+            print(f"{label:<32} {counters.get(hits, 0) / total:.1%}")
+    print()
+
+
+def _handle_peers(peers: dict, presence=None, client=None):
     """
-    List all known peers.
+    List all known peers with whether they are online.
 
     Args:
         peers: Peers dictionary
+        presence: PresenceMonitor (optional)
+        client: DaemonClient to read presence from (optional)
     """
     if not peers:
         print("No peers configured")
         return
 
+    try:
+        status = client.call('presence') if client else presence.status() if presence else {}
+    except Exception:
+        status = {}
+
     print("Known peers:")
     for fingerprint, (host, port) in peers.items():
-        print(f"  {fingerprint[:12]} - {host}:{port}")
-
-
-def _handle_add(peers: dict):
+        listed = ", ".join(addresses.format_address(*address) for address in addresses.book.addresses(host, port))
+        state = status.get(fingerprint, {})
+        if state.get('online'):
+            seen = "online"
+        elif state.get('last_seen'):
+            seen = "offline, last seen " + datetime.fromtimestamp(state['last_seen']).strftime('%Y-%m-%d %H:%M')
+        elif state.get('online') is False:
+            seen = "offline"
+        else:
+            seen = "unknown"
+        print(f"  {fingerprint[:12]} - {listed} ({seen})")
+
+
+def _handle_add(peers: dict, client=None, presence=None):
     """
     Add new peer's public key.
 
     Args:
         peers: Peers dictionary
+        client: DaemonClient to register the peer with (optional)
+        presence: PresenceMonitor to track the peer with (optional)
     """
     try:
         # Prompt for public key path
@@ -240,25 +390,22 @@ def _handle_add(peers: dict):
         fingerprint = keystore.add_peer_key(key_path)
 
         # Prompt for peer address
-        address = input("Peer's address (host:port): ").strip()
+        address = input("Peer's address (host:port, several separated by commas): ").strip()
         if not address:
             print("Cancelled")
             return
 
-        # Parse address
-        if ':' not in address:
-            print("Invalid address format. Use host:port")
-            return
-
-        host, port_str = address.rsplit(':', 1)
+        # Parse addresses, primary first
         try:
-            port = int(port_str)
+            peer_addresses = addresses.parse_address_list(address)
         except ValueError:
-            print("Invalid port number")
+            print("Invalid address format. Use host:port")
             return
+        host, port = peer_addresses[0]
 
         # Add to peers dictionary
         peers[fingerprint] = (host, port)
+        addresses.set_addresses(peer_addresses)
 
         # Save peer address to file
         from pathlib import Path
@@ -266,6 +413,13 @@ def _handle_add(peers: dict):
         address_file = peers_dir / f"{fingerprint}.address"
         address_file.write_text(address)
 
+        # Let the daemon know about the new peer
+        if client:
+            client.call('add_peer', fingerprint=fingerprint, host=host, port=port,
+                        alternates=[addresses.format_address(*a) for a in peer_addresses[1:]])
+        elif presence:
+            presence.watch(fingerprint, host, port)
+
         print(f"Peer added: {fingerprint[:12]}")
 
     except Exception as e:
@@ -277,10 +431,11 @@ def _handle_quit(server):
     Quit chat session.
 
     Args:
-        server: ChatServer instance
+        server: ChatServer instance (None when attached to a daemon, which keeps running)
     """
     print("Goodbye!")
-    server.stop()
+    if server:
+        server.stop()
 
 
 def create_message_callback():
@@ -298,3 +453,35 @@ def create_message_callback():
         print(f"[{time_str}] {sender_fingerprint[:12]}: {plaintext}")
 
     return callback
+
+
+def create_delivery_callback():
+    """
+    Create callback function for outgoing message deliveries.
+
+    Returns:
+        Callback function that prints whether a queued message was delivered
+    """
+    def callback(recipient_fingerprint: str, entry_id: str, plaintext: str, error):
+        if error is None:
+            print(f"Sent to {recipient_fingerprint[:12]}")
+        else:
+            print(f"Failed to send to {recipient_fingerprint[:12]}: {error}")
+
+    return callback
+
+
+def create_file_callback():
+    """
+    Create callback function for completed incoming file transfers.
+
+    Returns:
+        Callback function that prints where the file was saved
+    """
+    def callback(sender_fingerprint: str, path: str, timestamp: float):
+        # Format timestamp
+        time_str = datetime.fromtimestamp(timestamp).strftime('%H:%M:%S')
+
+        print(f"[{time_str}] {sender_fingerprint[:12]} sent a file: {path}")
+
+    return callback
@@ -5,7 +5,7 @@ Standalone launcher for Enclave Web GUI.
 
 import sys
 import argparse
-from . import web_server
+from . import daemon, network, web_server
 
 
 def main():
@@ -34,6 +34,15 @@ Examples:
     parser.add_argument('--password', type=str, default=None,
                        help='Password to unlock keys (will prompt if not provided)')
 
+    parser.add_argument('--p2p-port', type=int, default=8000,
+                       help='Port for P2P server (default: 8000)')
+
+    parser.add_argument('--socket', type=str, default=str(daemon.SOCKET_PATH),
+                       help=f'Daemon socket to attach to if running (default: {daemon.SOCKET_PATH})')
+
+    parser.add_argument('--engine', choices=network.SERVER_ENGINES, default='threads',
+                       help='P2P server engine: threads or asyncio (default: threads)')
+
     args = parser.parse_args()
 
     print("""
@@ -50,7 +59,10 @@ Examples:
         web_server.start_web_server(
             host=args.host,
             port=args.port,
-            password=args.password
+            password=args.password,
+            p2p_port=args.p2p_port,
+            client=daemon.connect(args.socket),
+            engine=args.engine
         )
     except KeyboardInterrupt:
         print("\n\n✓ Web GUI shut down gracefully")
@@ -6,16 +6,18 @@ Provides WhatsApp-like interface with real-time messaging, file sharing, and pee
 import os
 import json
 import time
+import uuid
 import base64
+import shutil
 from pathlib import Path
 from datetime import datetime
-from flask import Flask, render_template, request, jsonify, send_from_directory
+from flask import Flask, Response, render_template, request, jsonify, send_from_directory
 from flask_socketio import SocketIO, emit
 from flask_cors import CORS
 import threading
 import getpass
 
-from . import keystore, network, message as msg_module, crypto
+from . import addresses, keystore, metrics, network, outbox, presence, profiler, transfer, message as msg_module, crypto
 
 # Flask app setup
 app = Flask(__name__,
@@ -27,12 +29,16 @@ socketio = SocketIO(app, cors_allowed_origins="*", async_mode='threading')
 
 # Global state
 chat_server = None
+message_outbox = None  # Outbox delivering sent messages in the background
+peer_presence = None  # PresenceMonitor heartbeating peers, unless attached to a daemon
+daemon_client = None  # DaemonClient when attached to a running node daemon
 private_key = None
 public_key = None
 my_fingerprint = None
-peers = {}  # {fingerprint: {'host': str, 'port': int, 'name': str, 'online': bool}}
+peers = {}  # {fingerprint: {'host': str, 'port': int, 'name': str, 'online': bool, 'last_seen': float}}
 message_history = {}  # {fingerprint: [{msg}, {msg}, ...]}
 MESSAGES_FILE = Path("keys/messages.json")
+UPLOADS_DIR = Path("keys/uploads")
 
 
 def load_message_history():
@@ -81,6 +87,9 @@ def add_to_history(peer_fingerprint, message_text, sent=False, timestamp=None):
 
 def message_received_callback(sender_fingerprint, plaintext, timestamp):
     """Callback when message is received from network layer."""
+    if peer_presence:
+        peer_presence.seen(sender_fingerprint)
+
     # Add to history
     add_to_history(sender_fingerprint, plaintext, sent=False, timestamp=timestamp)
 
@@ -95,6 +104,60 @@ def message_received_callback(sender_fingerprint, plaintext, timestamp):
     print(f"[WebGUI] Message from {sender_fingerprint[:12]}: {plaintext}")
 
 
+def delivery_callback(recipient_fingerprint, entry_id, plaintext, error):
+    """Handle delivered or dropped queued message."""
+    if error is not None:
+        socketio.emit('message_error', {
+            'to': recipient_fingerprint,
+            'error': str(error)
+        })
+        return
+
+    # Add to history
+    add_to_history(recipient_fingerprint, plaintext, sent=True)
+
+    # Notify web clients
+    socketio.emit('message_sent', {
+        'to': recipient_fingerprint,
+        'text': plaintext,
+        'timestamp': time.time()
+    })
+
+
+def presence_callback(fingerprint, online, last_seen):
+    """Callback when a peer goes online or offline."""
+    info = peers.get(fingerprint)
+    if info is None:
+        return
+    info['online'] = bool(online)
+    info['last_seen'] = last_seen
+
+    socketio.emit('peer_status', {
+        'fingerprint': fingerprint,
+        'online': info['online'],
+        'last_seen': last_seen
+    })
+
+
+def file_received_callback(sender_fingerprint, path, timestamp):
+    """Callback when a file transfer from a peer completes."""
+    if peer_presence:
+        peer_presence.seen(sender_fingerprint)
+
+    name = os.path.basename(path)
+    add_to_history(sender_fingerprint, f"📎 {name}", sent=False, timestamp=timestamp)
+
+    socketio.emit('file_received', {
+        'from': sender_fingerprint,
+        'name': name,
+        'path': path,
+        'timestamp': timestamp,
+        'time_str': datetime.fromtimestamp(timestamp).strftime('%I:%M %p')
+    })
+
+    print(f"[WebGUI] File from {sender_fingerprint[:12]}: {path}")
+
+
 def load_peers_from_disk():
     """Load peer information from disk."""
     global peers
@@ -107,19 +170,21 @@ def load_peers_from_disk():
         fingerprint = address_file.stem
         address = address_file.read_text().strip()
 
-        if ':' in address:
-            host, port_str = address.rsplit(':', 1)
-            try:
-                port = int(port_str)
-                peers[fingerprint] = {
-                    'host': host,
-                    'port': port,
-                    'name': fingerprint[:12],
-                    'online': False,
-                    'last_seen': None
-                }
-            except ValueError:
-                continue
+        # Primary address first, alternates are tried when connecting
+        try:
+            peer_addresses = addresses.parse_address_list(address)
+        except ValueError:
+            continue
+        addresses.set_addresses(peer_addresses)
+
+        host, port = peer_addresses[0]
+        peers[fingerprint] = {
+            'host': host,
+            'port': port,
+            'name': fingerprint[:12],
+            'online': False,
+            'last_seen': None
+        }
 
 
 # Flask routes
@@ -150,7 +215,9 @@ def get_peers():
             'name': info.get('name', fp[:12]),
             'host': info['host'],
             'port': info['port'],
+            'addresses': [addresses.format_address(*a) for a in addresses.book.addresses(info['host'], info['port'])],
             'online': info.get('online', False),
+            'last_seen': info.get('last_seen'),
             'unread': 0  # TODO: implement unread count
         })
 
@@ -178,38 +245,118 @@ def send_message(fingerprint):
 
     peer_info = peers[fingerprint]
 
+    # Queue in the outbox, delivery is reported through delivery_callback
+    try:
+        if daemon_client:
+            entry_id = daemon_client.call('queue', fingerprint=fingerprint, message=message_text)
+        else:
+            entry_id = message_outbox.send(peer_info['host'], peer_info['port'], fingerprint, message_text)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+    return jsonify({'success': True, 'id': entry_id})
+
+
+@app.route('/api/peers/<fingerprint>/send-file', methods=['POST'])
+def send_file(fingerprint):
+    """Stream an uploaded file to a peer, or resume a failed transfer by transfer_id."""
+    upload = request.files.get('file')
+    transfer_id = request.form.get('transfer_id')
+
+    name = None
+    if upload is not None and upload.filename:
+        # Keep only the last path component of the original name for the
+        # recipient; a name ending in a separator leaves nothing to save as
+        name = os.path.basename(upload.filename.replace('\\', '/')).strip()
+        if name in ('', '.', '..') or '\0' in name:
+            return jsonify({'error': 'Invalid file name'}), 400
+
+    if transfer_id:
+        try:
+            transfer_id = str(uuid.UUID(transfer_id))
+        except ValueError:
+            return jsonify({'error': 'Invalid transfer ID'}), 400
+    elif name is None:
+        return jsonify({'error': 'No file uploaded'}), 400
+
+    if fingerprint not in peers:
+        return jsonify({'error': 'Peer not found'}), 404
+
+    peer_info = peers[fingerprint]
+    prune_uploads()
+
+    # Uploads are spooled per transfer and kept until it completes, so a
+    # failed transfer can resume from the same file
+    upload_dir = UPLOADS_DIR / (transfer_id or str(uuid.uuid4()))
+    if name is not None:
+        shutil.rmtree(upload_dir, ignore_errors=True)
+        upload_dir.mkdir(parents=True, exist_ok=True)
+        upload_path = upload_dir / name
+        upload.save(upload_path)
+    else:
+        spooled = list(upload_dir.iterdir()) if upload_dir.is_dir() else []
+        if not spooled:
+            return jsonify({'error': 'Transfer not found, upload the file again'}), 404
+        upload_path = spooled[0]
+        name = upload_path.name
+
+        # A resume restarts the age at which the spooled file is pruned
+        os.utime(upload_dir)
+
+    transfer_id = upload_dir.name
+
     # Send in background thread
-    def send_thread():
+    def send_file_thread():
         try:
-            network.send_message(
-                peer_info['host'],
-                peer_info['port'],
-                fingerprint,
-                message_text,
-                private_key,
-                my_fingerprint
-            )
-
-            # Add to history
-            add_to_history(fingerprint, message_text, sent=True)
-
-            # Notify web clients
-            socketio.emit('message_sent', {
-                'to': fingerprint,
-                'text': message_text,
-                'timestamp': time.time()
-            })
+            if daemon_client:
+                daemon_client.call('send_file', fingerprint=fingerprint, path=str(upload_path.resolve()),
+                                   transfer_id=transfer_id)
+            else:
+                network.send_file(
+                    peer_info['host'],
+                    peer_info['port'],
+                    fingerprint,
+                    str(upload_path),
+                    private_key,
+                    my_fingerprint,
+                    transfer_id
+                )
 
         except Exception as e:
             socketio.emit('message_error', {
                 'to': fingerprint,
-                'error': str(e)
+                'error': str(e),
+                'transfer_id': transfer_id
             })
+            return
+
+        shutil.rmtree(upload_dir, ignore_errors=True)
+        add_to_history(fingerprint, f"📎 {name}", sent=True)
+
+        socketio.emit('file_sent', {
+            'to': fingerprint,
+            'name': name,
+            'transfer_id': transfer_id,
+            'timestamp': time.time()
+        })
 
-    thread = threading.Thread(target=send_thread, daemon=True)
+    thread = threading.Thread(target=send_file_thread, daemon=True)
     thread.start()
 
-    return jsonify({'success': True})
+    return jsonify({'success': True, 'transfer_id': transfer_id})
+
+
+def prune_uploads():
+    """Delete spooled uploads of failed transfers not resumed within transfer.PARTIAL_MAX_AGE."""
+    if not UPLOADS_DIR.is_dir():
+        return
+    cutoff = time.time() - transfer.PARTIAL_MAX_AGE
+    for upload_dir in UPLOADS_DIR.iterdir():
+        try:
+            if upload_dir.stat().st_mtime < cutoff:
+                shutil.rmtree(upload_dir, ignore_errors=True)
+        except OSError:
+            continue
 
 
 @app.route('/api/peers/add', methods=['POST'])
@@ -219,11 +366,17 @@ def add_peer():
     peer_name = data.get('name', '')
     peer_host = data.get('host', '')
     peer_port = data.get('port', '')
+    alternates = data.get('alternates', [])
     public_key_data = data.get('public_key', '')
 
     if not all([peer_host, peer_port, public_key_data]):
         return jsonify({'error': 'Missing required fields'}), 400
 
+    try:
+        peer_addresses = [(peer_host, int(peer_port))] + [addresses.parse_address(a) for a in alternates]
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
     try:
         # Save public key to temp file
         temp_key_file = Path(f"keys/temp_peer_key_{int(time.time())}.pem")
@@ -232,10 +385,11 @@ def add_peer():
         # Add peer key
         fingerprint = keystore.add_peer_key(str(temp_key_file))
 
-        # Save address
-        address = f"{peer_host}:{peer_port}"
+        # Save addresses, primary first
+        address = ", ".join(addresses.format_address(host, port) for host, port in peer_addresses)
         address_file = Path(f"keys/peers/{fingerprint}.address")
         address_file.write_text(address)
+        addresses.set_addresses(peer_addresses)
 
         # Add to peers dict
         peers[fingerprint] = {
@@ -251,6 +405,13 @@ def add_peer():
         # Reload key into cache
         keystore.load_peer_key(fingerprint)
 
+        # Let the daemon know about the new peer
+        if daemon_client:
+            daemon_client.call('add_peer', fingerprint=fingerprint, host=peer_host, port=int(peer_port),
+                               alternates=alternates)
+        elif peer_presence:
+            peer_presence.watch(fingerprint, peer_host, int(peer_port))
+
         return jsonify({
             'success': True,
             'fingerprint': fingerprint,
@@ -273,32 +434,90 @@ def broadcast_message():
     if not peers:
         return jsonify({'error': 'No peers available'}), 400
 
-    # Send in background
-    def broadcast_thread():
-        recipients = [(info['host'], info['port'], fp)
-                     for fp, info in peers.items()]
+    recipients = [(info['host'], info['port'], fp)
+                  for fp, info in peers.items()]
 
-        results, errors = network.send_batch_messages(
-            recipients,
-            message_text,
-            private_key,
-            my_fingerprint
-        )
+    # Queue in the outbox, deliveries are reported through delivery_callback
+    try:
+        if daemon_client:
+            reply = daemon_client.call('queue_broadcast', message=message_text, fingerprints=list(peers))
+            entry_ids, errors = reply['ids'], reply['errors']
+        else:
+            entry_ids, errors = message_outbox.broadcast(recipients, message_text)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
 
-        # Add to history for each peer
-        for fp in peers.keys():
-            add_to_history(fp, message_text, sent=True)
+    # Notify clients
+    socketio.emit('broadcast_queued', {
+        'queued_count': len(entry_ids),
+        'total': len(recipients),
+        'errors': errors
+    })
 
-        # Notify clients
-        socketio.emit('broadcast_complete', {
-            'success_count': sum(1 for v in results.values() if v),
-            'total': len(results)
-        })
+    return jsonify({'success': True, 'ids': entry_ids, 'errors': errors})
 
-    thread = threading.Thread(target=broadcast_thread, daemon=True)
-    thread.start()
 
-    return jsonify({'success': True})
+@app.route('/api/metrics')
+def get_metrics():
+    """Get hot-path metrics as JSON, or as Prometheus text with ?format=prometheus."""
+    try:
+        snapshot = daemon_client.call('metrics') if daemon_client else metrics.snapshot()
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+    if request.args.get('format') == 'prometheus':
+        return Response(metrics.to_prometheus(snapshot), mimetype='text/plain; version=0.0.4')
+    return jsonify(snapshot)
+
+
+@app.route('/api/profile')
+def get_profile_status():
+    """Get the state of the current or last profiling session."""
+    try:
+        status = daemon_client.call('profile_status') if daemon_client else profiler.status()
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    return jsonify(status)
+
+
+@app.route('/api/profile/start', methods=['POST'])
+def start_profile():
+    """Start profiling the node for a bounded duration."""
+    data = request.json or {}
+
+    try:
+        options = {
+            'duration': float(data.get('duration', profiler.DEFAULT_DURATION)),
+            'interval': float(data.get('interval', profiler.DEFAULT_INTERVAL)),
+            'allocations': bool(data.get('allocations', True))
+        }
+    except (TypeError, ValueError):
+        return jsonify({'error': 'duration and interval must be numbers'}), 400
+
+    try:
+        if daemon_client:
+            status = daemon_client.call('profile_start', **options)
+        else:
+            status = profiler.start(**options)
+    except (ValueError, RuntimeError) as e:
+        # Bad arguments or wrong state, also when reported by the daemon
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    return jsonify(status)
+
+
+@app.route('/api/profile/stop', methods=['POST'])
+def stop_profile():
+    """Stop profiling and write the reports."""
+    try:
+        report = daemon_client.call('profile_stop') if daemon_client else profiler.stop()
+    except (ValueError, RuntimeError) as e:
+        # Bad arguments or wrong state, also when reported by the daemon
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    return jsonify(report)
 
 
 @app.route('/api/export/public-key')
@@ -340,7 +559,8 @@ def handle_typing(data):
     emit('peer_typing', data, broadcast=True, include_self=False)
 
 
-def start_web_server(host='0.0.0.0', port=5000, password=None):
+def start_web_server(host='0.0.0.0', port=5000, password=None, p2p_port=8000, client=None, engine='threads',
+                     listener_processes=1, profile=None):
     """
     Start the web GUI server.
 
@@ -348,18 +568,31 @@ def start_web_server(host='0.0.0.0', port=5000, password=None):
         host: Host to bind to (default: 0.0.0.0)
         port: Port for web interface (default: 5000)
         password: Password to unlock keys (if None, will prompt)
+        p2p_port: Port for the P2P chat server (default: 8000)
+        client: DaemonClient to attach to instead of unlocking keys and
+                starting a P2P server (optional)
+        engine: P2P server engine, 'threads' or 'asyncio' (default: threads)
+        listener_processes: Number of P2P server processes sharing the port (default: 1)
+        profile: Seconds to profile this process for once started (optional)
     """
-    global chat_server, private_key, public_key, my_fingerprint
-
-    # Load user keys
-    if password is None:
-        password = getpass.getpass("Enter password to unlock private key: ")
+    global chat_server, message_outbox, peer_presence, private_key, public_key, my_fingerprint, daemon_client
+
+    if client:
+        # Attach to running daemon: it owns the key and P2P server
+        daemon_client = client
+        info = client.call('info')
+        my_fingerprint = info['fingerprint']
+        p2p_port = info['port']
+    else:
+        # Load user keys
+        if password is None:
+            password = getpass.getpass("Enter password to unlock private key: ")
 
-    try:
-        private_key, public_key, my_fingerprint = keystore.load_my_keys(password)
-    except ValueError as e:
-        print(f"Error: {e}")
-        return
+        try:
+            private_key, public_key, my_fingerprint = keystore.load_my_keys(password)
+        except ValueError as e:
+            print(f"Error: {e}")
+            return
 
     print(f"\n{'='*60}")
     print(f"Enclave Web GUI Starting...")
@@ -369,39 +602,68 @@ def start_web_server(host='0.0.0.0', port=5000, password=None):
     # Load message history
     load_message_history()
 
-    # Preload peer keys
-    print("Loading peer keys...")
-    keystore.preload_all_peer_keys()
-
     # Load peers
     load_peers_from_disk()
     print(f"Loaded {len(peers)} peer(s)")
 
-    # Start P2P chat server
-    chat_port = 8000  # Default P2P port
-    chat_server = network.ChatServer(
-        host='0.0.0.0',
-        port=chat_port,
-        private_key=private_key,
-        public_key=public_key,
-        fingerprint=my_fingerprint,
-        message_callback=message_received_callback,
-        max_workers=20
-    )
+    if client:
+        client.subscribe(message_received_callback, file_received_callback, delivery_callback, presence_callback)
+        for fingerprint, state in client.call('presence').items():
+            if fingerprint in peers and state['online'] is not None:
+                peers[fingerprint].update(online=state['online'], last_seen=state['last_seen'])
+        print("Attached to Enclave daemon")
+    else:
+        # Preload peer keys
+        print("Loading peer keys...")
+        keystore.preload_all_peer_keys()
+
+        # Start P2P chat server
+        chat_server = network.create_server(
+            engine,
+            listener_processes,
+            host='0.0.0.0',
+            port=p2p_port,
+            private_key=private_key,
+            public_key=public_key,
+            fingerprint=my_fingerprint,
+            message_callback=message_received_callback,
+            max_workers=20,
+            file_callback=file_received_callback,
+            replay_cache_path=keystore.REPLAY_CACHE_PATH
+        )
+
+        chat_server.start()
+
+        # Heartbeat peers so the UI shows who is online and the outbox holds messages for peers that are not
+        peer_presence = presence.PresenceMonitor()
+        peer_presence.set_peers({fp: (info['host'], info['port']) for fp, info in peers.items()})
+        peer_presence.add_listener(presence_callback)
+        peer_presence.start()
+
+        message_outbox = outbox.Outbox(private_key, my_fingerprint, delivery_callback=delivery_callback,
+                                       presence=peer_presence)
+        message_outbox.start()
 
-    chat_server.start()
+    if profile:
+        profiler.start(profile)
 
     # Start Flask web server
     print(f"\n{'='*60}")
     print(f"🌐 Web GUI available at: http://localhost:{port}")
-    print(f"📡 P2P Server listening on port: {chat_port}")
+    print(f"📡 P2P Server listening on port: {p2p_port}")
     print(f"{'='*60}\n")
 
     try:
         socketio.run(app, host=host, port=port, debug=False, allow_unsafe_werkzeug=True)
     except KeyboardInterrupt:
         print("\n\nShutting down...")
-        chat_server.stop()
+        profiler.finish()
+        if message_outbox:
+            message_outbox.stop()
+        if peer_presence:
+            peer_presence.stop()
+        if chat_server:
+            chat_server.stop()
 
 
 if __name__ == '__main__':
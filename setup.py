@@ -21,6 +21,8 @@ setup(
         "console_scripts": [
             "enclave=enclave.main:main",
             "enclave-web=enclave.web_launcher:main",
+            "enclave-benchmark=enclave.benchmark:main",
+            "enclave-bench=enclave.loadgen:main",
         ],
     },
     python_requires=">=3.8",
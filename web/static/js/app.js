@@ -48,14 +48,33 @@ function initWebSocket() {
     });
 
     socket.on('message_error', function(data) {
+        if (data.transfer_id) {
+            showToast('Failed to send file: ' + data.error, 'error');
+            if (confirm('File transfer failed. Resume it?')) {
+                resumeFile(data.to, data.transfer_id);
+            }
+            return;
+        }
         showToast('Failed to send message: ' + data.error, 'error');
     });
 
-    socket.on('broadcast_complete', function(data) {
-        showToast(`Broadcast complete: ${data.success_count}/${data.total} sent`, 'success');
+    socket.on('file_received', function(data) {
+        handleNewMessage({ ...data, text: '📎 ' + data.name });
+    });
+
+    socket.on('file_sent', function(data) {
+        showToast(`File sent: ${data.name}`, 'success');
+    });
+
+    socket.on('broadcast_queued', function(data) {
+        showToast(`Broadcast queued: ${data.queued_count}/${data.total} peers`, 'success');
         closeModal('broadcast-modal');
     });
 
+    socket.on('peer_status', function(data) {
+        handlePeerStatus(data);
+    });
+
     socket.on('peer_typing', function(data) {
         if (data.peer === currentPeer) {
             showTypingIndicator();
@@ -117,7 +136,7 @@ function renderPeers() {
     peersList.innerHTML = peers.map(peer => `
         <div class="peer-item ${currentPeer === peer.fingerprint ? 'active' : ''}"
              onclick="selectPeer('${peer.fingerprint}')">
-            <div class="avatar">
+            <div class="avatar ${peer.online ? 'online' : ''}">
                 <i class="fas fa-user"></i>
             </div>
             <div class="peer-details">
@@ -159,6 +178,25 @@ function renderMessages(messages) {
     container.scrollTop = container.scrollHeight;
 }
 
+function formatPresence(peer) {
+    if (peer.online) return 'Online';
+    if (!peer.last_seen) return 'Offline';
+    return 'Last seen ' + new Date(peer.last_seen * 1000).toLocaleString();
+}
+
+function handlePeerStatus(data) {
+    const peer = peers.find(p => p.fingerprint === data.fingerprint);
+    if (!peer) return;
+
+    peer.online = data.online;
+    peer.last_seen = data.last_seen;
+    renderPeers();
+
+    if (currentPeer === peer.fingerprint) {
+        document.getElementById('current-peer-status').textContent = `${formatPresence(peer)} • ${peer.host}:${peer.port}`;
+    }
+}
+
 // Peer Selection
 function selectPeer(fingerprint) {
     currentPeer = fingerprint;
@@ -171,7 +209,7 @@ function selectPeer(fingerprint) {
     document.getElementById('chat-container').style.display = 'flex';
 
     document.getElementById('current-peer-name').textContent = peer.name;
-    document.getElementById('current-peer-status').textContent = `${peer.host}:${peer.port}`;
+    document.getElementById('current-peer-status').textContent = `${formatPresence(peer)} • ${peer.host}:${peer.port}`;
 
     // Update active peer in sidebar
     renderPeers();
@@ -317,7 +355,7 @@ function showPeerInfo() {
     document.getElementById('info-peer-name').textContent = peer.name;
     document.getElementById('info-peer-fingerprint').textContent = peer.fingerprint;
     document.getElementById('info-peer-address').textContent = `${peer.host}:${peer.port}`;
-    document.getElementById('info-peer-status').textContent = peer.online ? 'Online' : 'Offline';
+    document.getElementById('info-peer-status').textContent = formatPresence(peer);
 
     document.getElementById('peer-info-modal').classList.add('active');
 }
@@ -498,7 +536,59 @@ function showEmojiPicker() {
 }
 
 function attachFile() {
-    showToast('File sharing feature coming soon', 'info');
+    if (!currentPeer) {
+        showToast('Select a chat first', 'info');
+        return;
+    }
+
+    const input = document.createElement('input');
+    input.type = 'file';
+    input.onchange = async function() {
+        const file = input.files[0];
+        if (!file) return;
+
+        const formData = new FormData();
+        formData.append('file', file);
+
+        try {
+            const response = await fetch(`/api/peers/${currentPeer}/send-file`, {
+                method: 'POST',
+                body: formData
+            });
+
+            if (response.ok) {
+                showToast(`Sending ${file.name}...`, 'info');
+            } else {
+                showToast('Failed to send file', 'error');
+            }
+        } catch (error) {
+            console.error('File send error:', error);
+            showToast('Failed to send file', 'error');
+        }
+    };
+    input.click();
+}
+
+async function resumeFile(peer, transferId) {
+    const formData = new FormData();
+    formData.append('transfer_id', transferId);
+
+    try {
+        const response = await fetch(`/api/peers/${peer}/send-file`, {
+            method: 'POST',
+            body: formData
+        });
+
+        if (response.ok) {
+            showToast('Resuming file transfer...', 'info');
+        } else {
+            const data = await response.json();
+            showToast('Failed to resume file: ' + data.error, 'error');
+        }
+    } catch (error) {
+        console.error('File resume error:', error);
+        showToast('Failed to resume file', 'error');
+    }
 }
 
 function setupEventListeners() {